@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Conversion of sweep offsets to azimuth and elevation using precomputed tables
+#
+# calculateAE() in decodeV2.py computes, for each sensor:
+#   firstBeam = offset0 / period * 2 * pi
+#   secondBeam = offset1 / period * 2 * pi
+#   azimuth = (firstBeam + secondBeam) / 2 - pi
+#   elevation = atan(sin(((secondBeam - firstBeam) - 120deg) / 2) / tan(60deg / 2))
+#
+# With half_scale = pi / period, precomputed per channel, this becomes:
+#   azimuth = (offset0 + offset1) * half_scale - pi
+#   elevation = atan(sin((offset1 - offset0) * half_scale - 60deg) * (1 / tan(30deg)))
+#
+# The same tables are used for single sweep pairs in the decoders and for
+# whole batches of offset pairs with numpy. BatchConverter collects the pairs
+# of a decoder and converts them in batches, decodeV2.py uses it when decoding
+# a file with --angle-tables.
+#
+# The period tables of the decoders and tools are defined here only.
+
+import math
+
+# The cycle times of the Lighthouse base stations per channel, in their 48 MHz clock
+BASE_STATION_PERIODS = [959000, 957000,
+                        953000, 949000,
+                        947000, 943000,
+                        941000, 939000,
+                        937000, 929000,
+                        919000, 911000,
+                        907000, 901000,
+                        893000, 887000]
+# The same in the 24 MHz clock of the deck
+PERIODS = [period / 2 for period in BASE_STATION_PERIODS]
+
+BATCH_SIZE = 4096
+
+HALF_SCALES = [math.pi / period for period in PERIODS]
+A60 = math.radians(60)
+INV_TAN_P_2 = 1 / math.tan(math.radians(60) / 2)
+
+
+# Returns [(azimuth, elevation)] for each sensor of a sweep pair
+def convert_pair(channel, offsets0, offsets1):
+    half_scale = HALF_SCALES[channel]
+    pi = math.pi
+    sin = math.sin
+    atan = math.atan
+
+    result = []
+    for offset0, offset1 in zip(offsets0, offsets1):
+        azimuth = (offset0 + offset1) * half_scale - pi
+        elevation = atan(sin((offset1 - offset0) * half_scale - A60) * INV_TAN_P_2)
+        result.append((azimuth, elevation))
+
+    return result
+
+
+# Converts a batch of sweep pairs. channels is an array of n channels,
+# offsets0 and offsets1 are (n, sensors) arrays of the first and second sweep
+# offsets. Returns azimuth and elevation (n, sensors) arrays.
+def convert_batch(channels, offsets0, offsets1):
+    import numpy as np
+
+    half_scale = np.asarray(HALF_SCALES)[np.asarray(channels)][:, np.newaxis]
+    offsets0 = np.asarray(offsets0, dtype=np.float64)
+    offsets1 = np.asarray(offsets1, dtype=np.float64)
+
+    azimuth = (offsets0 + offsets1) * half_scale - math.pi
+    elevation = np.arctan(np.sin((offsets1 - offsets0) * half_scale - A60) * INV_TAN_P_2)
+    return azimuth, elevation
+
+
+# Collects sweep pairs and converts them with convert_batch() every size
+# pairs and on flush(). output is called with the item of each pair and its
+# [(azimuth, elevation)] for each sensor, in the order the pairs were added.
+class BatchConverter:
+    def __init__(self, output, size=BATCH_SIZE):
+        self.output = output
+        self.size = size
+        self.items = []
+        self.channels = []
+        self.offsets0 = []
+        self.offsets1 = []
+
+    def add(self, item, channel, offsets0, offsets1):
+        self.items.append(item)
+        self.channels.append(channel)
+        self.offsets0.append(offsets0)
+        self.offsets1.append(offsets1)
+        if len(self.items) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.items:
+            return
+        azimuth, elevation = convert_batch(self.channels, self.offsets0, self.offsets1)
+        items = self.items
+        self.items = []
+        self.channels = []
+        self.offsets0 = []
+        self.offsets1 = []
+        for item, item_azimuth, item_elevation in zip(items, azimuth.tolist(), elevation.tolist()):
+            self.output(item, list(zip(item_azimuth, item_elevation)))
+
+
+if __name__ == "__main__":
+    # Check the tables against calculateAE() and compare the speed
+    import random
+    import time
+    import numpy as np
+    from decodeV2 import calculateAE
+
+    count = 100000
+    rnd = random.Random(1)
+    channels = [rnd.randrange(16) for _ in range(count)]
+    offsets0 = [[rnd.randrange(100000, 200000) for _ in range(4)] for _ in range(count)]
+    offsets1 = [[o + rnd.randrange(100000, 200000) for o in pair] for pair in offsets0]
+
+    start = time.perf_counter()
+    reference = []
+    for channel, pair0, pair1 in zip(channels, offsets0, offsets1):
+        period = PERIODS[channel]
+        angles = []
+        for offset0, offset1 in zip(pair0, pair1):
+            firstBeam = (offset0 / period) * 2 * math.pi
+            secondBeam = (offset1 / period) * 2 * math.pi
+            angles.append(calculateAE(firstBeam, secondBeam))
+        reference.append(angles)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pairs = [convert_pair(channel, pair0, pair1) for channel, pair0, pair1 in zip(channels, offsets0, offsets1)]
+    pair_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    azimuth, elevation = convert_batch(channels, offsets0, offsets1)
+    batch_time = time.perf_counter() - start
+
+    reference = np.array(reference)
+    pair_error = np.max(np.abs(np.array(pairs) - reference))
+    batch_error = max(np.max(np.abs(azimuth - reference[:, :, 0])), np.max(np.abs(elevation - reference[:, :, 1])))
+
+    print("{} sweep pairs".format(count))
+    print("calculateAE:   {:8.1f} ms".format(reference_time * 1000))
+    print("convert_pair:  {:8.1f} ms, max error {:.3g} rad".format(pair_time * 1000, pair_error))
+    print("convert_batch: {:8.1f} ms, max error {:.3g} rad".format(batch_time * 1000, batch_error))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Binary angle files
+#
+# Angles are stored as fixed size records, one per sweep pair, after a file
+# header. All numbers are little-endian.
+#
+# Header, 16 bytes:
+#
+#   Offset  Type     Field
+#   0       char[4]  Magic, "LHAN"
+#   4       uint16   Format version, 1
+#   6       uint16   Header size in bytes
+#   8       uint16   Record size in bytes
+#   10      uint16   Number of sensors
+#   12      uint32   Timestamp clock frequency in Hz, 24000000
+#
+# Record, 40 bytes:
+#
+#   Offset  Type        Field
+#   0       uint32      Timestamp of the sweep pair, 24 bits in the deck clock
+#   4       uint8       Channel, zero indexed (0-15)
+#   5       uint8       Slow bit, 0xff if not known
+#   6       uint16      Valid mask, bit n is set if sensor n has angles
+#   8       float32[8]  Azimuth and elevation in radians, for sensor 0 to 3
+#
+# Records are packed in a preallocated buffer and written in bulk.
+
+import struct
+import os
+
+MAGIC = b'LHAN'
+VERSION = 1
+HEADER = struct.Struct("<4sHHHHI")
+RECORD = struct.Struct("<IBBH8f")
+N_SENSORS = 4
+CLOCK_FREQUENCY = 24000000
+NO_SLOW_BIT = 0xff
+
+WRITE_BUFFER_RECORDS = 4096
+
+
+class AngleWriter:
+    def __init__(self, file_name, buffer_records=WRITE_BUFFER_RECORDS):
+        self.file = open(file_name, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, HEADER.size, RECORD.size, N_SENSORS, CLOCK_FREQUENCY))
+
+        self.buffer = bytearray(RECORD.size * buffer_records)
+        self.buffer_records = buffer_records
+        self.used = 0
+        self.count = 0
+
+    # angles is a list of (azimuth, elevation) per sensor, None if a sensor has
+    # no angles
+    def write(self, ts, channel, slow_bit, angles):
+        valid = 0
+        values = [0.0] * (2 * N_SENSORS)
+        for i, a in enumerate(angles):
+            if a is not None:
+                valid |= 1 << i
+                values[2 * i] = a[0]
+                values[2 * i + 1] = a[1]
+
+        if slow_bit is None:
+            slow_bit = NO_SLOW_BIT
+
+        RECORD.pack_into(self.buffer, self.used * RECORD.size, ts & 0xffffff, channel, slow_bit, valid, *values)
+        self.used += 1
+        self.count += 1
+        if self.used == self.buffer_records:
+            self.flush()
+
+    # Writes an Angles object from decodeV2.py
+    def write_angles(self, angles):
+        self.write(angles.ts, angles.channel, angles.slow_bit, angles.data)
+
+    def flush(self):
+        self.file.write(memoryview(self.buffer)[:self.used * RECORD.size])
+        self.used = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_header(file_name):
+    with open(file_name, "rb") as f:
+        data = f.read(HEADER.size)
+
+    if len(data) < HEADER.size:
+        raise ValueError("{}: file too short".format(file_name))
+
+    magic, version, header_size, record_size, n_sensors, clock = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError("{}: not an angle file".format(file_name))
+    if version != VERSION or record_size != RECORD.size or n_sensors != N_SENSORS:
+        raise ValueError("{}: unsupported angle file version {}".format(file_name, version))
+
+    return header_size, clock
+
+
+# Returns the records of an angle file as a memory mapped numpy structured
+# array, with fields ts, channel, slow_bit, valid and angles, a (4, 2) array
+# of azimuth, elevation per sensor
+def read_angles(file_name):
+    import numpy as np
+
+    dtype = np.dtype([("ts", "<u4"), ("channel", "u1"), ("slow_bit", "u1"), ("valid", "<u2"),
+                      ("angles", "<f4", (N_SENSORS, 2))])
+    assert dtype.itemsize == RECORD.size
+
+    header_size, _ = read_header(file_name)
+    count = (os.path.getsize(file_name) - header_size) // RECORD.size
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(file_name, dtype=dtype, mode="r", offset=header_size, shape=(count,))
+
+
+if __name__ == "__main__":
+    import sys
+    import math
+    if len(sys.argv) < 2:
+        print("Usage: {} <angles.lha>".format(sys.argv[0]))
+        exit(1)
+
+    for record in read_angles(sys.argv[1]):
+        for sensor in range(N_SENSORS):
+            if record["valid"] & (1 << sensor):
+                azimuth, elevation = record["angles"][sensor]
+                print("TS:{:06x} Chan:{:2d} Sensor:{} azimuth:{:8.2f} elevation:{:8.2f}".format(
+                    record["ts"], record["channel"] + 1, sensor, math.degrees(azimuth), math.degrees(elevation)))
+        print()
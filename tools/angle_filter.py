@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+# Outlier rejection and smoothing of the angles
+#
+# The angles of each sensor and channel are filtered on their own:
+#
+#   * The median of the last MEDIAN_WINDOW samples is taken, per azimuth and
+#     elevation
+#   * A sample further than GATE from the median is an outlier, for instance
+#     a reflection, and is rejected
+#   * The medians of the samples that are not rejected are smoothed with an
+#     exponential moving average, the output
+#
+# The filter restarts when a sensor has no angles for RESET_TICKS. The
+# median lags MEDIAN_WINDOW // 2 samples behind and the average 1 / ALPHA - 1
+# samples, 40 ms at 50 Hz with the defaults.
+#
+# The samples are timed with unwrapped ticks, as the 24 bits timestamps wrap
+# every 0.7 s. The decoders unwrap the frames they receive, sync frames
+# included, with a timeline.Unwrapper. An angle file has no sync frames, its
+# timestamps are unwrapped by record_ticks() as gaps shorter than a wrap.
+#
+# AngleFilter filters the Angles of decodeV2.py as they are decoded, with a
+# fixed size state per sensor and channel. filter_records() filters all the
+# records of an angle file at once with numpy and gives the same results, to
+# rounding.
+
+import math
+
+from angle_file import N_SENSORS
+from timeline import MAX_BACKWARD_TICKS, TIMESTAMP_MASK, TIMESTAMP_WRAP
+
+N_CHANNELS = 16
+
+MEDIAN_WINDOW = 3
+GATE = math.radians(2)
+ALPHA = 0.5
+RESET_TICKS = 24000000 // 10
+# Samples of a run averaged at once by filter_records()
+SMOOTH_BLOCK = 64
+
+
+# Median of the first count values of a list, the mean of the two middle
+# values for an even count
+def _median(values, count):
+    s = sorted(values[:count])
+    return (s[(count - 1) // 2] + s[count // 2]) / 2
+
+
+class _SensorState:
+    __slots__ = ('azimuths', 'elevations', 'count', 'next', 'ticks', 'smooth', 'samples', 'rejected')
+
+    def __init__(self, window):
+        self.azimuths = [0.0] * window
+        self.elevations = [0.0] * window
+        self.count = 0
+        self.next = 0
+        self.ticks = None
+        # Averaged (azimuth, elevation), None until the first sample
+        self.smooth = None
+        self.samples = 0
+        self.rejected = 0
+
+
+class AngleFilter:
+    def __init__(self, window=MEDIAN_WINDOW, gate=GATE, alpha=ALPHA, reset_ticks=RESET_TICKS):
+        self.window = window
+        self.gate = gate
+        self.alpha = alpha
+        self.reset_ticks = reset_ticks
+        self.states = [[_SensorState(window) for _ in range(N_SENSORS)] for _ in range(N_CHANNELS)]
+
+    # Returns the filtered (azimuth, elevation) of a sample at unwrapped time
+    # ticks, None if it is rejected
+    def push(self, channel, sensor, ticks, azimuth, elevation):
+        state = self.states[channel][sensor]
+        state.samples += 1
+
+        if state.ticks is not None and ticks - state.ticks > self.reset_ticks:
+            state.count = 0
+            state.next = 0
+            state.smooth = None
+        state.ticks = ticks
+
+        state.azimuths[state.next] = azimuth
+        state.elevations[state.next] = elevation
+        state.next = (state.next + 1) % self.window
+        if state.count < self.window:
+            state.count += 1
+
+        median_azimuth = _median(state.azimuths, state.count)
+        median_elevation = _median(state.elevations, state.count)
+        if abs(azimuth - median_azimuth) > self.gate or abs(elevation - median_elevation) > self.gate:
+            state.rejected += 1
+            return None
+
+        if state.smooth is None:
+            state.smooth = (median_azimuth, median_elevation)
+        else:
+            smooth_azimuth, smooth_elevation = state.smooth
+            state.smooth = (smooth_azimuth + self.alpha * (median_azimuth - smooth_azimuth),
+                            smooth_elevation + self.alpha * (median_elevation - smooth_elevation))
+        return state.smooth
+
+    # Filters the data of an Angles from decodeV2.py in place, the rejected
+    # sensors are set to None. ticks is the unwrapped time of angles.ts.
+    def filter(self, angles, ticks):
+        data = angles.data
+        for sensor in range(N_SENSORS):
+            if data[sensor] is not None:
+                data[sensor] = self.push(angles.channel, sensor, ticks, data[sensor][0], data[sensor][1])
+        return angles
+
+    # Returns the number of samples and rejected samples per channel
+    def counts(self):
+        return [(sum(s.samples for s in states), sum(s.rejected for s in states)) for states in self.states]
+
+    def report(self):
+        lines = []
+        for channel, (samples, rejected) in enumerate(self.counts()):
+            if samples:
+                lines.append("Chan:{:2d} {:6d} samples {:5d} rejected ({:.2%})".format(
+                    channel + 1, samples, rejected, rejected / samples))
+        return "\n".join(lines)
+
+
+# Returns the unwrapped ticks of the records of an angle file as an int64
+# array. Without sync frames a gap longer than a wrap is taken as shorter by
+# a multiple of the wrap, a record up to MAX_BACKWARD_TICKS back in time is
+# earlier than the one before it.
+def record_ticks(records):
+    import numpy as np
+
+    timestamps = np.asarray(records["ts"]).astype(np.int64)
+    if len(timestamps) == 0:
+        return timestamps
+    deltas = np.diff(timestamps, prepend=timestamps[0]) & TIMESTAMP_MASK
+    deltas[deltas > TIMESTAMP_WRAP - MAX_BACKWARD_TICKS] -= TIMESTAMP_WRAP
+    return timestamps[0] + np.cumsum(deltas)
+
+
+# Filters the records of an angle file, as read by angle_file.read_angles(),
+# as AngleFilter does one at a time. ticks is the unwrapped time of the
+# records, record_ticks() if None. Returns the filtered angles as a float64
+# (records, 4, 2) array and the valid masks, with the bits of the rejected
+# sensors cleared.
+def filter_records(records, window=MEDIAN_WINDOW, gate=GATE, alpha=ALPHA, reset_ticks=RESET_TICKS, ticks=None):
+    import numpy as np
+
+    channels = np.asarray(records["channel"])
+    timestamps = record_ticks(records) if ticks is None else np.asarray(ticks, dtype=np.int64)
+    angles = np.array(records["angles"], dtype=np.float64)
+    valid = np.array(records["valid"], dtype=np.int64)
+
+    groups = []
+    for channel in np.unique(channels).tolist():
+        for sensor in range(N_SENSORS):
+            rows = np.flatnonzero((channels == channel) & ((valid >> sensor) & 1 == 1))
+            if len(rows) == 0:
+                continue
+            values = angles[rows, sensor]
+            ts = timestamps[rows]
+
+            # Index of each sample in its run without reset
+            reset = np.ones(len(rows), dtype=bool)
+            reset[1:] = np.diff(ts) > reset_ticks
+            starts = np.maximum.accumulate(np.where(reset, np.arange(len(rows)), 0))
+            position = np.arange(len(rows)) - starts
+
+            # Median of the samples of the window in the same run, the
+            # missing ones are NaN and sorted last
+            padded = np.concatenate((np.full((window - 1, 2), np.nan), values))
+            windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=0).copy()
+            lag = np.arange(window - 1, -1, -1)
+            windows[(lag[np.newaxis, :] > position[:, np.newaxis])[:, np.newaxis, :].repeat(2, axis=1)] = np.nan
+            windows.sort(axis=2)
+            count = np.minimum(position + 1, window)[:, np.newaxis]
+            low = np.take_along_axis(windows, ((count - 1) // 2)[:, :, np.newaxis].repeat(2, axis=1), axis=2)[:, :, 0]
+            high = np.take_along_axis(windows, (count // 2)[:, :, np.newaxis].repeat(2, axis=1), axis=2)[:, :, 0]
+            medians = (low + high) / 2
+
+            rejected = np.any(np.abs(values - medians) > gate, axis=1)
+            valid[rows[rejected]] &= ~(1 << sensor)
+            groups.append((rows, sensor, medians, rejected, reset))
+
+    # The sensors are averaged together
+    if groups:
+        smooth = _smooth(np.concatenate([g[2] for g in groups]), np.concatenate([g[3] for g in groups]),
+                         np.concatenate([g[4] for g in groups]), alpha)
+        start = 0
+        for rows, sensor, _, _, _ in groups:
+            angles[rows, sensor] = smooth[start:start + len(rows)]
+            start += len(rows)
+
+    return angles, valid
+
+
+# Exponential moving average of the samples that are not rejected, restarted
+# at each reset. The runs are averaged SMOOTH_BLOCK samples at a time, all the
+# runs together: within a block the average is the closed form
+#   s[k] = d^(k + 1) * c + sum(a * d^(k - j) * x[j] for j <= k)
+# with a = alpha, d = 1 - alpha and c the average before the block, the first
+# sample of a run for its first block. It matches AngleFilter to rounding.
+def _smooth(medians, rejected, reset, alpha, block=SMOOTH_BLOCK):
+    import numpy as np
+
+    smooth = np.full(medians.shape, np.nan)
+    kept = np.flatnonzero(~rejected)
+    if len(kept) == 0:
+        return smooth
+
+    # Run of each kept sample and its position in the run, the runs are in
+    # order in kept
+    run = np.cumsum(reset)[kept] - 1
+    first = np.concatenate(([True], run[1:] != run[:-1]))
+    run_starts = np.flatnonzero(first)
+    run_ids = np.cumsum(first) - 1
+    position = np.arange(len(kept)) - run_starts[run_ids]
+    lengths = np.diff(np.append(run_starts, len(kept)))
+
+    k = np.arange(block)
+    weights = np.tril(alpha * (1 - alpha) ** np.maximum(k[:, np.newaxis] - k, 0))
+    carry_weights = ((1 - alpha) ** (k + 1))[:, np.newaxis]
+
+    values = medians[kept]
+    carry = values[run_starts].copy()
+    blocks = position // block
+    order = np.argsort(blocks, kind="stable")
+    bounds = np.searchsorted(blocks[order], np.arange(blocks.max() + 2))
+    for b in range(len(bounds) - 1):
+        samples = order[bounds[b]:bounds[b + 1]]
+        active, rows = np.unique(run_ids[samples], return_inverse=True)
+        columns = position[samples] - b * block
+        table = np.zeros((len(active), block, 2))
+        table[rows, columns] = values[samples]
+        averages = weights @ table + carry_weights * carry[active][:, np.newaxis, :]
+        smooth[kept[samples]] = averages[rows, columns]
+        last = np.minimum(lengths[active] - b * block, block) - 1
+        carry[active] = averages[np.arange(len(active)), last]
+
+    return smooth
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import numpy as np
+    import angle_file
+
+    if len(sys.argv) < 2:
+        print("Usage: {} <angles.lha>".format(sys.argv[0]))
+        exit(1)
+
+    records = angle_file.read_angles(sys.argv[1])
+
+    start = time.perf_counter()
+    filtered, filtered_valid = filter_records(records)
+    batch_time = time.perf_counter() - start
+
+    # Same filter one record at a time, as in the decoder
+    angle_filter = AngleFilter()
+    valid = records["valid"].tolist()
+    values = records["angles"].astype(np.float64).tolist()
+    start = time.perf_counter()
+    streamed = []
+    for ticks, channel, mask, sensors in zip(record_ticks(records).tolist(), records["channel"].tolist(), valid,
+                                             values):
+        for sensor in range(N_SENSORS):
+            if mask & (1 << sensor):
+                streamed.append(angle_filter.push(channel, sensor, ticks, sensors[sensor][0], sensors[sensor][1]))
+    stream_time = time.perf_counter() - start
+
+    batch = []
+    for mask, filtered_mask, sensors in zip(valid, filtered_valid.tolist(), filtered.tolist()):
+        for sensor in range(N_SENSORS):
+            if mask & (1 << sensor):
+                batch.append(tuple(sensors[sensor]) if filtered_mask & (1 << sensor) else None)
+    # The averages of filter_records() are rounded differently
+    def matches(a, b):
+        if a is None or b is None:
+            return a is b
+        return abs(a[0] - b[0]) <= 1e-9 and abs(a[1] - b[1]) <= 1e-9
+
+    mismatch = sum(1 for a, b in zip(streamed, batch) if not matches(a, b))
+
+    print(angle_filter.report())
+    print("Stream:   {:.2f} us per sample".format(stream_time / max(len(streamed), 1) * 1e6))
+    print("Batch:    {:.3f} us per sample".format(batch_time / max(len(streamed), 1) * 1e6))
+    print("Mismatch: {}".format(mismatch))
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Asyncio ingestion pipeline for live decoding
+#
+# The pipeline is made of independent tasks connected by bounded queues:
+#  - The reader pulls large chunks from the serial port (or a file/pty), finds
+#    the frames and decodes them into pulses
+#  - The processor runs the pulses through PulseProcessor and BaseStation
+#  - One task per sink consumes the resulting angles
+#
+# Blocking reads and sink writes run in the default executor so that a
+# stalled terminal or consumer never stops the reader. When reading from a
+# live source (serial port or pty) and the decoder can not keep up, frames are
+# dropped at the reader and counted, instead of letting the OS buffer
+# overflow. When reading from a file, the reader waits for the decoder instead.
+# The time the processor waits for a full sink queue is counted apart, so that
+# a slow sink is not reported as a slow decoder.
+
+import asyncio
+import sys
+import time
+
+import capture_file
+import framing
+from decodeV2 import PulseProcessor, BaseStation, parse_pulse
+
+FRAME_QUEUE_SIZE = 64
+SINK_QUEUE_SIZE = 64
+READ_CHUNK_SIZE = 16384
+STATS_INTERVAL = 5.0
+# Timeout of serial reads, so that the pipeline can be stopped
+SERIAL_TIMEOUT = 0.5
+
+
+class PipelineStats:
+    def __init__(self):
+        self.bytes_read = 0
+        self.pulses_queued = 0
+        self.pulses_dropped = 0
+        self.pulses_processed = 0
+        self.decode_time = 0.0
+        self.sink_waits = 0
+        self.sink_wait_time = 0.0
+        self.blocks = 0
+        self.angles = 0
+        self.max_frame_queue_depth = 0
+        self.max_sink_queue_depth = 0
+        self.start_time = time.monotonic()
+
+    def report(self, frame_sync):
+        elapsed = time.monotonic() - self.start_time
+        rate = self.pulses_processed / elapsed if elapsed > 0 else 0.0
+
+        # Frames lost on the link show up in the framing counters, pulses
+        # lost because the decoder or the sinks are too slow are dropped at
+        # the frame queue. A full sink queue stops the processor, so the
+        # drops are blamed on the sinks when the processor spent more time
+        # waiting for them than decoding.
+        if self.pulses_dropped:
+            bottleneck = "sink" if self.sink_wait_time > self.decode_time else "decoder"
+        elif frame_sync.bad_frames:
+            bottleneck = "link"
+        else:
+            bottleneck = "none"
+
+        return ("read:{}B  pulses:{}  processed:{} ({:.0f}/s)  queue drops:{}  "
+                "bad frames:{}  dropped bytes:{}  resync:{}  blocks:{}  angles:{}  "
+                "max queue:{}/{}  sink waits:{} ({:.1f}s)  bottleneck:{}").format(
+            self.bytes_read, self.pulses_queued, self.pulses_processed, rate,
+            self.pulses_dropped, frame_sync.bad_frames, frame_sync.dropped_bytes,
+            frame_sync.resync_count, self.blocks, self.angles,
+            self.max_frame_queue_depth, self.max_sink_queue_depth,
+            self.sink_waits, self.sink_wait_time, bottleneck)
+
+
+class PrintSink:
+    def write(self, angles):
+        angles.dump()
+        print()
+
+    def close(self):
+        sys.stdout.flush()
+
+
+# Discards all results, useful to measure the throughput of the decoder
+class NullSink:
+    def write(self, angles):
+        pass
+
+    def close(self):
+        pass
+
+
+class AngleFileSink:
+    def __init__(self, file_name):
+        import angle_file
+        self.writer = angle_file.AngleWriter(file_name)
+
+    def write(self, angles):
+        self.writer.write_angles(angles)
+
+    def close(self):
+        self.writer.close()
+
+
+class CallbackSink:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, angles):
+        self.callback(angles)
+
+    def close(self):
+        pass
+
+
+async def reader_task(src, frame_sync, queue, stats, live, chunk_size):
+    loop = asyncio.get_running_loop()
+
+    while True:
+        data = await loop.run_in_executor(None, framing.read_chunk, src, chunk_size)
+        if len(data) == 0:
+            if live:
+                # Read timeout
+                continue
+            break
+        stats.bytes_read += len(data)
+
+        pulses = []
+        for frame in frame_sync.feed(data):
+            pulse = parse_pulse(frame)
+            if pulse:
+                pulses.append(pulse)
+
+        if not pulses:
+            continue
+
+        if live:
+            try:
+                queue.put_nowait(pulses)
+            except asyncio.QueueFull:
+                stats.pulses_dropped += len(pulses)
+                continue
+        else:
+            await queue.put(pulses)
+
+        stats.pulses_queued += len(pulses)
+        stats.max_frame_queue_depth = max(stats.max_frame_queue_depth, queue.qsize())
+
+    await queue.put(None)
+
+
+async def processor_task(queue, sink_queues, stats):
+    pulse_processor = PulseProcessor()
+    base_stations = []
+    for i in range(16):
+        base_stations.append(BaseStation(i))
+
+    while True:
+        pulses = await queue.get()
+        if pulses is None:
+            break
+
+        start = time.monotonic()
+        results = []
+        for pulse in pulses:
+            block = pulse_processor.push(*pulse)
+            if block:
+                stats.blocks += 1
+                angles = base_stations[block.channel].push(block)
+                if angles:
+                    results.append(angles)
+
+        stats.pulses_processed += len(pulses)
+        stats.angles += len(results)
+        stats.decode_time += time.monotonic() - start
+
+        if results:
+            for sink_queue in sink_queues:
+                try:
+                    sink_queue.put_nowait(results)
+                except asyncio.QueueFull:
+                    stats.sink_waits += 1
+                    start = time.monotonic()
+                    await sink_queue.put(results)
+                    stats.sink_wait_time += time.monotonic() - start
+                stats.max_sink_queue_depth = max(stats.max_sink_queue_depth, sink_queue.qsize())
+
+    for sink_queue in sink_queues:
+        await sink_queue.put(None)
+
+
+def write_all(sink, results):
+    for angles in results:
+        sink.write(angles)
+
+
+async def sink_task(sink, queue):
+    loop = asyncio.get_running_loop()
+
+    while True:
+        results = await queue.get()
+        if results is None:
+            break
+        await loop.run_in_executor(None, write_all, sink, results)
+
+    await loop.run_in_executor(None, sink.close)
+
+
+async def stats_task(stats, frame_sync, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(stats.report(frame_sync), file=sys.stderr)
+
+
+async def run_pipeline(src, sinks, live=True, frame_queue_size=FRAME_QUEUE_SIZE,
+                       sink_queue_size=SINK_QUEUE_SIZE, chunk_size=READ_CHUNK_SIZE,
+                       stats_interval=STATS_INTERVAL, frame_sync=None, stats=None):
+    if frame_sync is None:
+        frame_sync = framing.FrameSync()
+    if stats is None:
+        stats = PipelineStats()
+
+    frame_queue = asyncio.Queue(frame_queue_size)
+    sink_queues = [asyncio.Queue(sink_queue_size) for _ in sinks]
+
+    tasks = [asyncio.create_task(reader_task(src, frame_sync, frame_queue, stats, live, chunk_size)),
+             asyncio.create_task(processor_task(frame_queue, sink_queues, stats))]
+    for sink, sink_queue in zip(sinks, sink_queues):
+        tasks.append(asyncio.create_task(sink_task(sink, sink_queue)))
+
+    reporter = None
+    if stats_interval:
+        reporter = asyncio.create_task(stats_task(stats, frame_sync, stats_interval))
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if reporter:
+            reporter.cancel()
+
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Decode lighthouse deck frames with an asyncio pipeline")
+    parser.add_argument("source", help="input.bin, /dev/tty... or a pty")
+    parser.add_argument("--null", action="store_true", help="discard the angles instead of printing them")
+    parser.add_argument("--output", help="write the angles to a binary angle file instead of printing them")
+    parser.add_argument("--queue", type=int, default=FRAME_QUEUE_SIZE, help="frame queue size, in chunks")
+    parser.add_argument("--stats", type=float, default=STATS_INTERVAL, help="stats interval in seconds, 0 to disable")
+    args = parser.parse_args()
+
+    if args.source.startswith("/dev/"):
+        import serial
+        src = serial.Serial(args.source, 2*115200, timeout=SERIAL_TIMEOUT)
+        live = True
+    else:
+        src = capture_file.open_capture(args.source)
+        live = False
+
+    if args.null:
+        sinks = [NullSink()]
+    elif args.output:
+        sinks = [AngleFileSink(args.output)]
+    else:
+        sinks = [PrintSink()]
+
+    stats = PipelineStats()
+    frame_sync = framing.FrameSync(on_sync=lambda: print("Found sync!", file=sys.stderr))
+    print("Waiting for sync ...", file=sys.stderr)
+    try:
+        asyncio.run(run_pipeline(src, sinks, live, frame_queue_size=args.queue,
+                                 stats_interval=args.stats, frame_sync=frame_sync, stats=stats))
+    except KeyboardInterrupt:
+        pass
+
+    print(stats.report(frame_sync), file=sys.stderr)
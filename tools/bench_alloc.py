@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Allocation benchmark of PulseProcessor and BaseStation in decodeV2.py
+#
+# Runs a frame stream through the decoder and counts the decoder objects
+# created per frame once in steady state, together with the memory retained
+# and the time per frame. SweepBlock and SweepData should not be created at
+# all in steady state, Angles are only created for each result.
+
+import os
+import sys
+import time
+import tracemalloc
+
+import decodeV2
+import framing
+import synthetic
+
+WARMUP_FRACTION = 0.1
+
+
+def load_pulses(file_name=None):
+    if file_name:
+        with open(file_name, "rb") as f:
+            data = f.read()
+    else:
+        data = synthetic.generate(seconds=20.0, channels=(0, 1, 2, 3))
+
+    pulses = []
+    for frame in framing.FrameSync().feed(data):
+        pulse = decodeV2.parse_pulse(frame)
+        if pulse:
+            pulses.append(pulse)
+    return pulses
+
+
+class InstanceCounter:
+    def __init__(self, classes):
+        self.classes = classes
+        self.counts = {cls.__name__: 0 for cls in classes}
+        self._original = {}
+
+    def _wrap(self, cls):
+        original = cls.__init__
+        counts = self.counts
+        name = cls.__name__
+
+        def counting_init(obj, *args, **kwargs):
+            counts[name] += 1
+            original(obj, *args, **kwargs)
+
+        self._original[cls] = original
+        cls.__init__ = counting_init
+
+    def start(self):
+        for cls in self.classes:
+            self._wrap(cls)
+
+    def stop(self):
+        for cls, original in self._original.items():
+            cls.__init__ = original
+
+
+def run(pulses, pulse_processor, base_stations):
+    results = 0
+    for pulse in pulses:
+        block = pulse_processor.push(*pulse)
+        if block:
+            angles = base_stations[block.channel].push(block)
+            if angles:
+                results += 1
+    return results
+
+
+if __name__ == "__main__":
+    pulses = load_pulses(sys.argv[1] if len(sys.argv) > 1 else None)
+    warmup = int(len(pulses) * WARMUP_FRACTION)
+
+    pulse_processor = decodeV2.PulseProcessor()
+    base_stations = [decodeV2.BaseStation(i) for i in range(16)]
+
+    # The decoder prints dropped blocks
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        run(pulses[:warmup], pulse_processor, base_stations)
+
+        counter = InstanceCounter([decodeV2.SweepBlock, decodeV2.SweepData, decodeV2.Angles])
+        counter.start()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        results = run(pulses[warmup:], pulse_processor, base_stations)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        counter.stop()
+
+        start = time.perf_counter()
+        run(pulses[warmup:], pulse_processor, base_stations)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    frames = len(pulses) - warmup
+    retained = sum(stat.size_diff for stat in after.compare_to(before, "filename")
+                   if stat.traceback[0].filename == decodeV2.__file__)
+
+    print("Frames:            {}".format(frames))
+    print("Results:           {}".format(results))
+    for name, count in counter.counts.items():
+        print("{:18} {} ({:.4f} per frame)".format(name + ":", count, count / frames))
+    print("Retained by decodeV2.py: {} bytes".format(retained))
+    print("Time per frame:    {:.2f} us".format(elapsed / frames * 1e6))
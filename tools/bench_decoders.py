@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+# Benchmark of the decoding stages
+#
+# Feeds a synthetic frame stream and recorded captures through each stage of
+# the decoders and reports the time per frame, the frames per second and the
+# decoder objects created per frame, the setup of the stage included. Each
+# stage gets the output of the previous one, computed beforehand, and the
+# best of --repeat runs is kept:
+#
+#   framing          FrameSync over the raw bytes
+#   reader           FrameReader over the raw bytes, read from memory
+#   bulk_decode      numpy decoding of all the frames at once
+#   parse            parse_pulse() of each frame
+#   pulse_processor  PulseProcessor.push() of each pulse
+#   base_station     BaseStation.push() of each sweep block
+#   angle_filter     AngleFilter.filter() of each Angles
+#   decodeV2         frame to angles with decodeV2.py
+#   decodeV2_cf      frame to angles with decodeV2_cf.py
+#
+# --profile=FILE runs the stages once more under cProfile and writes the
+# statistics to FILE, --tracemalloc reports the memory allocated by each
+# stage. --output=FILE writes the times as JSON and --baseline=FILE compares
+# them to a previous output, the exit code is 1 if a stage is slower by more
+# than --tolerance.
+
+import io
+import json
+import sys
+import time
+
+import angle_filter
+import decoders
+import decodeV2
+import decodeV2_cf
+import synthetic
+import timeline
+from bench_alloc import InstanceCounter
+
+SYNTHETIC_SECONDS = 10.0
+SYNTHETIC_CHANNELS = (0, 1, 2, 3)
+REPEAT = 3
+TOLERANCE = 0.2
+
+# Objects that the decoders should not create for each frame
+DECODER_CLASSES = [decodeV2.SweepBlock, decodeV2.SweepData, decodeV2.Angles, decodeV2.SweepAngles,
+                   decodeV2_cf.pulseProcessorFrame_t, decodeV2_cf.pulseProcessorV2SweepBlock_t]
+
+
+class Stream:
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+        # Input of each stage
+        self.frames = list(decoders.FrameSync().feed(data))
+        self.pulses = [pulse for pulse in map(decoders.parse_pulse, self.frames) if pulse]
+        self.blocks = []
+        self.angles = []
+        # Unwrapped time of each angles, for the filter
+        self.angle_ticks = []
+        pulse_processor = decoders.PulseProcessor()
+        base_stations = [decoders.BaseStation(i) for i in range(decoders.N_CHANNELS)]
+        unwrapper = timeline.Unwrapper()
+        for frame in self.frames:
+            unwrapper.push_frame(frame)
+            pulse = decoders.parse_pulse(frame)
+            if not pulse:
+                continue
+            block = pulse_processor.push(*pulse)
+            if block:
+                # The blocks of the PulseProcessor are reused
+                stored = decodeV2.SweepBlock()
+                stored.copy_from(block)
+                self.blocks.append(stored)
+                angles = base_stations[block.channel].push(block)
+                if angles:
+                    self.angles.append(angles)
+                    self.angle_ticks.append(unwrapper.time_of(angles.ts))
+
+
+def run_framing(stream):
+    for _ in decoders.FrameSync().feed(stream.data):
+        pass
+
+
+def run_reader(stream):
+    for _ in decoders.FrameReader(io.BytesIO(stream.data)):
+        pass
+
+
+def run_bulk_decode(stream):
+    start = decoders.bulk_decode.find_sync(stream.data)
+    decoders.bulk_decode.FrameArrays(decoders.bulk_decode.align_frames(stream.data, max(start, 0)))
+
+
+def run_parse(stream):
+    parse_pulse = decoders.parse_pulse
+    for frame in stream.frames:
+        parse_pulse(frame)
+
+
+def run_pulse_processor(stream):
+    push = decoders.PulseProcessor().push
+    for pulse in stream.pulses:
+        push(*pulse)
+
+
+def run_base_station(stream):
+    base_stations = [decoders.BaseStation(i) for i in range(decoders.N_CHANNELS)]
+    for block in stream.blocks:
+        base_stations[block.channel].push(block)
+
+
+def run_angle_filter(stream):
+    filter_angles = angle_filter.AngleFilter().filter
+    for angles, ticks in zip(stream.angles, stream.angle_ticks):
+        # The filter changes the data in place
+        saved = angles.data
+        angles.data = list(saved)
+        filter_angles(angles, ticks)
+        angles.data = saved
+
+
+def run_decode_v2(stream):
+    push = decoders.V2Decoder().push
+    for frame in stream.frames:
+        push(frame)
+
+
+def run_decode_v2_cf(stream):
+    push = decoders.CfDecoder().push
+    for frame in stream.frames:
+        push(frame)
+
+
+STAGES = [("framing", run_framing), ("reader", run_reader), ("bulk_decode", run_bulk_decode), ("parse", run_parse),
+          ("pulse_processor", run_pulse_processor), ("base_station", run_base_station),
+          ("angle_filter", run_angle_filter), ("decodeV2", run_decode_v2), ("decodeV2_cf", run_decode_v2_cf)]
+
+
+def time_stage(run, stream, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(stream)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def count_objects(run, stream):
+    counter = InstanceCounter(DECODER_CLASSES)
+    counter.start()
+    try:
+        run(stream)
+    finally:
+        counter.stop()
+    return sum(counter.counts.values())
+
+
+def trace_stage(run, stream):
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        run(stream)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    own = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    top = after.filter_traces(own).compare_to(before.filter_traces(own), "lineno")[:3]
+    return peak, top
+
+
+def bench(streams, repeat, trace=False, out=sys.stdout):
+    results = {}
+    for stream in streams:
+        frames = len(stream.frames)
+        print("{}: {} frames, {} pulses, {} blocks, {} angles".format(
+            stream.name, frames, len(stream.pulses), len(stream.blocks), len(stream.angles)), file=out)
+        print("  {:16} {:>9} {:>11} {:>13}".format("Stage", "us/frame", "frames/s", "objects/frame"), file=out)
+        results[stream.name] = {}
+        for name, run in STAGES:
+            elapsed = time_stage(run, stream, repeat)
+            objects = count_objects(run, stream)
+            us = elapsed / frames * 1e6 if frames else 0.0
+            results[stream.name][name] = us
+            print("  {:16} {:9.3f} {:11.0f} {:13.4f}".format(
+                name, us, frames / elapsed if elapsed else 0.0, objects / frames if frames else 0.0), file=out)
+            if trace:
+                peak, top = trace_stage(run, stream)
+                print("  {:16} peak {:.1f} KiB".format("", peak / 1024), file=out)
+                for stat in top:
+                    print("  {:16}   {}".format("", stat), file=out)
+        print(file=out)
+    return results
+
+
+def profile(streams, file_name, out=sys.stdout):
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for stream in streams:
+        for _, run in STAGES:
+            run(stream)
+    profiler.disable()
+    profiler.dump_stats(file_name)
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(20)
+
+
+# Returns the stages slower than the baseline by more than tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    for stream, stages in results.items():
+        for stage, us in stages.items():
+            reference = baseline.get(stream, {}).get(stage)
+            if reference and us > reference * (1 + tolerance):
+                regressions.append((stream, stage, reference, us))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the decoding stages")
+    parser.add_argument("captures", nargs="*", help="recorded captures (.bin) to benchmark with")
+    parser.add_argument("--seconds", type=float, default=SYNTHETIC_SECONDS, help="length of the synthetic stream")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="runs of each stage, the best is kept")
+    parser.add_argument("--profile", metavar="FILE", help="write cProfile statistics of the stages to FILE")
+    parser.add_argument("--tracemalloc", action="store_true", help="report the memory allocated by each stage")
+    parser.add_argument("--output", metavar="FILE", help="write the times per frame as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="compare to the times of a previous --output")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    streams = []
+    with decoders.quiet():
+        if args.seconds > 0:
+            streams.append(Stream("synthetic", synthetic.generate(seconds=args.seconds, channels=SYNTHETIC_CHANNELS)))
+        for file_name in args.captures:
+            with open(file_name, "rb") as f:
+                streams.append(Stream(file_name, f.read()))
+
+    # The decoders print the dropped blocks
+    out = sys.stdout
+    with decoders.quiet():
+        results = bench(streams, args.repeat, args.tracemalloc, out)
+        if args.profile:
+            profile(streams, args.profile, out)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for stream, stage, reference, us in regressions:
+            print("Regression: {} {}: {:.3f} us/frame, was {:.3f}".format(stream, stage, us, reference))
+        if regressions:
+            sys.exit(1)
+        print("No regression")
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Bulk decoding of recorded UART captures.
+#
+# The capture is memory mapped and every 12 bytes frame is decoded at once
+# into columnar numpy arrays, one array per frame field. Sync frames and
+# padding bits are handled as masks so that whole captures can be filtered
+# and analysed without creating one python object per frame.
+#
+# When the padding bits show that the frame boundary has been lost, the
+# capture is re-aligned the same way as in framing.py and decoding continues
+# with the next aligned segment.
+
+import mmap
+import numpy as np
+
+import capture_file
+from framing import UART_FRAME_LENGTH, RESYNC_WINDOW, find_sync, find_alignment
+
+# Number of frames checked at once when aligning a capture
+ALIGN_BLOCK_FRAMES = 1 << 20
+
+
+# Returns the 24 bits little endian field starting at byte first of each
+# frame. Only the columns of the field are widened, not the whole capture.
+def frame_field(frames, first):
+    return (frames[:, first].astype(np.uint32) | (frames[:, first + 1].astype(np.uint32) << 8) |
+            (frames[:, first + 2].astype(np.uint32) << 16))
+
+
+class FrameArrays:
+    def __init__(self, frames):
+        # frames is a (n, 12) uint8 array of aligned raw frames, possibly a
+        # view of a memory mapped capture
+        first_word = frame_field(frames, 0)
+        offset_6 = frame_field(frames, 3)
+        beam_word = frame_field(frames, 6)
+        self.timestamp = frame_field(frames, 9)
+
+        self.sensor = (first_word & 0x03).astype(np.uint8)
+        self.width = ((first_word >> 8) & 0xffff).astype(np.uint16)
+
+        self.poly_ok = ((first_word >> 7) & 0x01) == 0
+        identity = (first_word >> 2) & 0x1f
+        self.channel = (identity >> 1).astype(np.uint8)
+        self.slow_bit = (identity & 1).astype(np.uint8)
+
+        self.is_sync = ((first_word == 0xffffff) & (offset_6 == 0xffffff) & (beam_word == 0xffffff) &
+                        (self.timestamp == 0xffffff))
+        # A frame with an all-ones offset carries no pulse, as in parse_pulse()
+        self.no_pulse = offset_6 == 0xffffff
+        is_padding_zero = ((frames[:, 5] | frames[:, 8]) & 0xfe) == 0
+        self.is_valid = is_padding_zero | self.is_sync
+
+        # Offset is expressed in a 6 MHz clock, while the timestamp uses a 24 MHz clock.
+        # update offset to a 24 MHz clock
+        self.offset = offset_6 * 4
+        self.beam_word = beam_word & 0x1ffff
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    # Mask of the frames carrying a pulse
+    def pulse_mask(self):
+        return self.is_valid & ~self.no_pulse
+
+    # Iterates over the pulses as (sensor, ts, width, offset, channel, slow_bit,
+    # beam_word), the arguments of PulseProcessor.push() in decodeV2.py. With
+    # with_syncs, None is given in place of each sync frame.
+    def iter_pulses(self, with_syncs=False):
+        if with_syncs:
+            yield from self._iter_pulses_and_syncs()
+            return
+
+        mask = self.pulse_mask()
+        poly_ok = self.poly_ok[mask].tolist()
+        columns = zip(self.sensor[mask].tolist(), self.timestamp[mask].tolist(),
+                      self.width[mask].tolist(), self.offset[mask].tolist(),
+                      self.channel[mask].tolist(), self.slow_bit[mask].tolist(), poly_ok,
+                      self.beam_word[mask].tolist())
+
+        for sensor, ts, width, offset, channel, slow_bit, ok, beam_word in columns:
+            if ok:
+                yield sensor, ts, width, offset, channel, slow_bit, beam_word
+            else:
+                yield sensor, ts, width, offset, None, None, beam_word
+
+    def _iter_pulses_and_syncs(self):
+        pulse = self.pulse_mask()
+        mask = pulse | self.is_sync
+        pulses = iter(self.iter_pulses())
+        for is_pulse in pulse[mask].tolist():
+            yield next(pulses) if is_pulse else None
+
+
+def decode_frames(data, start=0):
+    count = (len(data) - start) // UART_FRAME_LENGTH
+    frames = np.frombuffer(data, dtype=np.uint8, count=count * UART_FRAME_LENGTH, offset=start)
+    return FrameArrays(frames.reshape(-1, UART_FRAME_LENGTH))
+
+
+class AlignStats:
+    def __init__(self):
+        self.bad_frames = 0
+        self.dropped_bytes = 0
+        self.resync_count = 0
+
+
+# Returns a (n, 12) array of the aligned frames in data, starting at start.
+# Frames with broken padding bits are removed and the frame boundary is
+# recovered after each of them.
+def align_frames(data, start, stats=None):
+    if stats is None:
+        stats = AlignStats()
+
+    segments = []
+    pos = start
+    while len(data) - pos >= UART_FRAME_LENGTH:
+        count = min((len(data) - pos) // UART_FRAME_LENGTH, ALIGN_BLOCK_FRAMES)
+        frames = np.frombuffer(data, dtype=np.uint8, count=count * UART_FRAME_LENGTH, offset=pos)
+        frames = frames.reshape(-1, UART_FRAME_LENGTH)
+
+        is_valid = (((frames[:, 5] | frames[:, 8]) & 0xfe) == 0) | np.all(frames == 0xff, axis=1)
+        invalid = np.flatnonzero(~is_valid)
+        if len(invalid) == 0:
+            segments.append(frames)
+            pos += count * UART_FRAME_LENGTH
+            continue
+
+        first_bad = int(invalid[0])
+        segments.append(frames[:first_bad])
+        pos += first_bad * UART_FRAME_LENGTH
+
+        stats.bad_frames += 1
+        if len(data) - pos < RESYNC_WINDOW:
+            stats.dropped_bytes += len(data) - pos
+            break
+
+        shift = find_alignment(data, pos)
+        if shift is None:
+            # Wait for the next sync frame
+            start = find_sync(data, pos)
+            if start < 0:
+                stats.dropped_bytes += len(data) - pos
+                break
+            shift = start - pos
+        elif shift != UART_FRAME_LENGTH:
+            stats.resync_count += 1
+
+        stats.dropped_bytes += shift
+        pos += shift
+
+    if len(segments) == 0:
+        return np.zeros((0, UART_FRAME_LENGTH), dtype=np.uint8)
+    if len(segments) == 1:
+        return segments[0]
+    return np.concatenate(segments)
+
+
+# Memory maps a capture and decodes all frames following the first sync frame.
+# Compressed captures from capture_file.py are decompressed instead.
+def load_capture(file_name, stats=None):
+    if capture_file.is_capture_file(file_name):
+        with capture_file.CaptureReader(file_name) as reader:
+            # The frames are aligned and start with a sync frame
+            return FrameArrays(reader.read_frames(1))
+
+    with open(file_name, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return decode_frames(b'')
+
+    try:
+        start = find_sync(mm)
+        if start < 0:
+            return decode_frames(b'')
+        frames = align_frames(mm, start, stats)
+        result = FrameArrays(frames)
+        del frames
+        return result
+    finally:
+        mm.close()
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: {} <input.bin>".format(sys.argv[0]))
+        exit(1)
+
+    stats = AlignStats()
+    frames = load_capture(sys.argv[1], stats)
+    pulses = frames.pulse_mask()
+
+    print("Frames:         {}".format(len(frames)))
+    print("Sync frames:    {}".format(np.count_nonzero(frames.is_sync)))
+    print("Invalid frames: {}".format(stats.bad_frames))
+    print("Dropped bytes:  {}".format(stats.dropped_bytes))
+    print("Resync:         {}".format(stats.resync_count))
+    print("Pulses:         {}".format(np.count_nonzero(pulses)))
+    for channel in range(16):
+        count = np.count_nonzero(pulses & frames.poly_ok & (frames.channel == channel))
+        if count:
+            print("  Chan:{:2d}  {}".format(channel + 1, count))
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+# Compressed capture files
+#
+# The frames of a capture are stored column-wise in chunks of up to
+# CHUNK_FRAMES frames, compressed with zlib or lzma. The frames are the
+# aligned frames of a raw capture, starting with a sync frame, so reading a
+# compressed capture gives the same frames as decoding the raw one. All
+# numbers are little-endian.
+#
+# Header, 32 bytes:
+#
+#   Offset  Type     Field
+#   0       char[4]  Magic, "LHCP"
+#   4       uint16   Format version, 1
+#   6       uint16   Header size in bytes
+#   8       uint16   Frame size in bytes, 12
+#   10      uint8    Compression, 1 for zlib, 2 for lzma
+#   11      uint8    Reserved, 0
+#   12      uint32   Max number of frames per chunk
+#   16      uint64   Number of frames
+#   24      uint64   File offset of the chunk directory, 0 if not closed
+#
+# Chunk, after an 8 bytes header of uint32 number of frames and uint32
+# compressed size. Uncompressed, it has 12 columns of one byte per frame:
+#
+#   Column  Content
+#   0-8     Bytes 0 to 8 of the frames
+#   9-11    Timestamp minus the one of the previous frame of the chunk,
+#           modulo 2^24, low byte first
+#
+# Most bytes of a column are zeros or repeat, and the timestamp differences
+# of a sweep are small. The chunk directory is an array of (uint64 first
+# frame, uint64 file offset of the chunk, uint32 frames, uint32 compressed
+# size), one per chunk, to seek to a frame. When the writer was not closed,
+# the chunks are found by reading them in order.
+
+import lzma
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from framing import SYNC_FRAME, UART_FRAME_LENGTH, is_sync_frame
+
+MAGIC = b'LHCP'
+VERSION = 1
+HEADER = struct.Struct("<4sHHHBBIQQ")
+CHUNK_HEADER = struct.Struct("<II")
+DIRECTORY_DTYPE = np.dtype([("frame", "<u8"), ("offset", "<u8"), ("frames", "<u4"), ("size", "<u4")])
+CAPTURE_EXTENSION = ".lhc"
+
+ZLIB = 1
+LZMA = 2
+COMPRESSIONS = {"zlib": ZLIB, "lzma": LZMA}
+
+# About 8.5 s of frames at the full UART rate
+CHUNK_FRAMES = 16384
+# Max seconds between two chunks of a recording, so that an interrupted
+# recording loses at most that much
+RECORD_FLUSH_SECONDS = 1.0
+
+
+def compress(data, compression):
+    if compression == LZMA:
+        return lzma.compress(data)
+    return zlib.compress(data)
+
+
+def decompress(data, compression):
+    if compression == LZMA:
+        return lzma.decompress(data)
+    if compression == ZLIB:
+        return zlib.decompress(data)
+    raise ValueError("unsupported compression {}".format(compression))
+
+
+# Returns the compressed columns of a (n, 12) array of frames
+def encode_chunk(frames, compression=ZLIB):
+    ts = frames[:, 9].astype(np.int64) | (frames[:, 10].astype(np.int64) << 8) | \
+        (frames[:, 11].astype(np.int64) << 16)
+    deltas = np.diff(ts, prepend=0) & 0xffffff
+
+    columns = np.empty((UART_FRAME_LENGTH, len(frames)), dtype=np.uint8)
+    columns[:9] = frames[:, :9].T
+    columns[9] = deltas & 0xff
+    columns[10] = (deltas >> 8) & 0xff
+    columns[11] = deltas >> 16
+    return compress(columns.tobytes(), compression)
+
+
+# Returns the (n, 12) array of frames of a compressed chunk
+def decode_chunk(data, count, compression=ZLIB):
+    columns = np.frombuffer(decompress(data, compression), dtype=np.uint8).reshape(UART_FRAME_LENGTH, count)
+    deltas = columns[9].astype(np.int64) | (columns[10].astype(np.int64) << 8) | \
+        (columns[11].astype(np.int64) << 16)
+    ts = np.cumsum(deltas) & 0xffffff
+
+    frames = np.empty((count, UART_FRAME_LENGTH), dtype=np.uint8)
+    frames[:, :9] = columns[:9].T
+    frames[:, 9] = ts & 0xff
+    frames[:, 10] = (ts >> 8) & 0xff
+    frames[:, 11] = ts >> 16
+    return frames
+
+
+# Returns True if a file is a compressed capture
+def is_capture_file(file_name):
+    try:
+        with open(file_name, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+# With flush_seconds, the frames are also written as a chunk when the first
+# frame of the chunk was written that many seconds ago, for recording.
+class CaptureWriter:
+    def __init__(self, file_name, compression=ZLIB, chunk_frames=CHUNK_FRAMES, flush_seconds=None):
+        self.file = open(file_name, "wb")
+        self.compression = compression
+        self.chunk_frames = chunk_frames
+        self.flush_seconds = flush_seconds
+        self.buffer = bytearray(UART_FRAME_LENGTH * chunk_frames)
+        self.used = 0
+        self.count = 0
+        self.directory = []
+        # time.monotonic() the chunk must be written at, with flush_seconds
+        self._deadline = None
+        # The header is written again when closing, with the directory
+        self._write_header(0)
+
+    def _write_header(self, directory_offset):
+        self.file.write(HEADER.pack(MAGIC, VERSION, HEADER.size, UART_FRAME_LENGTH, self.compression, 0,
+                                    self.chunk_frames, self.count, directory_offset))
+
+    # Writes one frame, as read by framing.FrameSync. A sync frame is written
+    # first if the capture does not start with one.
+    def write(self, frame):
+        if self.count == 0 and not is_sync_frame(frame, 0):
+            self.write(SYNC_FRAME)
+
+        start = self.used * UART_FRAME_LENGTH
+        self.buffer[start:start + UART_FRAME_LENGTH] = frame
+        self.used += 1
+        self.count += 1
+        if self.used == self.chunk_frames:
+            self.flush()
+        elif self.flush_seconds is not None:
+            self.poll()
+
+    # Writes a (n, 12) array of aligned frames
+    def write_frames(self, frames):
+        if len(frames) == 0:
+            return
+        if self.count == 0 and not is_sync_frame(frames[0].tobytes(), 0):
+            self.write(SYNC_FRAME)
+
+        data = np.ascontiguousarray(frames, dtype=np.uint8).reshape(-1)
+        pos = 0
+        while pos < len(data):
+            start = self.used * UART_FRAME_LENGTH
+            size = min(len(data) - pos, len(self.buffer) - start)
+            self.buffer[start:start + size] = data[pos:pos + size].tobytes()
+            pos += size
+            self.used += size // UART_FRAME_LENGTH
+            self.count += size // UART_FRAME_LENGTH
+            if self.used == self.chunk_frames:
+                self.flush()
+
+    # Generator that writes the frames of an iterable of frames and passes
+    # them on, to record the frames as received ahead of other stages
+    def record(self, frames):
+        for frame in frames:
+            self.write(frame)
+            yield frame
+
+    # Writes the frames received so far as a chunk if flush_seconds have
+    # passed since the first one, also to be called when no frames arrive
+    def poll(self):
+        if self.used == 0 or self.flush_seconds is None:
+            return
+        now = time.monotonic()
+        if self._deadline is None:
+            self._deadline = now + self.flush_seconds
+        elif now >= self._deadline:
+            self.flush()
+
+    # Writes the frames received so far as a chunk
+    def flush(self):
+        self._deadline = None
+        if self.used == 0:
+            return
+        frames = np.frombuffer(self.buffer, dtype=np.uint8, count=self.used * UART_FRAME_LENGTH)
+        data = encode_chunk(frames.reshape(-1, UART_FRAME_LENGTH), self.compression)
+        self.directory.append((self.count - self.used, self.file.tell(), self.used, len(data)))
+        self.file.write(CHUNK_HEADER.pack(self.used, len(data)))
+        self.file.write(data)
+        self.used = 0
+        if self.flush_seconds is not None:
+            # Readable by other processes while recording
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        directory_offset = self.file.tell()
+        self.file.write(np.array(self.directory, dtype=DIRECTORY_DTYPE).tobytes())
+        self.file.seek(0)
+        self._write_header(directory_offset)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CaptureReader:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, "rb")
+        data = self.file.read(HEADER.size)
+        if len(data) < HEADER.size:
+            raise ValueError("{}: file too short".format(file_name))
+        magic, version, header_size, frame_size, compression, _, chunk_frames, count, directory_offset = \
+            HEADER.unpack(data)
+        if magic != MAGIC:
+            raise ValueError("{}: not a compressed capture".format(file_name))
+        if version != VERSION or frame_size != UART_FRAME_LENGTH:
+            raise ValueError("{}: unsupported compressed capture version {}".format(file_name, version))
+
+        self.compression = compression
+        self.chunk_frames = chunk_frames
+        self.closed = directory_offset != 0
+        if self.closed:
+            self.file.seek(directory_offset)
+            self.directory = np.frombuffer(self.file.read(), dtype=DIRECTORY_DTYPE)
+        else:
+            self.directory = self._scan(header_size)
+        self.count = int(self.directory["frames"].sum())
+
+        # Next chunk and position in the current one of read()
+        self.chunk = 0
+        self.current = b''
+        self.pos = 0
+
+    # Finds the chunks of a file that was not closed, up to the first one cut
+    # short
+    def _scan(self, offset):
+        directory = []
+        size = os.fstat(self.file.fileno()).st_size
+        frame = 0
+        while offset + CHUNK_HEADER.size <= size:
+            self.file.seek(offset)
+            count, length = CHUNK_HEADER.unpack(self.file.read(CHUNK_HEADER.size))
+            if offset + CHUNK_HEADER.size + length > size:
+                break
+            directory.append((frame, offset, count, length))
+            frame += count
+            offset += CHUNK_HEADER.size + length
+        return np.array(directory, dtype=DIRECTORY_DTYPE)
+
+    def __len__(self):
+        return self.count
+
+    # Returns the frames of a chunk as a (n, 12) array
+    def read_chunk(self, chunk):
+        _, offset, count, size = (int(x) for x in self.directory[chunk])
+        self.file.seek(offset + CHUNK_HEADER.size)
+        return decode_chunk(self.file.read(size), count, self.compression)
+
+    # Returns count frames from frame start as a (n, 12) array, up to the
+    # end of the capture
+    def read_frames(self, start=0, count=None):
+        end = self.count if count is None else min(self.count, start + count)
+        first = max(0, int(np.searchsorted(self.directory["frame"], start, side="right")) - 1)
+        last = int(np.searchsorted(self.directory["frame"], end, side="left"))
+        if start >= end or first >= last:
+            return np.zeros((0, UART_FRAME_LENGTH), dtype=np.uint8)
+
+        frames = np.concatenate([self.read_chunk(chunk) for chunk in range(first, last)])
+        skip = start - int(self.directory["frame"][first])
+        return frames[skip:skip + end - start]
+
+    # Reads the frames as the bytes of a raw capture, as a file opened in
+    # binary mode, for framing.read_frames(). Reads stop at the end of a
+    # chunk.
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self.read_chunk(chunk).tobytes() for chunk in range(self.chunk, len(self.directory))]
+            data = self.current[self.pos:] + b''.join(chunks)
+            self.chunk = len(self.directory)
+            self.current = b''
+            self.pos = 0
+            return data
+
+        if self.pos == len(self.current):
+            if self.chunk == len(self.directory):
+                return b''
+            self.current = self.read_chunk(self.chunk).tobytes()
+            self.chunk += 1
+            self.pos = 0
+        data = self.current[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Returns the aligned frames of a capture, compressed or raw, as a (n, 12)
+# array starting with a sync frame
+def load_frames(file_name):
+    if is_capture_file(file_name):
+        with CaptureReader(file_name) as reader:
+            return reader.read_frames()
+
+    import mmap
+    import bulk_decode
+    with open(file_name, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return np.zeros((0, UART_FRAME_LENGTH), dtype=np.uint8)
+    try:
+        start = bulk_decode.find_sync(mm)
+        if start < 0:
+            return np.zeros((0, UART_FRAME_LENGTH), dtype=np.uint8)
+        return np.array(bulk_decode.align_frames(mm, start - UART_FRAME_LENGTH))
+    finally:
+        mm.close()
+
+
+# Raises ValueError for a compressed capture, for the tools that use the byte
+# offsets of a raw capture
+def require_raw_capture(file_name):
+    if is_capture_file(file_name):
+        raise ValueError("{}: compressed capture, extract it first with capture_file.py {} capture.bin".format(
+            file_name, file_name))
+
+
+# Opens a capture, compressed or raw, to read it as a raw capture with
+# framing.read_frames()
+def open_capture(file_name):
+    if is_capture_file(file_name):
+        return CaptureReader(file_name)
+    return open(file_name, "rb")
+
+
+# Converts a raw capture to a compressed one
+def convert(input_file, output_file, compression=ZLIB, chunk_frames=CHUNK_FRAMES):
+    frames = load_frames(input_file)
+    tmp_file = "{}.{}.tmp".format(output_file, os.getpid())
+    writer = CaptureWriter(tmp_file, compression, chunk_frames)
+    try:
+        for start in range(0, len(frames), chunk_frames):
+            writer.write_frames(frames[start:start + chunk_frames])
+        writer.close()
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        writer.file.close()
+        os.remove(tmp_file)
+        raise
+    return len(frames)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Convert a raw capture to a compressed capture and back")
+    parser.add_argument("input", help="capture.bin or capture.lhc")
+    parser.add_argument("output", nargs="?",
+                        help="capture.lhc to compress a raw capture, capture.bin to extract a compressed one")
+    parser.add_argument("--compression", choices=sorted(COMPRESSIONS), default="zlib")
+    args = parser.parse_args()
+
+    compressed = is_capture_file(args.input)
+    if args.output and not compressed:
+        t = time.perf_counter()
+        count = convert(args.input, args.output, COMPRESSIONS[args.compression])
+        print("Converted: {} frames ({:.2f} s)".format(count, time.perf_counter() - t))
+        print("Size:      {} to {} bytes ({:.1f}x)".format(os.path.getsize(args.input), os.path.getsize(args.output),
+                                                         os.path.getsize(args.input) / os.path.getsize(args.output)))
+        exit(0)
+
+    if not compressed:
+        print("{}: not a compressed capture".format(args.input))
+        exit(1)
+
+    t = time.perf_counter()
+    with CaptureReader(args.input) as reader:
+        frames = reader.read_frames()
+        elapsed = time.perf_counter() - t
+        print("Frames:    {} in {} chunks{}".format(len(reader), len(reader.directory),
+                                                     "" if reader.closed else ", not closed"))
+        print("Size:      {} bytes, {:.1f}x".format(os.path.getsize(args.input),
+                                                   frames.size / os.path.getsize(args.input)))
+        print("Read:      {:.3f} s ({:.0f} frames/s)".format(elapsed, len(frames) / elapsed if elapsed else 0.0))
+
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(frames.tobytes())
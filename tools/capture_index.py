@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+# Sidecar index of recorded UART captures
+#
+# Reading a time window or a channel of a capture otherwise means decoding it
+# from the start. The index is built in one pass over the capture and written
+# next to it as <capture>.bin.lhx, it is rebuilt when the capture is newer or
+# has another size. All numbers are little-endian.
+#
+# Header, 48 bytes:
+#
+#   Offset  Type     Field
+#   0       char[4]  Magic, "LHIX"
+#   4       uint16   Format version, 1
+#   6       uint16   Header size in bytes
+#   8       uint16   Entry size in bytes
+#   10      uint8    Number of channels, 16
+#   11      uint8    Number of sensors, 4
+#   12      uint32   Timestamp clock frequency in Hz, 24000000
+#   16      uint64   Number of entries
+#   24      uint64   Size of the capture in bytes
+#   32      int64    Time of the first pulse of the capture in ticks
+#   40      int64    Time of the last pulse of the capture in ticks
+#
+# Entry, 72 bytes, one per chunk of the capture from a sync frame to the
+# next one, 0.5 s:
+#
+#   Offset  Type        Field
+#   0       uint64      Byte offset of the sync frame in the capture
+#   8       uint32      Size of the chunk in bytes
+#   12      uint32      Number of pulses
+#   16      int64       Time of the first pulse in ticks
+#   24      int64       Time of the last pulse in ticks
+#   32      uint16[16]  Pulses per channel, zero indexed
+#   64      uint16[4]   Pulses per sensor
+#
+# The times are on the unwrapped timeline of timeline.py, chunks without
+# pulses have the time of the latest pulse. The counts saturate at 65535, a
+# chunk that long means that the sync frames were lost.
+#
+# The index holds byte offsets of a raw capture, a compressed capture has to
+# be extracted first.
+#
+# A query selects the chunks overlapping a time window that have pulses of
+# the channel or sensor asked for, and only decodes them. The time of the
+# frames of a chunk is unwrapped from its first pulse.
+
+import mmap
+import os
+import struct
+
+import numpy as np
+
+import bulk_decode
+import timeline
+from capture_file import require_raw_capture
+from framing import UART_FRAME_LENGTH, find_sync
+
+MAGIC = b'LHIX'
+VERSION = 1
+HEADER = struct.Struct("<4sHHHBBIQQqq")
+N_CHANNELS = 16
+N_SENSORS = 4
+ENTRY_DTYPE = np.dtype([("offset", "<u8"), ("size", "<u4"), ("pulses", "<u4"), ("start", "<i8"), ("end", "<i8"),
+                        ("channels", "<u2", (N_CHANNELS,)), ("sensors", "<u2", (N_SENSORS,))])
+INDEX_EXTENSION = ".lhx"
+
+# Chunks decoded at once while building the index, about 8 minutes
+BUILD_CHUNKS = 1024
+MAX_COUNT = 0xffff
+
+
+# Returns the start and end offsets of the chunks of a capture, from each
+# sync frame to the next one, as int64 arrays. Both are empty without sync
+# frame.
+def find_chunks(data):
+    starts = []
+    pos = find_sync(data)
+    while pos >= 0:
+        starts.append(pos - UART_FRAME_LENGTH)
+        pos = find_sync(data, pos)
+    starts = np.array(starts, dtype=np.int64)
+    if len(starts) == 0:
+        return starts, starts.copy()
+    return starts, np.append(starts[1:], len(data))
+
+
+# Returns the index entries of the chunks of a capture and the time of its
+# first and last pulse
+def index_capture(data, batch_chunks=BUILD_CHUNKS):
+    starts, ends = find_chunks(data)
+    entries = np.zeros(len(starts), dtype=ENTRY_DTYPE)
+    entries["offset"] = starts
+    entries["size"] = ends - starts
+
+    unwrapper = timeline.Unwrapper()
+    for batch in range(0, len(starts), batch_chunks):
+        count = min(batch_chunks, len(starts) - batch)
+        raw = [bulk_decode.align_frames(data[starts[i]:ends[i]], 0) for i in range(batch, batch + count)]
+        sizes = np.array([len(frames) for frames in raw])
+        previous = 0 if unwrapper.ticks is None else unwrapper.ticks
+        frames = bulk_decode.FrameArrays(np.concatenate(raw))
+        ticks = unwrapper.push_frames(frames)
+        chunk = np.repeat(np.arange(count), sizes)
+        pulse = frames.pulse_mask()
+
+        batch_entries = entries[batch:batch + count]
+        batch_entries["pulses"] = np.bincount(chunk[pulse], minlength=count)
+
+        # Time of the latest pulse at the end of each chunk
+        last = np.cumsum(sizes) - 1
+        end = np.where(last >= 0, ticks[np.maximum(last, 0)] if len(ticks) else 0, previous)
+        batch_entries["end"] = end
+        batch_entries["start"] = end
+        with_pulses, first = np.unique(chunk[pulse], return_index=True)
+        batch_entries["start"][with_pulses] = ticks[np.flatnonzero(pulse)[first]]
+
+        known = pulse & frames.poly_ok
+        channels = np.bincount(chunk[known] * N_CHANNELS + frames.channel[known], minlength=count * N_CHANNELS)
+        batch_entries["channels"] = np.minimum(channels.reshape(count, N_CHANNELS), MAX_COUNT)
+        sensors = np.bincount(chunk[pulse] * N_SENSORS + frames.sensor[pulse], minlength=count * N_SENSORS)
+        batch_entries["sensors"] = np.minimum(sensors.reshape(count, N_SENSORS), MAX_COUNT)
+
+    with_pulses = entries[entries["pulses"] > 0]
+    if len(with_pulses) == 0:
+        return entries, 0, 0
+    return entries, int(with_pulses["start"][0]), int(with_pulses["end"].max())
+
+
+# Builds the index of a raw capture, written to a temporary file first so
+# that an interrupted build does not leave a broken index
+def build_index(capture_file, index_file, batch_chunks=BUILD_CHUNKS):
+    require_raw_capture(capture_file)
+    with open(capture_file, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            data = b''
+    try:
+        entries, first, last = index_capture(data, batch_chunks)
+        size = len(data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+    tmp_file = "{}.{}.tmp".format(index_file, os.getpid())
+    try:
+        with open(tmp_file, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, HEADER.size, ENTRY_DTYPE.itemsize, N_CHANNELS, N_SENSORS,
+                                timeline.CLOCK_FREQUENCY, len(entries), size, first, last))
+            f.write(entries.tobytes())
+        os.replace(tmp_file, index_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+class CaptureIndex:
+    def __init__(self, file_name, capture_file=None):
+        self.file_name = file_name
+        if capture_file is None and file_name.endswith(INDEX_EXTENSION):
+            capture_file = file_name[:-len(INDEX_EXTENSION)]
+        self.capture_file = capture_file
+
+        with open(file_name, "rb") as f:
+            data = f.read(HEADER.size)
+        if len(data) < HEADER.size:
+            raise ValueError("{}: file too short".format(file_name))
+        magic, version, header_size, entry_size, n_channels, n_sensors, clock, n_entries, capture_size, first, \
+            last = HEADER.unpack(data)
+        if magic != MAGIC:
+            raise ValueError("{}: not a capture index".format(file_name))
+        if version != VERSION or entry_size != ENTRY_DTYPE.itemsize or n_channels != N_CHANNELS or \
+                n_sensors != N_SENSORS:
+            raise ValueError("{}: unsupported capture index version {}".format(file_name, version))
+
+        self.capture_size = capture_size
+        self.first_ticks = first
+        self.last_ticks = last
+        if n_entries:
+            self.entries = np.memmap(file_name, dtype=ENTRY_DTYPE, mode="r", offset=header_size, shape=(n_entries,))
+        else:
+            self.entries = np.zeros(0, dtype=ENTRY_DTYPE)
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Duration of the capture in seconds, from the first to the last pulse
+    def duration(self):
+        return timeline.seconds(self.last_ticks - self.first_ticks)
+
+    # Pulses per channel and per sensor in the whole capture
+    def channel_counts(self):
+        return self.entries["channels"].sum(axis=0, dtype=np.int64)
+
+    def sensor_counts(self):
+        return self.entries["sensors"].sum(axis=0, dtype=np.int64)
+
+    def _window(self, start, end):
+        start_ticks = self.first_ticks if start is None else self.first_ticks + round(start * timeline.CLOCK_FREQUENCY)
+        end_ticks = self.last_ticks + 1 if end is None else self.first_ticks + round(end * timeline.CLOCK_FREQUENCY)
+        return start_ticks, end_ticks
+
+    # Returns the entry numbers of the chunks with pulses from start to end, in
+    # seconds since the first pulse, with a channel (zero indexed) or a sensor
+    def select(self, start=None, end=None, channel=None, sensor=None):
+        start_ticks, end_ticks = self._window(start, end)
+        entries = self.entries
+        # Frames sent out of order can be a bit earlier than the first pulse
+        mask = (entries["pulses"] > 0) & (entries["end"] >= start_ticks) & \
+            (entries["start"] - timeline.MAX_BACKWARD_TICKS < end_ticks)
+        if channel is not None:
+            mask &= entries["channels"][:, channel] > 0
+        if sensor is not None:
+            mask &= entries["sensors"][:, sensor] > 0
+        return np.flatnonzero(mask)
+
+    # Returns the pulses from start to end, in seconds since the first pulse,
+    # of a channel (zero indexed) or a sensor as a bulk_decode.FrameArrays,
+    # the time of each pulse in ticks and the number of chunks decoded
+    def read(self, start=None, end=None, channel=None, sensor=None):
+        start_ticks, end_ticks = self._window(start, end)
+        chunks = self.select(start, end, channel, sensor)
+
+        raws = []
+        times = []
+        with open(self.capture_file, "rb") as f:
+            for entry in self.entries[chunks]:
+                f.seek(int(entry["offset"]))
+                raw = bulk_decode.align_frames(f.read(int(entry["size"])), 0)
+                frames = bulk_decode.FrameArrays(raw)
+                pulse = frames.pulse_mask()
+                if not np.any(pulse):
+                    continue
+
+                ticks = timeline.Unwrapper().push_frames(frames)
+                ticks += int(entry["start"]) - ticks[np.argmax(pulse)]
+                mask = pulse & (ticks >= start_ticks) & (ticks < end_ticks)
+                if channel is not None:
+                    mask &= frames.poly_ok & (frames.channel == channel)
+                if sensor is not None:
+                    mask &= frames.sensor == sensor
+                raws.append(raw[mask])
+                times.append(ticks[mask])
+
+        if not raws:
+            return bulk_decode.decode_frames(b''), np.zeros(0, dtype=np.int64), len(chunks)
+        return bulk_decode.FrameArrays(np.concatenate(raws)), np.concatenate(times), len(chunks)
+
+
+# Opens the index of a capture, built the first time and when the capture
+# changed
+def open_index(file_name, rebuild=False):
+    if file_name.endswith(INDEX_EXTENSION):
+        return CaptureIndex(file_name)
+
+    index_file = file_name + INDEX_EXTENSION
+    if not rebuild:
+        try:
+            if os.path.getmtime(index_file) >= os.path.getmtime(file_name):
+                index = CaptureIndex(index_file, file_name)
+                if index.capture_size == os.path.getsize(file_name):
+                    return index
+        except (OSError, ValueError):
+            pass
+
+    build_index(file_name, index_file)
+    return CaptureIndex(index_file, file_name)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Index a recorded capture and read the pulses of a time window")
+    parser.add_argument("input", help="capture.bin or capture.bin.lhx")
+    parser.add_argument("--start", type=float, help="start of the window in seconds since the first pulse")
+    parser.add_argument("--end", type=float, help="end of the window in seconds since the first pulse")
+    parser.add_argument("--channel", type=int, help="only the pulses of a channel, 1 to 16")
+    parser.add_argument("--sensor", type=int, help="only the pulses of a sensor, 0 to 3")
+    parser.add_argument("--count", action="store_true", help="only count the pulses of the window")
+    parser.add_argument("--rebuild", action="store_true", help="build the index again")
+    args = parser.parse_args()
+    channel = None if args.channel is None else args.channel - 1
+
+    t = time.perf_counter()
+    try:
+        index = open_index(args.input, args.rebuild)
+    except ValueError as e:
+        parser.error(str(e))
+    print("Index:   {} ({:.1f} ms)".format(index.file_name, (time.perf_counter() - t) * 1000))
+    print("Chunks:  {}, {} bytes for {} bytes of capture".format(len(index), os.path.getsize(index.file_name),
+                                                               index.capture_size))
+    print("Time:    {:.6f} s".format(index.duration()))
+    for i, count in enumerate(index.channel_counts().tolist()):
+        if count:
+            print("  Chan:{:2d}  {}".format(i + 1, count))
+
+    if args.start is None and args.end is None and channel is None and args.sensor is None:
+        exit(0)
+
+    t = time.perf_counter()
+    frames, ticks, chunks = index.read(args.start, args.end, channel, args.sensor)
+    print("Window:  {} pulses in {} chunks ({:.1f} ms)".format(len(frames), chunks, (time.perf_counter() - t) * 1000))
+    if args.count:
+        exit(0)
+
+    columns = zip(timeline.seconds(ticks - index.first_ticks).tolist(), frames.sensor.tolist(),
+                  frames.timestamp.tolist(), frames.width.tolist(), frames.poly_ok.tolist(),
+                  frames.channel.tolist(), frames.slow_bit.tolist(), frames.offset.tolist(),
+                  frames.beam_word.tolist())
+    for seconds, sensor, ts, width, ok, pulse_channel, slow_bit, offset, beam_word in columns:
+        chan_s = "{:2}({})".format(pulse_channel + 1, slow_bit) if ok else " None"
+        print("T:{:12.6f}  Sensor: {}  TS:{:06x}  Width:{:4x}  Chan:{}  offset:{:-6d}  BeamWord:{:05x}".format(
+            seconds, sensor, ts, width, chan_s, offset, beam_word))
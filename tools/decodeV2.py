@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 
-import serial
 import math
 
+import angle_conversion
+import discard_stats
+import lfsr
+from angle_conversion import PERIODS
+from framing import unpack_frame
+
+# Set to a discard_stats.DiscardStats() to count discarded blocks
+discards = None
+
 
 def calculateAE(firstBeam, secondBeam):
     azimuth = ((firstBeam + secondBeam) / 2) - math.pi
@@ -17,24 +25,36 @@ def ts_sub(a, b):
 def ts_add(a, b):
     return (a + b) & 0x00ffffff
 
+# Timestamp of the start of the rotor rotation of a processed sweep block
+def rotor_start(block):
+    return ts_sub(block.offset_sensor.ts, block.offset_sensor.offset)
+
 
-# The cycle times from the Lighhouse base stations is expressed in a 48 MHz clock, we use 24 MHz, hence the / 2.
-PERIODS = [959000 / 2, 957000 / 2,
-           953000 / 2, 949000 / 2,
-           947000 / 2, 943000 / 2,
-           941000 / 2, 939000 / 2,
-           937000 / 2, 929000 / 2,
-           919000 / 2, 911000 / 2,
-           907000 / 2, 901000 / 2,
-           893000 / 2, 887000 / 2]
+# Number of sweep blocks reused by the PulseProcessor. A block returned by
+# PulseProcessor.push() is valid until SWEEP_BLOCK_RING_SIZE - 1 more blocks
+# have been started.
+SWEEP_BLOCK_RING_SIZE = 4
+
+# Number of sweeps a BaseStation keeps while waiting for the other sweep of
+# their rotation
+SWEEP_INDEX_SIZE = 4
+# Max difference between the rotation starts of the two sweeps of a rotation,
+# they are the same but for rounding of the offsets
+ROTOR_MATCH_TICKS = 1000
 
 class SweepData:
-    def __init__(self, ts, width, offset, channel, slow_bit):
+    __slots__ = ('ts', 'width', 'offset', 'channel', 'slow_bit', 'beam_word')
+
+    def __init__(self, ts=0, width=0, offset=0, channel=None, slow_bit=None, beam_word=0):
+        self.set(ts, width, offset, channel, slow_bit, beam_word)
+
+    def set(self, ts, width, offset, channel, slow_bit, beam_word=0):
         self.ts = ts
         self.width = width
         self.offset = offset
         self.channel = channel
         self.slow_bit = slow_bit
+        self.beam_word = beam_word
 
     def dump(self, sensor_nr, mark=False):
         if self.channel == None:
@@ -55,31 +75,88 @@ class SweepData:
 
 
 class SweepBlock:
+    __slots__ = ('sensors', 'channel', 'ts', 'is_valid', 'offset_sensor', 'slow_bit', '_data')
+
     def __init__(self):
+        # Storage for the sensor data, sensors[i] is either None or _data[i]
+        self._data = [SweepData(), SweepData(), SweepData(), SweepData()]
         self.sensors = [None, None, None, None]
+        self.reset()
+
+    def reset(self):
+        sensors = self.sensors
+        sensors[0] = sensors[1] = sensors[2] = sensors[3] = None
         self.channel = None
         self.ts = None
         self.is_valid = False
         self.offset_sensor = None
         self.slow_bit = None
 
-    def print_err(self, s):
+    def copy_from(self, other):
+        for i in range(4):
+            sensor = other.sensors[i]
+            if sensor is None:
+                self.sensors[i] = None
+            else:
+                data = self._data[i]
+                data.set(sensor.ts, sensor.width, sensor.offset, sensor.channel, sensor.slow_bit, sensor.beam_word)
+                self.sensors[i] = data
+
+        self.offset_sensor = None
+        if other.offset_sensor is not None:
+            self.offset_sensor = self._data[other._data.index(other.offset_sensor)]
+
+        self.channel = other.channel
+        self.ts = other.ts
+        self.is_valid = other.is_valid
+        self.slow_bit = other.slow_bit
+
+    # Returns the content of the block as a tuple, to compare and restore
+    # decoder states
+    def state(self):
+        offset = None if self.offset_sensor is None else self._data.index(self.offset_sensor)
+        return (tuple(None if s is None else (s.ts, s.width, s.offset, s.channel, s.slow_bit, s.beam_word)
+                      for s in self.sensors), self.channel, self.ts, self.is_valid, self.slow_bit, offset)
+
+    def set_state(self, state):
+        sensors, self.channel, self.ts, self.is_valid, self.slow_bit, offset = state
+        for i in range(4):
+            if sensors[i] is None:
+                self.sensors[i] = None
+            else:
+                self._data[i].set(*sensors[i])
+                self.sensors[i] = self._data[i]
+        self.offset_sensor = None if offset is None else self._data[offset]
+
+    def print_err(self, reason, s):
+        if discards is not None:
+            # The channel is not set yet if the block is discarded early
+            channel = self.channel
+            if channel is None:
+                for sensor in self.sensors:
+                    if sensor and sensor.channel is not None:
+                        channel = sensor.channel
+                        break
+            discards.count(reason, channel)
+
         # Enable this print to see why a frame is discarded
         # print(s)
         # self.dump()
         pass
 
-    def push(self, sensor, ts, width, offset, channel, slow_bit):
+    def push(self, sensor, ts, width, offset, channel, slow_bit, beam_word=0):
         if self.sensors[sensor] != None:
             return False
-        self.sensors[sensor] = SweepData(ts, width, offset, channel, slow_bit)
+        data = self._data[sensor]
+        data.set(ts, width, offset, channel, slow_bit, beam_word)
+        self.sensors[sensor] = data
         return True
 
     def process(self):
         # Check we have data for all sensors
         for sensor in self.sensors:
             if not sensor:
-                self.print_err("Sensor missing - discard sweep")
+                self.print_err(discard_stats.SENSOR_MISSING, "Sensor missing - discard sweep")
                 return False
 
         # Channel. Should all be the same except one that is None
@@ -93,11 +170,11 @@ class SweepBlock:
                     self.slow_bit = sensor.slow_bit
 
                 if sensor.channel != self.channel:
-                    self.print_err("Duplicate channels - discard sweep")
+                    self.print_err(discard_stats.DUPLICATE_CHANNEL, "Duplicate channels - discard sweep")
                     return False
 
         if channel_count != 3:
-            self.print_err("Channel missing - discard sweep")
+            self.print_err(discard_stats.CHANNEL_MISSING, "Channel missing - discard sweep")
             return False
 
         # Set channel in all sensors
@@ -110,12 +187,12 @@ class SweepBlock:
         for sensor in self.sensors:
             if sensor.offset:
                 if self.offset_sensor:
-                    self.print_err("Duplicate offset - discard sweep")
+                    self.print_err(discard_stats.DUPLICATE_OFFSET, "Duplicate offset - discard sweep")
                     return False
                 self.offset_sensor = sensor
 
         if not self.offset_sensor:
-            self.print_err("No offset found - discard sweep")
+            self.print_err(discard_stats.NO_OFFSET, "No offset found - discard sweep")
             return False
 
         # Calculate other offsets
@@ -124,12 +201,10 @@ class SweepBlock:
                 ts_delta = ts_sub(sensor.ts, self.offset_sensor.ts)
                 sensor.offset = ts_add(self.offset_sensor.offset, ts_delta)
 
-        # Find fist time stamp
+        # Find first time stamp, the timestamps wrap
+        self.ts = self.sensors[0].ts
         for sensor in self.sensors:
-            if not self.ts:
-                self.ts = sensor.ts
-
-            if sensor.ts < self.ts:
+            if ts_sub(self.ts, sensor.ts) < 0x800000:
                 self.ts = sensor.ts
 
         self.is_valid = True
@@ -148,9 +223,12 @@ class SweepBlock:
 
 
 class Angles:
-    def __init__(self, channel):
+    def __init__(self, channel, ts=None, slow_bit=None):
         self.data = [None, None, None, None]
         self.channel = channel
+        # Timestamp of the second sweep
+        self.ts = ts
+        self.slow_bit = slow_bit
 
     def set(self, sensor, azimuth, elevation):
         self.data[sensor] = (azimuth, elevation)
@@ -158,50 +236,177 @@ class Angles:
     def dump(self):
         sensor_nr = 0
         for d in self.data:
-            print("Chan:{:2d} Sensor:{} azimuth:{:8.2f} elevation:{:8.2f}".format(self.channel + 1, sensor_nr, math.degrees(d[0]), math.degrees(d[1])))
+            # None if rejected by the angle filter
+            if d is not None:
+                print("Chan:{:2d} Sensor:{} azimuth:{:8.2f} elevation:{:8.2f}".format(self.channel + 1, sensor_nr, math.degrees(d[0]), math.degrees(d[1])))
+            sensor_nr += 1
+
+
+# Angles of a single sweep, used when the other sweep of the rotation is lost.
+# The angle of a sensor is the azimuth it would have at elevation 0.
+class SweepAngles:
+    def __init__(self, channel, first, ts=None, slow_bit=None):
+        self.data = [None, None, None, None]
+        self.channel = channel
+        self.first = first
+        self.ts = ts
+        self.slow_bit = slow_bit
+
+    def dump(self):
+        sweep = 1 if self.first else 2
+        sensor_nr = 0
+        for d in self.data:
+            print("Chan:{:2d} Sensor:{} sweep:{} angle:{:8.2f}".format(self.channel + 1, sensor_nr, sweep, math.degrees(d)))
             sensor_nr += 1
 
 
 class BaseStation:
-    def __init__(self, channel):
+    def __init__(self, channel, use_angle_tables=False, on_single_sweep=None, batch=None):
         self.channel = channel
-        self.prev_block = None
+        self.use_angle_tables = use_angle_tables
+        # angle_conversion.BatchConverter the pairs are added to, with their
+        # Angles as item. push() then returns None and the angles are set when
+        # the batch is converted.
+        self.batch = batch
+        # Called with a SweepAngles for each sweep that is not paired
+        self.on_single_sweep = on_single_sweep
+        # Sweeps waiting for the other sweep of their rotation, indexed by the
+        # start of the rotation. Blocks from the PulseProcessor are reused, the
+        # sweeps are copied to _storage.
+        self._storage = [SweepBlock() for _ in range(SWEEP_INDEX_SIZE)]
+        self._rotors = [None] * SWEEP_INDEX_SIZE
+        # Offsets of sensor 0 in the first and second sweep of the latest pair,
+        # to tell which sweep a single sweep is. Not part of state().
+        self._pair_offsets = None
+        self.blocks = 0
+        self.pairs = 0
+        self.singles = 0
 
     def push(self, block):
-        result = None
-
         if block.channel != self.channel:
             print("Wrong channel!")
-            return result
-
-        if self.prev_block:
-            if self.is_second_sweep(self.prev_block, block):
-                result = self.process(self.prev_block, block)
-                self.prev_block = None
+            return None
+
+        self.blocks += 1
+        rotor = rotor_start(block)
+        match = None
+        for slot in range(SWEEP_INDEX_SIZE):
+            stored = self._rotors[slot]
+            if stored is None:
+                continue
+            age = ts_sub(rotor, stored)
+            if age <= ROTOR_MATCH_TICKS or age >= 0x1000000 - ROTOR_MATCH_TICKS:
+                match = slot
+            elif age < 0x800000:
+                # The rotation of the stored sweep is over
+                self._expire(slot)
+
+        if match is not None:
+            other = self._storage[match]
+            other_first = self.is_first_sweep(other, block)
+            if other_first is not None:
+                self._rotors[match] = None
+                self.pairs += 1
+                if other_first:
+                    self._pair_offsets = (other.sensors[0].offset, block.sensors[0].offset)
+                    return self.process(other, block)
+                self._pair_offsets = (block.sensors[0].offset, other.sensors[0].offset)
+                return self.process(block, other)
+            # The same sweep twice in a rotation, keep the latest
+            self._expire(match)
+
+        self._store(rotor, block)
+        return None
+
+    # Expires all the stored sweeps, at the end of a capture
+    def flush(self):
+        for slot in range(SWEEP_INDEX_SIZE):
+            if self._rotors[slot] is not None:
+                self._expire(slot)
+
+    def _store(self, rotor, block):
+        slot = None
+        oldest = -1
+        for i in range(SWEEP_INDEX_SIZE):
+            stored = self._rotors[i]
+            if stored is None:
+                slot = i
+                break
+            age = ts_sub(rotor, stored)
+            if age > oldest:
+                slot = i
+                oldest = age
+        if self._rotors[slot] is not None:
+            self._expire(slot)
+
+        self._storage[slot].copy_from(block)
+        self._rotors[slot] = rotor
+
+    def _expire(self, slot):
+        self._rotors[slot] = None
+        # print("No other sweep, discard sweep")
+        if discards is not None:
+            discards.count(discard_stats.PAIR_MISMATCH, self.channel)
+        if self.on_single_sweep:
+            single = self.process_single(self._storage[slot])
+            if single:
+                self.singles += 1
+                self.on_single_sweep(single)
+
+    # Returns True if a is the first sweep of their rotation and b the second,
+    # False if b is the first and None if they are the same sweep. Offsets
+    # count from the rotation start, the second sweep hits a sensor 120
+    # degrees plus or minus its elevation after the first one.
+    def is_first_sweep(self, a, b):
+        delta = b.sensors[0].offset - a.sensors[0].offset
+        if -ROTOR_MATCH_TICKS <= delta <= ROTOR_MATCH_TICKS:
+            return None
+        return delta > 0
+
+    # Returns True if a single sweep is the first of its rotation, by the
+    # sweep of the latest pair closest to it, None before the first pair
+    def is_single_first_sweep(self, block):
+        if self._pair_offsets is None:
+            return None
+        offset = block.sensors[0].offset
+        return abs(offset - self._pair_offsets[0]) < abs(offset - self._pair_offsets[1])
+
+    # Returns the sweeps waiting for their other sweep as a tuple, to compare
+    # and restore decoder states
+    def state(self):
+        return tuple(None if rotor is None else (rotor, self._storage[slot].state())
+                     for slot, rotor in enumerate(self._rotors))
+
+    def set_state(self, state):
+        for slot, stored in enumerate(state):
+            if stored is None:
+                self._rotors[slot] = None
             else:
-                # print("Not second sweep, use as first sweep and wait for next sweep")
-                self.prev_block = block
-        else:
-            self.prev_block = block
-
-        return result
+                self._rotors[slot] = stored[0]
+                self._storage[slot].set_state(stored[1])
 
-    def is_second_sweep(self, a, b):
-        if a.sensors[0].offset > b.sensors[0].offset:
-            return False
-
-        dt = ts_sub(b.ts, a.ts)
-        # 220000 ticks is around 180 degrees
-        if dt > 220000:
-            return False
-
-        return True
+    # Returns the pairing rate, the fraction of the blocks used in a pair
+    def pairing_rate(self):
+        if self.blocks == 0:
+            return 0.0
+        return 2 * self.pairs / self.blocks
 
     def process(self, a, b):
         # a.dump()
         # b.dump()
 
-        result = Angles(self.channel)
+        result = Angles(self.channel, b.ts, b.slow_bit)
+
+        if self.batch is not None:
+            self.batch.add(result, self.channel, [sensor.offset for sensor in a.sensors],
+                           [sensor.offset for sensor in b.sensors])
+            return None
+
+        if self.use_angle_tables:
+            offsets0 = [sensor.offset for sensor in a.sensors]
+            offsets1 = [sensor.offset for sensor in b.sensors]
+            result.data = angle_conversion.convert_pair(self.channel, offsets0, offsets1)
+            return result
 
         for i in range(4):
             offset0 = a.sensors[i].offset
@@ -216,100 +421,343 @@ class BaseStation:
 
         return result
 
+    # Returns the SweepAngles of a single sweep, None if it is not known which
+    # sweep it is
+    def process_single(self, block):
+        first = self.is_single_first_sweep(block)
+        if first is None:
+            return None
+        result = SweepAngles(self.channel, first, block.ts, block.slow_bit)
+
+        # The sweeps are 120 degrees apart at elevation 0, see calculateAE()
+        shift = math.radians(60) if first else -math.radians(60)
+        period = PERIODS[self.channel]
+        for i in range(4):
+            beam = (block.sensors[i].offset / period) * 2 * math.pi
+            result.data[i] = beam - math.pi + shift
+
+        return result
+
 class PulseProcessor:
-    def __init__(self):
+    def __init__(self, recover_channels=False):
         self.block = None
         self.latest_pulse = 0
+        self._blocks = [SweepBlock() for _ in range(SWEEP_BLOCK_RING_SIZE)]
+        self._next_block = 0
+        # Identify the channel of pulses where the FPGA did not find the poly,
+        # from the beam words of the other sensors in the block
+        self.recover_channels = recover_channels
+        self.recovered = 0
+
+    def _new_block(self):
+        block = self._blocks[self._next_block]
+        self._next_block = (self._next_block + 1) % SWEEP_BLOCK_RING_SIZE
+        block.reset()
+        return block
+
+    # The FPGA identifies the poly of a pulse from the beam word of the previous
+    # pulse, from any sensor or base station. The first pulse of a sweep never
+    # has a poly and a pulse in between from another base station, or a bad
+    # beam word, hides the poly of the next one. Here the poly is searched
+    # from the beam words of the earlier pulses in the block, until 3 sensors
+    # have a channel as expected by SweepBlock.process().
+    def _recover_channels(self, block):
+        # Oldest first, a block is much shorter than the timestamp wrap
+        ref = ts_sub(self.latest_pulse, 0x100000)
+        sensors = sorted((s for s in block.sensors if s), key=lambda s: ts_sub(s.ts, ref))
+        known = sum(1 for s in sensors if s.channel is not None)
+        if known >= 3:
+            return
+
+        # Pairs of a pulse without channel and each earlier pulse, nearest first
+        pairs = []
+        for i in range(1, len(sensors)):
+            # A beam word of 0 was not received
+            if sensors[i].channel is None and sensors[i].beam_word:
+                for j in range(i - 1, -1, -1):
+                    if sensors[j].beam_word:
+                        pairs.append((sensors[j], sensors[i]))
+        if not pairs:
+            return
+
+        polys = lfsr.find_polys([a.beam_word for a, _ in pairs], [b.beam_word for _, b in pairs],
+                                [ts_sub(b.ts, a.ts) for a, b in pairs])
+        for (_, sensor), poly in zip(pairs, polys.tolist()):
+            if known >= 3:
+                break
+            if poly != lfsr.NO_POLY and sensor.channel is None:
+                sensor.channel = poly >> 1
+                sensor.slow_bit = poly & 1
+                known += 1
+                self.recovered += 1
+
+    # Returns the latest pulse and the open block as a tuple, to compare and
+    # restore decoder states
+    def state(self):
+        return (self.latest_pulse, None if self.block is None else self.block.state())
+
+    def set_state(self, state):
+        self.latest_pulse, block = state
+        self.block = None
+        if block is not None:
+            self.block = self._new_block()
+            self.block.set_state(block)
 
-    def push(self, sensor, ts, width, offset, channel, slow_bit):
+    def push(self, sensor, ts, width, offset, channel, slow_bit, beam_word=0):
         result = None
 
         delta = ts_sub(ts, self.latest_pulse)
         if delta > 10000:
             if self.block:
+                if self.recover_channels:
+                    self._recover_channels(self.block)
                 if self.block.process():
                     result = self.block
                 self.block = None
         self.latest_pulse = ts
 
         if not self.block:
-            self.block = SweepBlock()
+            self.block = self._new_block()
 
-        if not self.block.push(sensor, ts, width, offset, channel, slow_bit):
+        if not self.block.push(sensor, ts, width, offset, channel, slow_bit, beam_word):
             print("Drop block")
+            self.block.print_err(discard_stats.DUPLICATE_SENSOR, "Duplicate sensor - drop block")
             self.block = None
 
         return result
 
 
+# Returns the pulse in a frame as the arguments of PulseProcessor.push(), or
+# None for a sync frame
+def parse_pulse(reading):
+    first_word, offset_6, beam_word, timestamp = unpack_frame(reading)
+    beam_word &= 0x1ffff
+
+    # Sync frame, ignore it
+    if offset_6 == 0xffffff:
+        return None
+
+    # Offset is expressed in a 6 MHz clock, while the timestamp uses a 24 MHz clock.
+    # update offset to a 24 MHz clock
+    offset = offset_6 * 4
+
+    sensor = first_word & 0x03
+    width = (first_word >> 8) & 0xffff
+
+    nPoly_ok = ((first_word >> 7) & 0x01) == 0
+    if nPoly_ok:
+        identity = (first_word >> 2) & 0x1f
+        channel = identity >> 1
+        slow_bit = identity & 1
+    else:
+        channel = None
+        slow_bit = None
+
+    return sensor, timestamp, width, offset, channel, slow_bit, beam_word
+
+
 if __name__ == "__main__":
     import sys
-    import struct
-    if len(sys.argv) < 2:
-        print("Usage: {} <input.bin or /dev/tty...>".format(sys.argv[0]))
-        exit(1)
+    import framing
+    # --angle-tables: convert angles with the precomputed tables of angle_conversion.py, in batches for a file
+    # --discard-stats=FILE: write discard counters to FILE as JSON lines, see discard_stats.py
+    # --recover-channels: identify the channel of pulses without poly from the beam words, see lfsr.py
+    # --single-sweeps: print the angles of the sweeps that are not paired, they are not written to output.lha
+    # --ootx: decode the calibration data in the slow bits, cached between runs, see ootx.py
+    # --filter: reject outliers and smooth the angles, see angle_filter.py
+    # --record=FILE: write the frames read from the deck to a compressed capture, see capture_file.py
+    # --reorder[=US]: sort the pulses by timestamp, holding them US microseconds, see reorder.py
+    use_angle_tables = False
+    recover_channels = False
+    single_sweeps = False
+    slow_data = None
+    angles_filter = None
+    # timeline.Unwrapper of the pulses decoded, to time the filtered angles.
+    # A pulse is pushed after it is decoded, the angles it completes are timed
+    # from the pulse before, the last one of their sweep, even after a gap.
+    frame_timeline = None
+    snapshot_writer = None
+    record_file = None
+    reorder_buffer = None
+    args = []
+    for arg in sys.argv[1:]:
+        if arg == "--angle-tables":
+            use_angle_tables = True
+        elif arg == "--recover-channels":
+            recover_channels = True
+        elif arg == "--single-sweeps":
+            single_sweeps = True
+        elif arg == "--ootx":
+            import ootx
+            slow_data = ootx.cached_slow_data()
+        elif arg == "--filter":
+            import angle_filter
+            import timeline
+            angles_filter = angle_filter.AngleFilter()
+            frame_timeline = timeline.Unwrapper()
+        elif arg.startswith("--record="):
+            record_file = arg.split("=", 1)[1]
+        elif arg == "--reorder" or arg.startswith("--reorder="):
+            import reorder
+            if "=" in arg:
+                reorder_buffer = reorder.ReorderBuffer(reorder.us_to_ticks(float(arg.split("=", 1)[1])))
+            else:
+                reorder_buffer = reorder.ReorderBuffer()
+        elif arg.startswith("--discard-stats="):
+            discards = discard_stats.DiscardStats()
+            snapshot_writer = discard_stats.SnapshotWriter(discards, open(arg.split("=", 1)[1], "w"))
+        else:
+            args.append(arg)
 
-    if sys.argv[1].startswith("/dev/"):
-        src = serial.Serial(sys.argv[1], 2*115200)
-    else:
-        src = open(sys.argv[1], "rb")
+    if len(args) < 1:
+        print("Usage: {} [--angle-tables] [--discard-stats=FILE] [--recover-channels] [--single-sweeps] [--ootx] [--filter] [--record=FILE] [--reorder[=US]] <input.bin, input.lhc or /dev/tty...> [output.lha]".format(sys.argv[0]))
+        exit(1)
 
-    pulse_processor = PulseProcessor()
-    base_stations = []
-    for i in range(16):
-        base_stations.append(BaseStation(i))
+    if record_file and not args[0].startswith("/dev/"):
+        print("--record=FILE records the frames read from a deck, not from {}".format(args[0]))
+        exit(1)
 
-    print("Waiting for sync ...")
-    sync = [b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff']
-    syncBuffer = [b'\x00'] * len(sync)
-    while sync != syncBuffer:
-        b = src.read(1)
-        if len(b) < 1:
-            sys.exit(1)
-        syncBuffer.append(b)
-        syncBuffer = syncBuffer[1:]
-
-    print("Found sync!")
-
-    reading = src.read(12)
-
-    frames_since_last_result = 0
-
-    while(len(reading) == 12):
-        timestamp = struct.unpack("<I", reading[9:] + b'\x00')[0]
-        beam_word = struct.unpack("<I", reading[6:9] + b'\x00')[0]
-        offset_6 = struct.unpack("<I", reading[3:6] + b'\x00')[0]
-        first_word = struct.unpack("<I", reading[:3] + b'\x00')[0]
-
-        # Offset is expressed in a 6 MHz clock, while the timestamp uses a 24 MHz clock.
-        # update offset to a 24 MHz clock
-        offset = offset_6 * 4
-
-        sensor = first_word & 0x03
-        width = (first_word >> 8) & 0xffff
-
-        nPoly_ok = ((first_word >> 7) & 0x01) == 0
-        if nPoly_ok:
-            identity = (first_word >> 2) & 0x1f
-            channel = identity >> 1
-            slow_bit = identity & 1
+    # Write the angles to a binary angle file instead of printing them
+    writer = None
+    if len(args) > 1:
+        import angle_file
+        writer = angle_file.AngleWriter(args[1])
+
+    def process_single_sweep(angles):
+        if not writer:
+            angles.dump()
+            print()
+
+    def output_angles(angles):
+        if angles_filter:
+            angles_filter.filter(angles, frame_timeline.time_of(angles.ts))
+        if writer:
+            writer.write_angles(angles)
         else:
-            channel = None
-            slow_bit = None
+            angles.dump()
 
-        # Sync frame, ignore it
-        if offset_6 == 0xffffff:
-            reading = src.read(12)
-            continue
+            print()
 
-        block = pulse_processor.push(sensor, timestamp, width, offset, channel, slow_bit)
+    # A recorded capture is not decoded in real time, the pairs can be
+    # converted in batches. The filter needs the time of the pairs when they
+    # are decoded.
+    batch = None
+    if use_angle_tables and not args[0].startswith("/dev/") and not angles_filter:
+        def output_batch(angles, data):
+            angles.data = data
+            output_angles(angles)
+        batch = angle_conversion.BatchConverter(output_batch)
+
+    pulse_processor = PulseProcessor(recover_channels)
+    base_stations = []
+    for i in range(16):
+        base_stations.append(BaseStation(i, use_angle_tables, process_single_sweep if single_sweeps else None, batch))
+
+    def print_stats():
+        blocks = sum(bs.blocks for bs in base_stations)
+        pairs = sum(bs.pairs for bs in base_stations)
+        print("Paired sweeps: {} of {} ({:.1%})".format(2 * pairs, blocks, 2 * pairs / blocks if blocks else 0.0),
+              file=sys.stderr)
+        for bs in base_stations:
+            if bs.blocks:
+                print("  Chan:{:2d} {:6d} sweeps {:6.1%} paired {:6d} single".format(
+                    bs.channel + 1, bs.blocks, bs.pairing_rate(), bs.singles), file=sys.stderr)
+        if reorder_buffer:
+            print(reorder_buffer.report(), file=sys.stderr)
+        if angles_filter:
+            print("Angle filter:", file=sys.stderr)
+            print(angles_filter.report(), file=sys.stderr)
+
+    def process_pulse(sensor, timestamp, width, offset, channel, slow_bit, beam_word):
+        block = pulse_processor.push(sensor, timestamp, width, offset, channel, slow_bit, beam_word)
         if block:
             # print("Good")
             # block.dump()
+            if slow_data:
+                slow_data[block.channel].push(rotor_start(block), block.slow_bit)
             angles = base_stations[block.channel].push(block)
             if angles:
-                angles.dump()
+                output_angles(angles)
+        if frame_timeline:
+            frame_timeline.push(timestamp)
+
+        if snapshot_writer:
+            snapshot_writer.poll()
 
-                print()
+    # Decodes a pulse, None is a sync frame kept in the pulses for the timeline
+    def process_item(pulse):
+        if pulse:
+            process_pulse(*pulse)
+        else:
+            frame_timeline.sync()
+
+    if not args[0].startswith("/dev/"):
+        # Recorded capture, decode all frames at once
+        import bulk_decode
+        frames = bulk_decode.load_capture(args[0])
+        pulses = frames.iter_pulses(with_syncs=frame_timeline is not None)
+        if reorder_buffer:
+            pulses = reorder.reorder_pulses(pulses, reorder_buffer)
+        for pulse in pulses:
+            process_item(pulse)
+        for bs in base_stations:
+            bs.flush()
+        if batch:
+            batch.flush()
+        print_stats()
+        if writer:
+            writer.close()
+        if snapshot_writer:
+            snapshot_writer.write()
+        if recover_channels:
+            print("Recovered channels: {}".format(pulse_processor.recovered))
+        sys.exit(0)
+
+    import serial
+    src = serial.Serial(args[0], 2*115200, timeout=framing.SERIAL_TIMEOUT)
+
+    recorder = None
+    if record_file:
+        import capture_file
+        recorder = capture_file.CaptureWriter(record_file, flush_seconds=capture_file.RECORD_FLUSH_SECONDS)
+
+    # The pulses held are released when the deck goes quiet
+    if reorder_buffer:
+        reorder_buffer.max_delay = reorder.LIVE_MAX_DELAY
+
+    # Called when no data is received for framing.SERIAL_TIMEOUT
+    def on_idle():
+        if reorder_buffer:
+            for pulse in reorder_buffer.poll():
+                process_item(pulse)
+        if recorder:
+            recorder.poll()
 
-        reading = src.read(12)
+    print("Waiting for sync ...")
+    frame_sync = framing.FrameSync(on_sync=lambda: print("Found sync!"))
+    try:
+        for reading in framing.FrameReader(src, frame_sync, on_idle=on_idle):
+            if recorder:
+                recorder.write(reading)
+            pulse = parse_pulse(reading)
+            if pulse or (frame_timeline and framing.is_sync_frame(reading, 0)):
+                if reorder_buffer:
+                    for pulse in reorder_buffer.push(pulse[1] if pulse else None, pulse):
+                        process_item(pulse)
+                else:
+                    process_item(pulse)
+            if reorder_buffer:
+                # Only sync frames are received without base stations
+                for pulse in reorder_buffer.poll():
+                    process_item(pulse)
+        if reorder_buffer:
+            for pulse in reorder_buffer.flush():
+                process_item(pulse)
+    finally:
+        print_stats()
+        if recorder:
+            recorder.close()
+        if writer:
+            writer.close()
+        if snapshot_writer:
+            snapshot_writer.write()
@@ -3,13 +3,17 @@
 # This implementation is designed to be close to the implementation in the Crazyflie.
 # The design is C-like to resemble the firmware as much as possible
 
-import serial
 import math
-import copy
+
+import angle_conversion
+import discard_stats
+from framing import unpack_frame
 
 UART_FRAME_LENGTH = 12
 PULSE_PROCESSOR_N_SWEEPS = 2
-PULSE_PROCESSOR_N_BASE_STATIONS = 3
+# Number of base stations (channels) decoded, up to 16. Can be set with --base-stations
+PULSE_PROCESSOR_N_BASE_STATIONS = 16
+MAX_BASE_STATIONS = 16
 PULSE_PROCESSOR_N_SENSORS = 4
 PULSE_PROCRSSOR_N_CONCURRENT_BLOCKS = 2
 PULSE_PROCESSOR_N_WORKSPACE = PULSE_PROCESSOR_N_SENSORS * PULSE_PROCRSSOR_N_CONCURRENT_BLOCKS
@@ -20,17 +24,25 @@ NO_SENSOR = -1
 NO_OFFSET = 0
 MIN_TICKS_BETWEEN_SLOW_BITS = int(0.8 * 24000000 / 50)
 
+# Use the precomputed tables of angle_conversion.py in calculateAngles()
+useAngleTables = False
+
+# Set to a discard_stats.DiscardStats() to count discarded blocks
+discards = None
+
+# Set to a list of ootx.SlowData, one per channel, to decode the slow data
+slow_data = None
+
+# Set to an angle_filter.AngleFilter to filter the angles in calculateAngles(),
+# with frameTimeline a timeline.Unwrapper of the frames processed to time them.
+# A frame is pushed after it is processed, the angles are timed from the frame
+# before, the last one of their sweep.
+angleFilter = None
+frameTimeline = None
+
 
-# The cycle times from the Lighhouse base stations is expressed in a 48 MHz clock, we use 24 MHz, hence the / 2.
-CYCLE_PERIODS = [
-    959000 / 2, 957000 / 2,
-    953000 / 2, 949000 / 2,
-    947000 / 2, 943000 / 2,
-    941000 / 2, 939000 / 2,
-    937000 / 2, 929000 / 2,
-    919000 / 2, 911000 / 2,
-    907000 / 2, 901000 / 2,
-    893000 / 2, 887000 / 2]
+# The cycle times from the Lighhouse base stations in the 24 MHz clock
+CYCLE_PERIODS = angle_conversion.PERIODS
 
 
 class SlowBitValidtor:
@@ -61,7 +73,7 @@ class SlowBitValidtor:
         self.ts = ts
 
 slowbitValidators = []
-for i in range(PULSE_PROCESSOR_N_BASE_STATIONS):
+for i in range(MAX_BASE_STATIONS):
     slowbitValidators.append(SlowBitValidtor(i))
 
 class pulseProcessorFrame_t:
@@ -103,11 +115,17 @@ class pulseProcessor_t:
 
         self.latestSlowbitTs = [0] * PULSE_PROCESSOR_N_BASE_STATIONS
 
+        # Number of sweep blocks decoded, for the tools
+        self.blockCount = 0
+
+        # False while the first sweep in blocksV2 is waiting for its second sweep
+        self.isBlockV2Paired = [True] * PULSE_PROCESSOR_N_BASE_STATIONS
+
 class pulseProcessorBaseStationMeasuremnt_t:
     def __init__(self):
         self.angles = [0.0] * PULSE_PROCESSOR_N_SWEEPS
-        correctedAngles = [0.0] * PULSE_PROCESSOR_N_SWEEPS
-        validCount = 0
+        self.correctedAngles = [0.0] * PULSE_PROCESSOR_N_SWEEPS
+        self.validCount = 0
 
 class pulseProcessorSensorMeasurement_t:
     def __init__(self):
@@ -121,10 +139,18 @@ class pulseProcessorResult_t:
         for i in range(PULSE_PROCESSOR_N_SENSORS):
             self.sensorMeasurements.append(pulseProcessorSensorMeasurement_t())
 
+        # Base stations with angles set since the last clear_angles(), only these
+        # entries have to be cleared
+        self.isBaseStationDirty = [False] * PULSE_PROCESSOR_N_BASE_STATIONS
+        self.dirtyBaseStations = []
+        # Timestamp of the first pulse of the second sweep of each base station
+        self.timestamps = [0] * PULSE_PROCESSOR_N_BASE_STATIONS
+
 class pulseProcessorV2SweepBlock_t:
     def __init__(self):
         self.offset = [0] * PULSE_PROCESSOR_N_SENSORS
         self.timestamp = None  # Timestamp of offset start, that is when the rotor is starting a new revolution
+        self.firstTimestamp = None  # Timestamp of the first pulse, the ts of a decodeV2.py block
         self.channel = None
         self.slowbit = None
 
@@ -137,6 +163,21 @@ def TS_DIFF(a, b):
 def TS_ABS_DIFF_LARGER_THAN(a, b, limit):
     return TS_DIFF(a + limit, b) > limit * 2
 
+def print_err(reason, s, channel=NO_CHANNEL):
+    if discards is not None:
+        discards.count(reason, None if channel == NO_CHANNEL else channel)
+
+    # Enable this print to see why a block is discarded
+    # print(s)
+
+# Returns the first channel found in a range of slots, used to count discards per channel
+def findChannel(pulseWorkspace, firstSlot, nrOfSlots):
+    for slotNr in range(firstSlot, firstSlot + nrOfSlots):
+        frame = pulseWorkspace.slots[slotNr]
+        if frame.channelFound:
+            return frame.channel
+    return NO_CHANNEL
+
 def processWorkspaceBlock(pulseWorkspace, blockBaseIndex, block):
     # Check that we have data for all sensors
     sensorMask = 0
@@ -146,6 +187,8 @@ def processWorkspaceBlock(pulseWorkspace, blockBaseIndex, block):
         sensorMask |= 1 << frame.sensor
     if sensorMask != 0xf:
         # All sensors not present - discard
+        print_err(discard_stats.SENSOR_MISSING, "Sensor missing - discard block",
+                  findChannel(pulseWorkspace, blockBaseIndex, PULSE_PROCESSOR_N_SENSORS))
         return False
 
     # Channel - should all be the same or not set
@@ -161,10 +204,12 @@ def processWorkspaceBlock(pulseWorkspace, blockBaseIndex, block):
 
             if not block.channel == sensor.channel:
                 # Multiple channels in the block - discard
+                print_err(discard_stats.DUPLICATE_CHANNEL, "Duplicate channels - discard block", block.channel)
                 return False;
 
     if block.channel == NO_CHANNEL:
         # Channel is missing - discard
+        print_err(discard_stats.CHANNEL_MISSING, "Channel missing - discard block")
         return False
 
     # Offset - should be offset on one and only one sensor
@@ -177,10 +222,12 @@ def processWorkspaceBlock(pulseWorkspace, blockBaseIndex, block):
                 indexWithOffset = slotNr
             else:
                 # Duplicate offsets - discard
+                print_err(discard_stats.DUPLICATE_OFFSET, "Duplicate offset - discard block", block.channel)
                 return False
 
     if indexWithOffset == NO_SENSOR:
         # No offset found - discard
+        print_err(discard_stats.NO_OFFSET, "No offset found - discard block", block.channel)
         return False
 
     # Calculate offsets for all sensors
@@ -189,12 +236,19 @@ def processWorkspaceBlock(pulseWorkspace, blockBaseIndex, block):
         slotNr = blockBaseIndex + i
         sensor = pulseWorkspace.slots[slotNr]
         if slotNr == indexWithOffset:
-            block.offset[i] = sensor.offset
+            block.offset[sensor.sensor] = sensor.offset
         else:
             timestamp_delta = TS_DIFF(baseSensor.timestamp, sensor.timestamp)
-            block.offset[i] = TS_DIFF(baseSensor.offset, timestamp_delta)
+            block.offset[sensor.sensor] = TS_DIFF(baseSensor.offset, timestamp_delta)
 
     block.timestamp = TS_DIFF(baseSensor.timestamp, baseSensor.offset)
+
+    # The first pulse, the timestamps wrap
+    block.firstTimestamp = baseSensor.timestamp
+    for i in range(PULSE_PROCESSOR_N_SENSORS):
+        sensor = pulseWorkspace.slots[blockBaseIndex + i]
+        if TS_DIFF(block.firstTimestamp, sensor.timestamp) < 0x800000:
+            block.firstTimestamp = sensor.timestamp
     return True
 
 def processWorkspace(pulseWorkspace, blocks):
@@ -221,10 +275,14 @@ def processWorkspace(pulseWorkspace, blocks):
 
     # We must have at least one block
     if slotsUsed < PULSE_PROCESSOR_N_SENSORS:
+        print_err(discard_stats.BAD_WORKSPACE, "Workspace too small - discard workspace",
+                  findChannel(pulseWorkspace, 0, slotsUsed))
         return 0
 
     # The number of slots used must be a multiple of the block size
     if not (slotsUsed % PULSE_PROCESSOR_N_SENSORS == 0):
+        print_err(discard_stats.BAD_WORKSPACE, "Workspace not full blocks - discard workspace",
+                  findChannel(pulseWorkspace, 0, slotsUsed))
         return 0
 
     # Process one block at a time in the workspace
@@ -232,7 +290,6 @@ def processWorkspace(pulseWorkspace, blocks):
     for blockNr in range(blocksInWorkspace):
         blockBaseIndex = blockNr * PULSE_PROCESSOR_N_SENSORS
         if not processWorkspaceBlock(pulseWorkspace, blockBaseIndex, blocks[blockNr]):
-            print("Broken block")
             return 0
 
     return blocksInWorkspace;
@@ -272,7 +329,8 @@ def processFrame(frameData, pulseWorkspace, blocks):
     pulseWorkspace.latestTimestamp = frameData.timestamp;
 
     if (not storePulse(frameData, pulseWorkspace)):
-        print("Workspace overflow")
+        print_err(discard_stats.WORKSPACE_OVERFLOW, "Workspace overflow - drop pulse",
+                  frameData.channel if frameData.channelFound else NO_CHANNEL)
         clearWorkspace(pulseWorkspace)
 
     return nrOfBlocks, isFirstFrameInNewWorkspace;
@@ -285,19 +343,55 @@ def calculateAzimuthElevation(firstBeam, secondBeam, angles):
     beta = (secondBeam - firstBeam) - a120
     angles[1] = math.atan(math.sin(beta / 2.0) / tan_p_2)
 
+def markBaseStationDirty(angles, baseStation):
+    if not angles.isBaseStationDirty[baseStation]:
+        angles.isBaseStationDirty[baseStation] = True
+        angles.dirtyBaseStations.append(baseStation)
+
 def calculateAngles(latestBlock, previousBlock, angles):
     channel = latestBlock.channel
+    markBaseStationDirty(angles, channel)
+    angles.timestamps[channel] = latestBlock.firstTimestamp
 
-    for i in range(PULSE_PROCESSOR_N_SENSORS):
-        firstOffset = previousBlock.offset[i]
-        secondOffset = latestBlock.offset[i]
-        period = CYCLE_PERIODS[channel]
+    if useAngleTables:
+        sensorAngles = angle_conversion.convert_pair(channel, previousBlock.offset, latestBlock.offset)
+        for i in range(PULSE_PROCESSOR_N_SENSORS):
+            measurement = angles.sensorMeasurements[i].baseStationMeasurements[channel]
+            measurement.angles[0], measurement.angles[1] = sensorAngles[i]
+            measurement.validCount = 2
+    else:
+        for i in range(PULSE_PROCESSOR_N_SENSORS):
+            firstOffset = previousBlock.offset[i]
+            secondOffset = latestBlock.offset[i]
+            period = CYCLE_PERIODS[channel]
+
+            firstBeam = firstOffset * 2 * math.pi / period
+            secondBeam = secondOffset * 2 * math.pi / period
 
-        firstBeam = firstOffset * 2 * math.pi / period
-        secondBeam = secondOffset * 2 * math.pi / period
+            calculateAzimuthElevation(firstBeam, secondBeam, angles.sensorMeasurements[i].baseStationMeasurements[channel].angles)
+            angles.sensorMeasurements[i].baseStationMeasurements[channel].validCount = 2
 
-        calculateAzimuthElevation(firstBeam, secondBeam, angles.sensorMeasurements[i].baseStationMeasurements[channel].angles)
-        angles.sensorMeasurements[i].baseStationMeasurements[channel].validCount = 2
+    if angleFilter:
+        filterAngles(angles, channel)
+
+# Runs the angles of a base station through angleFilter, the rejected sensors
+# get a validCount of 0
+def filterAngles(angles, channel):
+    ticks = frameTimeline.time_of(angles.timestamps[channel])
+    for i in range(PULSE_PROCESSOR_N_SENSORS):
+        measurement = angles.sensorMeasurements[i].baseStationMeasurements[channel]
+        filtered = angleFilter.push(channel, i, ticks, measurement.angles[0], measurement.angles[1])
+        if filtered is None:
+            measurement.validCount = 0
+        else:
+            measurement.angles[0], measurement.angles[1] = filtered
+
+def copyBlock(dest, src):
+    dest.offset[:] = src.offset
+    dest.timestamp = src.timestamp
+    dest.firstTimestamp = src.firstTimestamp
+    dest.channel = src.channel
+    dest.slowbit = src.slowbit
 
 def isBlockPairGood(latest, storage):
     if not latest.channel == storage.channel:
@@ -322,6 +416,9 @@ def processSlowBit(state, frameData):
 
             state.latestSlowbitTs[channel] = ts_zero
 
+            if slow_data is not None:
+                slow_data[channel].push(ts_zero, slowbit)
+
             if is_new_bit:
                 # print("slowbit", channel, ts_zero, slowbit)
                 # slowbitValidators[channel].push(ts_zero, slowbit)
@@ -336,6 +433,7 @@ def pulseProcessorV2ProcessPulse(state, frameData, angles):
 
     blocks = state.tempBlocks
     nrOfBlocks, isFirstFrameInNewWorkspace = processFrame(frameData, state.pulseWorkspace, blocks)
+    state.blockCount += nrOfBlocks
     for blockIndex in range(nrOfBlocks):
         block = blocks[blockIndex]
         channel = block.channel;
@@ -343,45 +441,49 @@ def pulseProcessorV2ProcessPulse(state, frameData, angles):
             previousBlock = state.blocksV2[channel]
             if (isBlockPairGood(block, previousBlock)):
                 calculateAngles(block, previousBlock, angles)
+                state.isBlockV2Paired[channel] = True
 
                 baseStation = block.channel;
                 axis = 'sweepDirection_y';
                 anglesMeasured = True;
                 print("--- second sweep chan:", channel)
             else:
-                state.blocksV2[channel] = copy.copy(block)
+                if not state.isBlockV2Paired[channel]:
+                    print_err(discard_stats.PAIR_MISMATCH, "No second sweep - discard first sweep", channel)
+                copyBlock(state.blocksV2[channel], block)
+                state.isBlockV2Paired[channel] = False
                 print("... first sweep chan:", channel)
 
-    if nrOfBlocks == 0:
-        if isFirstFrameInNewWorkspace:
-            print("... bad workspace")
     processSlowBit(state, frameData)
 
     return anglesMeasured, baseStation, axis;
 
 def clear_angles(angles):
-    for sensor in range(PULSE_PROCESSOR_N_SENSORS):
-        for bs in range(PULSE_PROCESSOR_N_BASE_STATIONS):
-            a = angles.sensorMeasurements[sensor].baseStationMeasurements[bs].angles
-            a[0] = 0
-            a[1] = 0
-
-def processUartFrame(appState, angles, frame):
+    for bs in angles.dirtyBaseStations:
+        for sensor in range(PULSE_PROCESSOR_N_SENSORS):
+            measurement = angles.sensorMeasurements[sensor].baseStationMeasurements[bs]
+            measurement.angles[0] = 0
+            measurement.angles[1] = 0
+            measurement.validCount = 0
+        angles.isBaseStationDirty[bs] = False
+    del angles.dirtyBaseStations[:]
+
+def processUartFrame(appState, angles, frame, writer=None):
     clear_angles(angles)
     resultOk, basestation, axis = pulseProcessorV2ProcessPulse(appState, frame.data, angles)
     if (resultOk):
-        print_angles(angles)
+        if writer:
+            # A frame can complete the pairs of several base stations
+            for bs in angles.dirtyBaseStations:
+                write_angles(writer, appState, angles, bs)
+        else:
+            print_angles(angles)
 
 def getUartFrameRaw(frame, data):
-    syncCounter = 0
+    first_word, offset_6, beam_word, timestamp = unpack_frame(data)
 
-    for d in data:
-        if d == 0xff:
-            syncCounter += 1
+    frame.isSyncFrame = (first_word == offset_6 == beam_word == timestamp == 0xffffff);
 
-    frame.isSyncFrame = (syncCounter == UART_FRAME_LENGTH);
-
-    first_word = struct.unpack("<I", data[:3] + b'\x00')[0]
     frame.data.sensor = first_word & 0x03
     frame.data.channelFound = ((first_word >> 7) & 0x01) == 0
 
@@ -391,10 +493,9 @@ def getUartFrameRaw(frame, data):
 
     # Offset is expressed in a 6 MHz clock, while the timestamp uses a 24 MHz clock.
     # update offset to a 24 MHz clock
-    offset_6 = struct.unpack("<I", data[3:6] + b'\x00')[0]
     frame.data.offset = offset_6 * 4
 
-    frame.data.timestamp = struct.unpack("<I", data[9:] + b'\x00')[0]
+    frame.data.timestamp = timestamp
 
     isPaddingZero = (((data[5] | data[8]) & 0xfe) == 0);
     isFrameValid = (isPaddingZero or frame.isSyncFrame);
@@ -424,50 +525,151 @@ def print_workspace(pulseWorkspace):
 def print_block(block):
     print("Block: ts:", block.timestamp, "chan:", block.channel, "sb:", block.slowbit, "offset:", block.offset)
 
+# Prints the angles of the base stations measured since the last clear_angles()
 def print_angles(angles):
+    for bs in angles.dirtyBaseStations:
+        print("bs:{:2d} ".format(bs), end='')
+        for sensor in range(PULSE_PROCESSOR_N_SENSORS):
+            measurement = angles.sensorMeasurements[sensor].baseStationMeasurements[bs]
+            # Rejected by the angle filter
+            if measurement.validCount == 0:
+                continue
+            a = measurement.angles
+            print("s:{} [{:-6.3f}, {:-6.3f}]  ".format(sensor, a[0], a[1]), end='')
+        print()
+
+
+# Writes the angles of a base station with the timestamp of its second
+# sweep, as decodeV2.py does
+def write_angles(writer, state, angles, basestation):
+    sensorAngles = []
     for sensor in range(PULSE_PROCESSOR_N_SENSORS):
-        print("s:{} ".format(sensor), end='')
-        for bs in range(PULSE_PROCESSOR_N_BASE_STATIONS):
-            a = angles.sensorMeasurements[sensor].baseStationMeasurements[bs].angles
-            print("[{:-6.3f}, {:-6.3f}]".format(a[0], a[1]), end='')
-        print("  ", end='')
-    print()
+        measurement = angles.sensorMeasurements[sensor].baseStationMeasurements[basestation]
+        if measurement.validCount == 0:
+            # Rejected by the angle filter
+            sensorAngles.append(None)
+        else:
+            sensorAngles.append((measurement.angles[0], measurement.angles[1]))
 
+    # Both sweeps of a pair have the same slow bit
+    slowbit = state.blocksV2[basestation].slowbit
+    writer.write(angles.timestamps[basestation], basestation, slowbit, sensorAngles)
 
 
 if __name__ == "__main__":
     import sys
-    import struct
-    if len(sys.argv) < 2:
-        print("Usage: {} <input.bin or /dev/tty...>".format(sys.argv[0]))
-        exit(1)
+    import framing
+    # --angle-tables: convert angles with the precomputed tables of angle_conversion.py
+    # --base-stations=N: number of base stations to decode
+    # --discard-stats=FILE: write discard counters to FILE as JSON lines, see discard_stats.py
+    # --ootx: decode the calibration data in the slow bits, cached between runs, see ootx.py
+    # --filter: reject outliers and smooth the angles, see angle_filter.py
+    # --record=FILE: write the frames read from the deck to a compressed capture, see capture_file.py
+    # --reorder[=US]: sort the frames by timestamp, holding them US microseconds, see reorder.py
+    snapshotWriter = None
+    recordFile = None
+    reorderBuffer = None
+    args = []
+    for arg in sys.argv[1:]:
+        if arg == "--angle-tables":
+            useAngleTables = True
+        elif arg.startswith("--base-stations="):
+            PULSE_PROCESSOR_N_BASE_STATIONS = int(arg.split("=")[1])
+        elif arg.startswith("--discard-stats="):
+            discards = discard_stats.DiscardStats()
+            snapshotWriter = discard_stats.SnapshotWriter(discards, open(arg.split("=", 1)[1], "w"))
+        elif arg == "--ootx":
+            import ootx
+            slow_data = ootx.cached_slow_data()
+        elif arg == "--filter":
+            import angle_filter
+            import timeline
+            angleFilter = angle_filter.AngleFilter()
+            frameTimeline = timeline.Unwrapper()
+        elif arg.startswith("--record="):
+            recordFile = arg.split("=", 1)[1]
+        elif arg == "--reorder" or arg.startswith("--reorder="):
+            import reorder
+            if "=" in arg:
+                reorderBuffer = reorder.ReorderBuffer(reorder.us_to_ticks(float(arg.split("=", 1)[1])))
+            else:
+                reorderBuffer = reorder.ReorderBuffer()
+        else:
+            args.append(arg)
 
-    if sys.argv[1].startswith("/dev/"):
-        src = serial.Serial(sys.argv[1], 2*115200)
-    else:
-        src = open(sys.argv[1], "rb")
+    if len(args) < 1 or not (0 < PULSE_PROCESSOR_N_BASE_STATIONS <= MAX_BASE_STATIONS):
+        print("Usage: {} [--angle-tables] [--base-stations=N] [--discard-stats=FILE] [--ootx] [--filter] [--record=FILE] [--reorder[=US]] <input.bin, input.lhc or /dev/tty...> [output.lha]".format(sys.argv[0]))
+        exit(1)
 
-    print("Waiting for sync ...")
-    sync = [b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff']
-    syncBuffer = [b'\x00'] * len(sync)
-    while sync != syncBuffer:
-        b = src.read(1)
-        if len(b) < 1:
-            sys.exit(1)
-        syncBuffer.append(b)
-        syncBuffer = syncBuffer[1:]
+    if recordFile and not args[0].startswith("/dev/"):
+        print("--record=FILE records the frames read from a deck, not from {}".format(args[0]))
+        exit(1)
 
-    print("Found sync!")
+    # Write the angles to a binary angle file instead of printing them
+    writer = None
+    if len(args) > 1:
+        import angle_file
+        writer = angle_file.AngleWriter(args[1])
+
+    recorder = None
+    if args[0].startswith("/dev/"):
+        import serial
+        src = serial.Serial(args[0], 2*115200, timeout=framing.SERIAL_TIMEOUT)
+        if recordFile:
+            import capture_file
+            recorder = capture_file.CaptureWriter(recordFile, flush_seconds=capture_file.RECORD_FLUSH_SECONDS)
+        # The frames held are released when the deck goes quiet
+        if reorderBuffer:
+            reorderBuffer.max_delay = reorder.LIVE_MAX_DELAY
+    else:
+        import capture_file
+        src = capture_file.open_capture(args[0])
 
     state = pulseProcessor_t()
     angles = pulseProcessorResult_t()
 
-    uartData = src.read(12)
-    while(len(uartData) == 12):
+    def handleFrame(uartData):
         frame = lighthouseUartFrame_t()
         getUartFrameRaw(frame, uartData)
         if not frame.isSyncFrame:
-            processUartFrame(state, angles, frame);
+            processUartFrame(state, angles, frame, writer);
             # print_frame(frame.data)
+        if frameTimeline:
+            frameTimeline.push_frame(uartData)
+        if snapshotWriter:
+            snapshotWriter.poll()
+
+    # Called when no data is received from the deck for framing.SERIAL_TIMEOUT
+    def onIdle():
+        if reorderBuffer:
+            for uartData in reorderBuffer.poll():
+                handleFrame(uartData)
+        if recorder:
+            recorder.poll()
 
-        uartData = src.read(12)
+    print("Waiting for sync ...")
+    frame_sync = framing.FrameSync(on_sync=lambda: print("Found sync!"))
+    frames = framing.FrameReader(src, frame_sync, on_idle=onIdle if args[0].startswith("/dev/") else None)
+    if recorder:
+        frames = recorder.record(frames)
+    if reorderBuffer:
+        frames = reorder.reorder_frames(frames, reorderBuffer)
+    try:
+        for uartData in frames:
+            handleFrame(uartData)
+    finally:
+        if recorder:
+            recorder.close()
+        if writer:
+            writer.close()
+        if snapshotWriter:
+            snapshotWriter.write()
+        if reorderBuffer:
+            print(reorderBuffer.report(), file=sys.stderr)
+        if angleFilter:
+            print("Angle filter:", file=sys.stderr)
+            print(angleFilter.report(), file=sys.stderr)
+
+    # Losing the sync in garbage at the end of a capture is not an error
+    if frame_sync.frames == 0:
+        sys.exit(1)
@@ -0,0 +1,97 @@
+# Decoders of the tools as a library
+#
+# The decoding tools are scripts that can also be imported, their command
+# line part is only run as __main__. This module gathers what is needed to
+# decode frames from other scripts, benchmarks and notebooks:
+#
+#   * Framing: FrameSync, FrameReader, read_frames(), unpack_frame(),
+#     parse_pulse(), bulk_decode and ReorderBuffer to sort the pulses
+#   * decodeV2.py: PulseProcessor, BaseStation and the Angles they produce,
+#     wrapped by V2Decoder
+#   * decodeV2_cf.py, the mirror of the Crazyflie firmware:
+#     pulseProcessorV2ProcessPulse() and its state, wrapped by CfDecoder
+#   * Angle math: calculateAE(), convert_pair() and convert_batch()
+#
+# pyserial is only needed to read from a deck. The decoders print the blocks
+# they drop and the sweeps they pair, quiet() silences them.
+
+import contextlib
+import os
+
+import bulk_decode
+import decodeV2
+import decodeV2_cf
+from angle_conversion import convert_batch, convert_pair
+from decodeV2 import Angles, BaseStation, PulseProcessor, SweepAngles, calculateAE, parse_pulse, rotor_start
+from decodeV2_cf import pulseProcessorV2ProcessPulse
+from framing import FrameReader, FrameSync, read_frames, unpack_frame
+from reorder import ReorderBuffer
+
+N_CHANNELS = 16
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+# Counts the blocks discarded by the decoders in the DiscardStats given, the
+# counters are module globals of the decoders and are restored on exit
+@contextlib.contextmanager
+def count_discards(v2_discards=None, cf_discards=None):
+    saved = decodeV2.discards, decodeV2_cf.discards
+    decodeV2.discards = v2_discards
+    decodeV2_cf.discards = cf_discards
+    try:
+        yield
+    finally:
+        decodeV2.discards, decodeV2_cf.discards = saved
+
+
+# Decodes frames with decodeV2.py
+class V2Decoder:
+    def __init__(self, use_angle_tables=False, recover_channels=False):
+        self.pulse_processor = PulseProcessor(recover_channels)
+        self.base_stations = [BaseStation(i, use_angle_tables) for i in range(N_CHANNELS)]
+        self.blocks = 0
+        # Rotor start of the latest sweep block
+        self.rotor = None
+
+    # Returns the Angles completed by a frame or None
+    def push(self, frame):
+        pulse = parse_pulse(frame)
+        if not pulse:
+            return None
+        block = self.pulse_processor.push(*pulse)
+        if not block:
+            return None
+        self.blocks += 1
+        self.rotor = rotor_start(block)
+        return self.base_stations[block.channel].push(block)
+
+
+# Decodes frames with decodeV2_cf.py
+class CfDecoder:
+    def __init__(self):
+        self.state = decodeV2_cf.pulseProcessor_t()
+        self.angles = decodeV2_cf.pulseProcessorResult_t()
+        self.frame = decodeV2_cf.lighthouseUartFrame_t()
+
+    # Returns the pulseProcessorResult_t when a frame completes angles or
+    # None. The result is reused for the next frames, the rotor start of the
+    # angles of a base station is state.blocksV2[channel].timestamp.
+    def push(self, frame):
+        decodeV2_cf.getUartFrameRaw(self.frame, frame)
+        if self.frame.isSyncFrame:
+            return None
+
+        decodeV2_cf.clear_angles(self.angles)
+        measured, _, _ = pulseProcessorV2ProcessPulse(self.state, self.frame.data, self.angles)
+        if not measured:
+            return None
+        return self.angles
+
+    @property
+    def blocks(self):
+        return self.state.blockCount
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# Differential test of decodeV2.py against decodeV2_cf.py
+#
+# Runs the same capture through both decoders, pairs the angles they produce
+# by channel and rotor start time, and reports how many results only one of
+# the decoders produced, the angle differences per sensor and why blocks were
+# discarded. The capture is streamed, results that are not matched within
+# PENDING_TIMEOUT ticks are counted as unmatched and dropped.
+#
+# Exits with status 1 if a matched angle differs more than the tolerance.
+
+import math
+import sys
+from collections import deque
+
+import capture_file
+import decoders
+import discard_stats
+import framing
+import timeline
+
+N_SENSORS = 4
+N_CHANNELS = 16
+
+# Rotor start times closer than this are the same sweep pair
+MATCH_TICKS = 1000
+PENDING_TIMEOUT = 24000000
+EXPIRE_INTERVAL_FRAMES = 1024
+
+DEFAULT_TOLERANCE_DEG = 0.01
+
+
+class DiffStats:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.max = 0.0
+
+    def add(self, diff):
+        diff = abs(diff)
+        self.count += 1
+        self.sum += diff
+        self.sum_sq += diff * diff
+        if diff > self.max:
+            self.max = diff
+
+    def summary(self):
+        if self.count == 0:
+            return "-"
+        mean = self.sum / self.count
+        rms = math.sqrt(self.sum_sq / self.count)
+        return "max {:.3g} mean {:.3g} rms {:.3g} deg".format(
+            math.degrees(self.max), math.degrees(mean), math.degrees(rms))
+
+
+# Returns the results of a decoders.V2Decoder for a frame as a list of
+# (channel, rotor start, angles)
+def v2_results(decoder, frame):
+    angles = decoder.push(frame)
+    if not angles:
+        return ()
+    return ((angles.channel, decoder.rotor, angles.data),)
+
+
+# The same for a decoders.CfDecoder, the angles are copied as its result is
+# reused
+def cf_results(decoder, frame):
+    angles = decoder.push(frame)
+    if not angles:
+        return ()
+
+    results = []
+    for bs in angles.dirtyBaseStations:
+        sensor_angles = []
+        for sensor in range(N_SENSORS):
+            a = angles.sensorMeasurements[sensor].baseStationMeasurements[bs].angles
+            sensor_angles.append((a[0], a[1]))
+        results.append((bs, decoder.state.blocksV2[bs].timestamp, sensor_angles))
+    return results
+
+
+class DiffHarness:
+    def __init__(self):
+        self.decoders = [decoders.V2Decoder(), decoders.CfDecoder()]
+        self.names = ["decodeV2", "decodeV2_cf"]
+        self.results_of = [v2_results, cf_results]
+        # Set as the discard counters of the decoders by counting()
+        self.discards = [discard_stats.DiscardStats() for _ in self.decoders]
+
+        # Results waiting for the other decoder, per decoder and channel, as
+        # (unwrapped rotor start, angles)
+        self.pending = [[deque() for _ in range(N_CHANNELS)] for _ in self.decoders]
+        self.unmatched = [0 for _ in self.decoders]
+        self.results = [0 for _ in self.decoders]
+        self.matched = 0
+
+        self.azimuth = [DiffStats() for _ in range(N_SENSORS)]
+        self.elevation = [DiffStats() for _ in range(N_SENSORS)]
+
+        self.timeline = timeline.Unwrapper()
+        self.frames = 0
+
+    def _add(self, index, channel, rotor, angles):
+        self.results[index] += 1
+        other = 1 - index
+        pending = self.pending[other][channel]
+        while pending:
+            other_rotor, other_angles = pending[0]
+            if other_rotor < rotor - MATCH_TICKS:
+                # The other decoder has no result for this sweep pair
+                pending.popleft()
+                self.unmatched[other] += 1
+                continue
+
+            if other_rotor <= rotor + MATCH_TICKS:
+                pending.popleft()
+                self._compare(angles, other_angles)
+                return
+            break
+
+        self.pending[index][channel].append((rotor, angles))
+
+    def _compare(self, a, b):
+        self.matched += 1
+        for sensor in range(N_SENSORS):
+            self.azimuth[sensor].add(a[sensor][0] - b[sensor][0])
+            self.elevation[sensor].add(a[sensor][1] - b[sensor][1])
+
+    def _expire(self, limit):
+        for index, channels in enumerate(self.pending):
+            for pending in channels:
+                while pending and pending[0][0] < limit:
+                    pending.popleft()
+                    self.unmatched[index] += 1
+
+    def push(self, frame):
+        now = self.timeline.push_frame(frame)
+        for index, decoder in enumerate(self.decoders):
+            for channel, rotor, angles in self.results_of[index](decoder, frame):
+                self._add(index, channel, self.timeline.time_of(rotor), angles)
+
+        self.frames += 1
+        if now is not None and self.frames % EXPIRE_INTERVAL_FRAMES == 0:
+            self._expire(now - PENDING_TIMEOUT)
+
+    # Context manager counting the discards of the decoders while decoding
+    def counting(self):
+        return decoders.count_discards(*self.discards)
+
+    def finish(self):
+        self._expire(float("inf"))
+
+    def max_diff(self):
+        return max(stats.max for stats in self.azimuth + self.elevation)
+
+    def report(self):
+        print("Frames:  {}".format(self.frames))
+        print("Matched: {}".format(self.matched))
+        for index, decoder in enumerate(self.decoders):
+            name = self.names[index]
+            print("{:12} blocks: {}  results: {}  only in {}: {}".format(
+                name, decoder.blocks, self.results[index], name, self.unmatched[index]))
+
+        for sensor in range(N_SENSORS):
+            print("Sensor {} azimuth:   {}".format(sensor, self.azimuth[sensor].summary()))
+            print("Sensor {} elevation: {}".format(sensor, self.elevation[sensor].summary()))
+
+        for name, discards in zip(self.names, self.discards):
+            print("{} discards:".format(name))
+            for reason, count in discards.reasons.items():
+                if count:
+                    print("  {:20} {}".format(reason, count))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare decodeV2.py and decodeV2_cf.py on a capture")
+    parser.add_argument("input", help="capture.bin or capture.lhc")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE_DEG,
+                        help="max angle difference in degrees, default {}".format(DEFAULT_TOLERANCE_DEG))
+    args = parser.parse_args()
+
+    harness = DiffHarness()
+    frame_sync = framing.FrameSync()
+
+    # Both decoders print while decoding
+    with decoders.quiet(), harness.counting(), capture_file.open_capture(args.input) as src:
+        for frame in framing.FrameReader(src, frame_sync):
+            harness.push(frame)
+    harness.finish()
+
+    harness.report()
+    if frame_sync.bad_frames:
+        print("Bad frames: {}".format(frame_sync.bad_frames))
+
+    if harness.max_diff() > math.radians(args.tolerance):
+        print("FAIL: angle difference larger than {} deg".format(args.tolerance))
+        sys.exit(1)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Counters of the pulses and blocks the decoders discard
+#
+# decodeV2.py and decodeV2_cf.py count each discard by reason and channel in
+# a DiscardStats object set as the module level "discards", or do nothing but
+# a None check if it is not set. SnapshotWriter writes the counters as one
+# JSON object per line, for instance:
+#
+#   {"time": 1700000000.1, "total": 12, "reasons": {"sensor_missing": 10, ...},
+#    "channels": {"sensor_missing": [0, 10, 0, ...], ...}, "no_channel": {...}}
+#
+# Counters are cumulative since the start. Channels are zero indexed (0-15),
+# discards where the channel is not known are counted in "no_channel".
+
+import json
+import time
+
+SENSOR_MISSING = "sensor_missing"
+DUPLICATE_SENSOR = "duplicate_sensor"
+DUPLICATE_CHANNEL = "duplicate_channel"
+CHANNEL_MISSING = "channel_missing"
+DUPLICATE_OFFSET = "duplicate_offset"
+NO_OFFSET = "no_offset"
+BAD_WORKSPACE = "bad_workspace"
+WORKSPACE_OVERFLOW = "workspace_overflow"
+PAIR_MISMATCH = "pair_mismatch"
+
+REASONS = (SENSOR_MISSING, DUPLICATE_SENSOR, DUPLICATE_CHANNEL, CHANNEL_MISSING, DUPLICATE_OFFSET,
+           NO_OFFSET, BAD_WORKSPACE, WORKSPACE_OVERFLOW, PAIR_MISMATCH)
+
+N_CHANNELS = 16
+SNAPSHOT_INTERVAL = 1.0
+
+
+class DiscardStats:
+    def __init__(self):
+        self.reasons = dict.fromkeys(REASONS, 0)
+        self.channels = {reason: [0] * N_CHANNELS for reason in REASONS}
+        self.no_channel = dict.fromkeys(REASONS, 0)
+
+    def count(self, reason, channel=None):
+        self.reasons[reason] += 1
+        if channel is not None and 0 <= channel < N_CHANNELS:
+            self.channels[reason][channel] += 1
+        else:
+            self.no_channel[reason] += 1
+
+    def total(self):
+        return sum(self.reasons.values())
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "total": self.total(),
+            "reasons": dict(self.reasons),
+            "channels": {reason: list(counts) for reason, counts in self.channels.items()},
+            "no_channel": dict(self.no_channel),
+        }
+
+
+# Writes a snapshot of the counters when poll() is called and at least
+# interval seconds have passed since the previous one
+class SnapshotWriter:
+    def __init__(self, stats, file, interval=SNAPSHOT_INTERVAL):
+        self.stats = stats
+        self.file = file
+        self.interval = interval
+        self.next_snapshot = time.monotonic() + interval
+
+    def poll(self):
+        now = time.monotonic()
+        if now >= self.next_snapshot:
+            self.next_snapshot = now + self.interval
+            self.write()
+
+    def write(self):
+        self.file.write(json.dumps(self.stats.snapshot()) + "\n")
+        self.file.flush()
+
+
+if __name__ == "__main__":
+    # Summarizes the latest snapshot of a JSON lines file
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: {} <discards.jsonl>".format(sys.argv[0]))
+        exit(1)
+
+    snapshot = None
+    with open(sys.argv[1]) as f:
+        for line in f:
+            if line.strip():
+                snapshot = json.loads(line)
+
+    if not snapshot:
+        print("No snapshots")
+        exit(1)
+
+    print("Total: {}".format(snapshot["total"]))
+    for reason in REASONS:
+        count = snapshot["reasons"].get(reason, 0)
+        if count:
+            channels = ["{}:{}".format(channel + 1, n) for channel, n in enumerate(snapshot["channels"][reason]) if n]
+            if snapshot["no_channel"][reason]:
+                channels.append("-:{}".format(snapshot["no_channel"][reason]))
+            print("  {:20} {:8}  {}".format(reason, count, " ".join(channels)))
@@ -0,0 +1,287 @@
+# UART framing shared by the decoding tools.
+#
+# Data received from the deck is buffered and split in 12 bytes frames. The
+# first frame boundary is found by searching for the 'all-ones' sync frame,
+# then the padding bits of every frame are checked as described in the readme.
+# When the padding bits are not zero, the frame boundary is recovered by
+# testing the 12 possible alignments against the padding bits and timestamps
+# of the next frames instead of waiting for the next sync frame. If no
+# alignment is good, we fall back to waiting for the next sync frame.
+#
+# FrameReader reads into a preallocated buffer and returns the frames as
+# memoryviews of it, unpack_frame() decodes the fields of a frame with one
+# precompiled struct, so that reading and parsing a frame copies nothing.
+
+import struct
+
+UART_FRAME_LENGTH = 12
+SYNC_FRAME = b'\xff' * UART_FRAME_LENGTH
+
+# Number of consecutive frames that must have valid padding bits to accept
+# a new alignment
+RESYNC_FRAMES = 4
+RESYNC_WINDOW = UART_FRAME_LENGTH * (RESYNC_FRAMES + 1)
+# Max timestamp difference between consecutive frames in a new alignment, the
+# width high byte is almost always 0 so the padding bits are not enough to
+# reject all wrong alignments.
+MAX_RESYNC_TS_DELTA = 24000000 // 25
+
+READ_CHUNK_SIZE = 4096
+READ_BUFFER_SIZE = 1 << 16
+# Seconds a read from a deck waits for data, so that the decoders can release
+# what they hold when the deck goes quiet
+SERIAL_TIMEOUT = 0.05
+
+# The four little endian 24 bits fields of a frame, read as three 32 bits
+# words
+FRAME_WORDS = struct.Struct("<III")
+
+
+def is_padding_zero(data, start):
+    return ((data[start + 5] | data[start + 8]) & 0xfe) == 0
+
+
+def is_sync_frame(data, start):
+    return data[start:start + UART_FRAME_LENGTH] == SYNC_FRAME
+
+
+def is_frame_valid(data, start):
+    return is_padding_zero(data, start) or is_sync_frame(data, start)
+
+
+# Returns the position of the first frame following a sync frame, or -1 if no
+# sync frame was found. A frame with 0xff in its last bytes (ie. timestamp) or
+# in its first bytes can extend the run of 0xff, the padding bits of the
+# following frame are used to find the actual boundary.
+# Only the data before end is searched, if given.
+def find_sync(data, start=0, end=None):
+    if end is None:
+        end = len(data)
+    while True:
+        pos = data.find(SYNC_FRAME, start, end)
+        if pos < 0:
+            return -1
+
+        run_end = pos + UART_FRAME_LENGTH
+        while run_end < end and data[run_end] == 0xff:
+            run_end += 1
+
+        for candidate in range(pos + UART_FRAME_LENGTH, run_end + 1):
+            if candidate + UART_FRAME_LENGTH > end:
+                return candidate
+            if is_padding_zero(data, candidate):
+                return candidate
+
+        start = run_end
+
+
+def frame_timestamp(data, start):
+    return data[start + 9] | (data[start + 10] << 8) | (data[start + 11] << 16)
+
+
+# Returns the first word, offset, beam word and timestamp of the frame at
+# start, all four are 0xffffff in a sync frame
+def unpack_frame(data, start=0):
+    low, middle, high = FRAME_WORDS.unpack_from(data, start)
+    return (low & 0xffffff, (low >> 24) | ((middle & 0xffff) << 8),
+            (middle >> 16) | ((high & 0xff) << 16), high >> 8)
+
+
+# Called when the frame at pos has invalid padding bits. Returns the number of
+# bytes to skip to get back on a frame boundary, or None if no alignment is
+# good. UART_FRAME_LENGTH means that the alignment is fine and only the frame
+# at pos is broken. Needs RESYNC_WINDOW bytes of data from pos.
+def find_alignment(data, pos):
+    for shift in [UART_FRAME_LENGTH] + list(range(1, UART_FRAME_LENGTH)):
+        if is_alignment_good(data, pos + shift):
+            return shift
+
+    return None
+
+
+def is_alignment_good(data, start):
+    previous_ts = None
+    for i in range(RESYNC_FRAMES):
+        frame_start = start + i * UART_FRAME_LENGTH
+        if is_sync_frame(data, frame_start):
+            continue
+        if not is_padding_zero(data, frame_start):
+            return False
+
+        ts = frame_timestamp(data, frame_start)
+        if previous_ts is not None and ((ts - previous_ts) & 0xffffff) > MAX_RESYNC_TS_DELTA:
+            return False
+        previous_ts = ts
+
+    return True
+
+
+class FrameSync:
+    def __init__(self, on_sync=None):
+        self.synced = False
+        self._on_sync = on_sync
+        self._buffer = bytearray()
+
+        self.frames = 0
+        self.sync_frames = 0
+        self.bad_frames = 0
+        self.dropped_bytes = 0
+        self.resync_count = 0
+
+    # Adds received data and returns the list of complete frames, as bytes.
+    # Sync frames are returned as well, except the one used for the initial
+    # synchronization.
+    def feed(self, data):
+        buf = self._buffer
+        buf += data
+        frames = [bytes(buf[pos:pos + UART_FRAME_LENGTH]) for pos in self.scan(buf, 0, len(buf))]
+        del buf[:self.scan_end]
+        return frames
+
+    # Generator of the positions of the complete frames in buf[pos:end]. Once
+    # done, scan_end is where the data not used yet starts.
+    def scan(self, buf, pos, end):
+        while True:
+            if not self.synced:
+                start = find_sync(buf, pos, end)
+                if start < 0:
+                    # Keep what could be the beginning of a sync frame
+                    keep_from = max(pos, end - (UART_FRAME_LENGTH - 1))
+                    self.dropped_bytes += keep_from - pos
+                    pos = keep_from
+                    break
+                if start + UART_FRAME_LENGTH > end:
+                    # The frame boundary can not be verified yet, keep the
+                    # data from the sync frame
+                    self.dropped_bytes += start - UART_FRAME_LENGTH - pos
+                    pos = start - UART_FRAME_LENGTH
+                    break
+
+                self.dropped_bytes += start - UART_FRAME_LENGTH - pos
+                self.sync_frames += 1
+                self.synced = True
+                pos = start
+                if self._on_sync and self.frames == 0:
+                    self._on_sync()
+
+            if end - pos < UART_FRAME_LENGTH:
+                break
+
+            if is_padding_zero(buf, pos):
+                self.frames += 1
+                yield pos
+                pos += UART_FRAME_LENGTH
+            elif is_sync_frame(buf, pos):
+                self.frames += 1
+                self.sync_frames += 1
+                yield pos
+                pos += UART_FRAME_LENGTH
+            else:
+                if end - pos < RESYNC_WINDOW:
+                    break
+
+                self.bad_frames += 1
+                shift = find_alignment(buf, pos)
+                if shift is None:
+                    # Wait for the next sync frame
+                    self.synced = False
+                    continue
+                if shift != UART_FRAME_LENGTH:
+                    self.resync_count += 1
+
+                self.dropped_bytes += shift
+                pos += shift
+
+        self.scan_end = pos
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "sync_frames": self.sync_frames,
+            "bad_frames": self.bad_frames,
+            "dropped_bytes": self.dropped_bytes,
+            "resync_count": self.resync_count,
+        }
+
+
+# Do not block on a serial port waiting for a full chunk
+def read_size(src, size):
+    in_waiting = getattr(src, "in_waiting", None)
+    if in_waiting is not None:
+        size = min(size, max(in_waiting, UART_FRAME_LENGTH))
+    return size
+
+
+def read_chunk(src, size=READ_CHUNK_SIZE):
+    return src.read(read_size(src, size))
+
+
+# Generator of frames read from a file or serial port until the end of data
+def read_frames(src, frame_sync=None, chunk_size=READ_CHUNK_SIZE):
+    if frame_sync is None:
+        frame_sync = FrameSync()
+
+    while True:
+        data = read_chunk(src, chunk_size)
+        if len(data) == 0:
+            return
+
+        for frame in frame_sync.feed(data):
+            yield frame
+
+
+# Iterable of the frames read from a file or serial port until the end of
+# data, as read_frames() but without copies. The data is read with readinto()
+# in a buffer allocated once, or read() if src has no readinto(), and each
+# frame is a memoryview of the buffer that is only valid until the next frame
+# is requested: keep bytes(frame) to store it.
+class FrameReader:
+    def __init__(self, src, frame_sync=None, buffer_size=READ_BUFFER_SIZE, on_idle=None):
+        self.src = src
+        self.frame_sync = frame_sync if frame_sync is not None else FrameSync()
+        # Called when a read returns no data, the timeout of a serial port,
+        # then the reading goes on. Without it no data is the end of data.
+        self.on_idle = on_idle
+        self._buffer = bytearray(max(buffer_size, 2 * RESYNC_WINDOW))
+        self._view = memoryview(self._buffer)
+        self._end = 0
+
+    # Appends data from src to the buffer, returns the number of bytes read.
+    # The buffer is grown if scan() could not use any of its data, so that 0
+    # is only returned at the end of data.
+    def _read(self):
+        end = self._end
+        if end == len(self._buffer):
+            self._buffer = bytearray(2 * end)
+            self._buffer[:end] = self._view
+            self._view = memoryview(self._buffer)
+        size = read_size(self.src, len(self._buffer) - end)
+        readinto = getattr(self.src, "readinto", None)
+        if readinto is not None:
+            return readinto(self._view[end:end + size]) or 0
+
+        data = self.src.read(size)
+        self._buffer[end:end + len(data)] = data
+        return len(data)
+
+    def __iter__(self):
+        frame_sync = self.frame_sync
+
+        while True:
+            count = self._read()
+            if count == 0:
+                if self.on_idle is None:
+                    return
+                self.on_idle()
+                continue
+            buf = self._buffer
+            view = self._view
+            end = self._end + count
+
+            for pos in frame_sync.scan(buf, 0, end):
+                yield view[pos:pos + UART_FRAME_LENGTH]
+
+            # Move the data not used yet to the start, the buffer keeps its size
+            pos = frame_sync.scan_end
+            buf[:end - pos] = buf[pos:end]
+            self._end = end - pos
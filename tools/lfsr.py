@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+# LFSRs of the lighthouse V2 base stations
+#
+# Python version of SoftLfsr in Lighthouse.scala and of the LFSR search done
+# by PolyFinder and OffsetFinder in the FPGA. POLYS is constants.Polys in
+# utils.scala, poly n is used by channel n / 2 with slow bit n % 2.
+#
+# An LFSR iteration shifts the state one bit left and shifts in the parity of
+# state & poly. The offset of a state is the number of iterations from state 1.
+#
+# The offsets of all states for all polys are kept in an index, a (32, 2^17)
+# int32 array built once and cached on disk as a .npy file. The cache is
+# memory mapped, so looking up an offset is a single array access, also for
+# whole numpy arrays of states.
+
+import os
+
+POLYS = [0x0001D258, 0x00017E04,
+         0x0001FF6B, 0x00013F67,
+         0x0001B9EE, 0x000198D1,
+         0x000178C7, 0x00018A55,
+         0x00015777, 0x0001D911,
+         0x00015769, 0x0001991F,
+         0x00012BD0, 0x0001CF73,
+         0x0001365D, 0x000197F5,
+         0x000194A0, 0x0001B279,
+         0x00013A34, 0x0001AE41,
+         0x000180D4, 0x00017891,
+         0x00012E64, 0x00017C72,
+         0x00019C6D, 0x00013F32,
+         0x0001AE14, 0x00014E76,
+         0x00013C97, 0x000130CB,
+         0x00013750, 0x0001CB8D]
+
+STATE_BITS = 17
+STATE_MASK = (1 << STATE_BITS) - 1
+# All states but 0 are in the sequence
+SEQUENCE_LENGTH = (1 << STATE_BITS) - 1
+NO_OFFSET = -1
+NO_POLY = -1
+
+
+def iterate(state, poly):
+    b = bin(state & poly).count("1") & 1
+    return ((state << 1) | b) & STATE_MASK
+
+
+def state_at_offset(poly, offset):
+    state = 1
+    for _ in range(offset):
+        state = iterate(state, poly)
+    return state
+
+
+# Iterates numpy arrays of states and polys once
+def iterate_batch(states, polys):
+    b = states & polys
+    b ^= b >> 16
+    b ^= b >> 8
+    b ^= b >> 4
+    b ^= b >> 2
+    b ^= b >> 1
+    return ((states << 1) | (b & 1)) & STATE_MASK
+
+
+INDEX_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+                          "lighthouse", "lfsr_offsets.npy")
+# States checked against an LFSR walk when the cached index is loaded
+INDEX_CHECK_STEPS = 64
+
+_index = None
+_state_tables = {}
+
+
+def _build_index():
+    import numpy as np
+    index = np.full((len(POLYS), 1 << STATE_BITS), NO_OFFSET, dtype=np.int32)
+    offsets = np.arange(SEQUENCE_LENGTH, dtype=np.int32)
+    for poly_index, poly in enumerate(POLYS):
+        states = [0] * SEQUENCE_LENGTH
+        state = 1
+        for i in range(SEQUENCE_LENGTH):
+            states[i] = state
+            state = iterate(state, poly)
+        index[poly_index, states] = offsets
+    return index
+
+
+def _is_index_good(index):
+    if index.shape != (len(POLYS), 1 << STATE_BITS):
+        return False
+
+    for poly_index, poly in enumerate(POLYS):
+        if index[poly_index, 0] != NO_OFFSET:
+            return False
+        state = 1
+        for offset in range(INDEX_CHECK_STEPS):
+            if index[poly_index, state] != offset:
+                return False
+            state = iterate(state, poly)
+    return True
+
+
+# Returns the offset index, a (32, 2^17) array with the offset of each state
+# for each poly, NO_OFFSET for state 0. It is built and written to
+# index_file the first time.
+def offset_index(index_file=INDEX_FILE):
+    global _index
+    if _index is not None:
+        return _index
+
+    import numpy as np
+    try:
+        index = np.load(index_file, mmap_mode="r")
+        if index.dtype == np.int32 and _is_index_good(index):
+            _index = index
+            return _index
+    except (OSError, ValueError):
+        pass
+
+    index = _build_index()
+    try:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        tmp_file = "{}.{}.tmp".format(index_file, os.getpid())
+        with open(tmp_file, "wb") as f:
+            np.save(f, index)
+        os.replace(tmp_file, index_file)
+        index = np.load(index_file, mmap_mode="r")
+    except OSError:
+        # Not cached, use the index in memory
+        pass
+
+    _index = index
+    return _index
+
+
+# Returns the offset of each state for POLYS[poly_index]
+def offset_table(poly_index):
+    return offset_index()[poly_index]
+
+
+# Returns the state at each offset for POLYS[poly_index]
+def state_table(poly_index):
+    table = _state_tables.get(poly_index)
+    if table is None:
+        import numpy as np
+        offsets = offset_table(poly_index)
+        table = np.zeros(SEQUENCE_LENGTH, dtype=np.int32)
+        states = np.flatnonzero(offsets != NO_OFFSET)
+        table[offsets[states]] = states
+        _state_tables[poly_index] = table
+    return table
+
+
+# Returns the offset of a state for POLYS[poly_index] or None for state 0
+def find_offset(poly_index, state):
+    offset = offset_index()[poly_index, state]
+    if offset == NO_OFFSET:
+        return None
+    return int(offset)
+
+
+# Returns the offsets of numpy arrays of poly indexes and states, NO_OFFSET
+# for state 0
+def find_offsets(poly_indexes, states):
+    import numpy as np
+    return offset_index()[np.asarray(poly_indexes, dtype=np.intp), np.asarray(states, dtype=np.intp) & STATE_MASK]
+
+
+# Same search as PolyFinder: runs all LFSRs from start_state for max_tick
+# iterations and returns the index of the poly that reaches target_state in
+# the last 4 iterations, or None. If several polys match, the indexes are
+# or:ed as OHToUInt() does in the FPGA.
+def find_poly(start_state, target_state, max_tick):
+    states = [start_state] * len(POLYS)
+    for tick in range(max_tick + 1):
+        if tick >= max_tick - 3:
+            found = None
+            for poly_index, state in enumerate(states):
+                if state == target_state:
+                    found = poly_index if found is None else found | poly_index
+            if found is not None:
+                return found
+        states = [iterate(state, poly) for state, poly in zip(states, POLYS)]
+    return None
+
+
+# Batch version of find_poly() for numpy arrays of start states, target states
+# and distances between the pulses in ticks of the 24 MHz clock, the LFSR
+# iterates every 4 ticks. Returns the poly index of each pair or NO_POLY. The
+# search is done with the offset index, so there is no limit on the distance
+# as in the FPGA.
+def find_polys(start_states, target_states, ticks):
+    import numpy as np
+    index = offset_index()
+    start = index[:, np.asarray(start_states, dtype=np.intp) & STATE_MASK]
+    target = index[:, np.asarray(target_states, dtype=np.intp) & STATE_MASK]
+    max_tick = (np.asarray(ticks, dtype=np.int64) >> 2) + 2
+
+    # Number of iterations from the start to the target state, for each poly
+    iterations = (target.astype(np.int64) - start) % SEQUENCE_LENGTH
+    match = (start != NO_OFFSET) & (target != NO_OFFSET) & (iterations >= max_tick - 3) & (iterations <= max_tick)
+
+    # The FPGA stops at the first match, polys matching at the same iteration
+    # are or:ed
+    iterations[~match] = SEQUENCE_LENGTH
+    first = match & (iterations == iterations.min(axis=0))
+    polys = np.bitwise_or.reduce(np.where(first, np.arange(len(POLYS))[:, np.newaxis], 0), axis=0)
+    polys = np.where(match.any(axis=0), polys, NO_POLY)
+
+    # State 0 is not in the sequences but stays 0, all polys match
+    zero = (np.asarray(start_states) == 0) & (np.asarray(target_states) == 0)
+    polys[zero] = len(POLYS) - 1
+    return polys
+
+
+# Checks the offsets found by the FPGA in a capture against the index,
+# returns the number of checked and mismatching frames
+def check_capture(file_name):
+    import bulk_decode
+    frames = bulk_decode.load_capture(file_name)
+    mask = frames.pulse_mask() & frames.poly_ok & (frames.offset != 0)
+
+    poly_indexes = (frames.channel[mask].astype(int) << 1) | frames.slow_bit[mask]
+    offsets = find_offsets(poly_indexes, frames.beam_word[mask])
+    mismatch = offsets != frames.offset[mask] // 4
+    return int(mask.sum()), int(mismatch.sum())
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import random
+    import numpy as np
+
+    start = time.perf_counter()
+    offset_index()
+    print("Index:   {} ({:.1f} ms)".format(INDEX_FILE, (time.perf_counter() - start) * 1000))
+
+    if len(sys.argv) > 1:
+        # Cross-check the sync offsets of a capture
+        checked, mismatch = check_capture(sys.argv[1])
+        print("Offsets: {} checked, {} mismatch".format(checked, mismatch))
+        sys.exit(1 if mismatch else 0)
+
+    # Check the index against a plain LFSR walk and time the lookups
+    rnd = random.Random(1)
+    for poly_index in (0, 12, 31):
+        for _ in range(5):
+            offset = rnd.randrange(SEQUENCE_LENGTH)
+            state = state_at_offset(POLYS[poly_index], offset)
+            assert find_offset(poly_index, state) == offset
+            assert state_table(poly_index)[offset] == state
+
+    # Check the batch poly search against the LFSR walk of the FPGA
+    starts = []
+    targets = []
+    ticks = []
+    for _ in range(50):
+        poly_index = rnd.randrange(len(POLYS))
+        start = state_table(poly_index)[rnd.randrange(SEQUENCE_LENGTH)]
+        distance = rnd.randrange(4, 4000)
+        starts.append(start)
+        if rnd.randrange(4):
+            targets.append(state_table(poly_index)[(find_offset(poly_index, start) + distance // 4) % SEQUENCE_LENGTH])
+        else:
+            targets.append(rnd.randrange(1 << STATE_BITS))
+        ticks.append(distance)
+    for start, target, distance, poly in zip(starts, targets, ticks, find_polys(starts, targets, ticks)):
+        expected = find_poly(int(start), target, (distance >> 2) + 2)
+        assert poly == (NO_POLY if expected is None else expected)
+
+    count = 100000
+    poly_indexes = np.array([rnd.randrange(len(POLYS)) for _ in range(count)])
+    states = np.array([rnd.randrange(1, 1 << STATE_BITS) for _ in range(count)])
+
+    start = time.perf_counter()
+    for poly_index, state in zip(poly_indexes.tolist(), states.tolist()):
+        find_offset(poly_index, state)
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    find_offsets(poly_indexes, states)
+    batch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    find_polys(states, np.roll(states, 1), np.full(count, 1000))
+    poly_time = time.perf_counter() - start
+
+    print("find_offset:  {:.2f} us per state".format(scalar_time / count * 1e6))
+    print("find_offsets: {:.3f} us per state".format(batch_time / count * 1e6))
+    print("find_polys:   {:.3f} us per pair".format(poly_time / count * 1e6))
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Decodes several lighthouse decks at once
+#
+# One decoder worker process is started per deck, each reading its own serial
+# port or capture file and running PulseProcessor and BaseStation. The angles
+# are sent back to the supervisor in batches and merged into one time ordered
+# output tagged by deck.
+#
+# Each deck has its own 24 MHz clock, so the 24-bit timestamps of different
+# decks can not be compared. When decoding files, each deck timestamp is
+# unwrapped with timeline.py into a time since the start of its own capture
+# and the streams are merged on that time. For live serial ports the host arrival time is used
+# instead.
+
+import itertools
+import math
+import multiprocessing
+import queue
+import sys
+import time
+
+import framing
+import timeline
+from decodeV2 import PulseProcessor, BaseStation, parse_pulse, ts_sub
+
+BATCH_SIZE = 4096
+RESULT_QUEUE_SIZE = 1024
+READ_CHUNK_SIZE = 16384
+STATS_INTERVAL = 5.0
+# Time to wait for a silent deck before outputting results from the other decks
+MAX_MERGE_DELAY = 0.2
+SERIAL_TIMEOUT = 0.5
+
+
+def is_live_source(source):
+    return source.startswith("/dev/")
+
+
+# Yields batches of pulses, with the time of each pulse in ticks since the
+# start of the capture for files, None for live sources
+def pulse_batches(source):
+    if is_live_source(source):
+        import serial
+        src = serial.Serial(source, 2*115200, timeout=SERIAL_TIMEOUT)
+        frame_sync = framing.FrameSync()
+        while True:
+            pulses = []
+            for frame in frame_sync.feed(framing.read_chunk(src, READ_CHUNK_SIZE)):
+                pulse = parse_pulse(frame)
+                if pulse:
+                    pulses.append(pulse)
+            yield pulses, None
+    else:
+        import bulk_decode
+        frames = bulk_decode.load_capture(source)
+        ticks = timeline.unwrap_frames(frames).ticks[frames.pulse_mask()]
+        if len(ticks):
+            ticks -= ticks[0]
+        ticks = ticks.tolist()
+        pulses = frames.iter_pulses()
+        for start in range(0, len(ticks), BATCH_SIZE):
+            yield list(itertools.islice(pulses, BATCH_SIZE)), ticks[start:start + BATCH_SIZE]
+
+
+def deck_worker(deck, source, results, stats_interval):
+    # The decoder prints diagnostics, keep stdout for the merged output
+    sys.stdout = sys.stderr
+
+    try:
+        live = is_live_source(source)
+        pulse_processor = PulseProcessor()
+        base_stations = []
+        for i in range(16):
+            base_stations.append(BaseStation(i))
+
+        frames = 0
+        start_time = time.monotonic()
+        latest_stats = start_time
+
+        for pulses, ticks in pulse_batches(source):
+            now = time.monotonic()
+            records = []
+            for i, pulse in enumerate(pulses):
+                block = pulse_processor.push(*pulse)
+                if not block:
+                    continue
+                angles = base_stations[block.channel].push(block)
+                if not angles:
+                    continue
+
+                if live:
+                    record_time = now
+                else:
+                    # The sweeps started before the pulse that ended them
+                    record_time = timeline.seconds(ticks[i] - ts_sub(pulse[1], angles.ts))
+
+                records.append((record_time, angles.ts, angles.channel, angles.slow_bit, angles.data))
+
+            frames += len(pulses)
+            if records:
+                results.put(("angles", deck, records))
+
+            if now - latest_stats >= stats_interval:
+                results.put(("stats", deck, frames, now - start_time))
+                latest_stats = now
+
+        results.put(("done", deck, frames, time.monotonic() - start_time))
+    except Exception as e:
+        results.put(("error", deck, str(e)))
+
+
+class DeckMerger:
+    def __init__(self, deck_count, max_delay=None):
+        self.pending = [[] for _ in range(deck_count)]
+        self.read_index = [0] * deck_count
+        self.finished = [False] * deck_count
+        self.max_delay = max_delay
+
+    def push(self, deck, records):
+        self.pending[deck].extend(records)
+
+    def finish(self, deck):
+        self.finished[deck] = True
+
+    def _head(self, deck):
+        if self.read_index[deck] < len(self.pending[deck]):
+            return self.pending[deck][self.read_index[deck]]
+        return None
+
+    # Returns the records that can be output in time order. A record is ready
+    # when all decks still running have a later record, or, for live sources,
+    # when it is older than max_delay.
+    def pop_ready(self, now=None):
+        ready = []
+        while True:
+            best_deck = None
+            best_time = None
+            waiting = False
+            for deck in range(len(self.pending)):
+                head = self._head(deck)
+                if head is None:
+                    if not self.finished[deck]:
+                        waiting = True
+                    continue
+                if best_time is None or head[0] < best_time:
+                    best_deck = deck
+                    best_time = head[0]
+
+            if best_deck is None:
+                break
+            if waiting and (self.max_delay is None or now is None or best_time > now - self.max_delay):
+                break
+
+            ready.append((best_deck,) + self.pending[best_deck][self.read_index[best_deck]])
+            self.read_index[best_deck] += 1
+
+        for deck in range(len(self.pending)):
+            if self.read_index[deck] > BATCH_SIZE:
+                del self.pending[deck][:self.read_index[deck]]
+                self.read_index[deck] = 0
+
+        return ready
+
+
+def print_record(record):
+    deck, record_time, ts, channel, slow_bit, data = record
+    sensor_nr = 0
+    for azimuth, elevation in data:
+        print("Deck:{} Time:{:10.6f} TS:{:06x} Chan:{:2d} Sensor:{} azimuth:{:8.2f} elevation:{:8.2f}".format(
+            deck, record_time, ts, channel + 1, sensor_nr, math.degrees(azimuth), math.degrees(elevation)))
+        sensor_nr += 1
+    print()
+
+
+def print_deck_rate(deck, source, frames, elapsed):
+    rate = frames / elapsed if elapsed > 0 else 0.0
+    print("Deck {} ({}): {} frames, {:.0f} frames/s".format(deck, source, frames, rate), file=sys.stderr)
+
+
+# Live decks and capture files do not share a clock, they can not be merged
+# together
+def run(sources, output=print_record, stats_interval=STATS_INTERVAL):
+    live = any(is_live_source(source) for source in sources)
+    if live and not all(is_live_source(source) for source in sources):
+        raise ValueError("live decks and capture files can not be decoded together")
+    results = multiprocessing.Queue(RESULT_QUEUE_SIZE)
+
+    workers = []
+    for deck, source in enumerate(sources):
+        worker = multiprocessing.Process(target=deck_worker, args=(deck, source, results, stats_interval), daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    merger = DeckMerger(len(sources), MAX_MERGE_DELAY if live else None)
+    running = len(sources)
+    finished = [False] * len(sources)
+    # Workers found dead with no message left, a worker that exits normally
+    # sends "done" before
+    dead = set()
+    deck_frames = [0] * len(sources)
+
+    def finish(deck):
+        nonlocal running
+        finished[deck] = True
+        merger.finish(deck)
+        running -= 1
+
+    try:
+        while running > 0:
+            try:
+                message = results.get(timeout=MAX_MERGE_DELAY)
+            except queue.Empty:
+                message = None
+                # A worker that was killed or crashed sends nothing
+                for deck, worker in enumerate(workers):
+                    if finished[deck] or worker.is_alive():
+                        continue
+                    if deck in dead:
+                        print("Deck {} ({}): worker exited with code {}".format(
+                            deck, sources[deck], worker.exitcode), file=sys.stderr)
+                        finish(deck)
+                    else:
+                        dead.add(deck)
+
+            if message:
+                kind, deck = message[0], message[1]
+                if kind == "angles":
+                    merger.push(deck, message[2])
+                elif kind == "stats":
+                    print_deck_rate(deck, sources[deck], message[2], message[3])
+                elif kind == "done":
+                    deck_frames[deck] = message[2]
+                    print_deck_rate(deck, sources[deck], message[2], message[3])
+                    finish(deck)
+                elif kind == "error":
+                    print("Deck {} ({}): {}".format(deck, sources[deck], message[2]), file=sys.stderr)
+                    finish(deck)
+
+            for record in merger.pop_ready(time.monotonic() if live else None):
+                output(record)
+
+        for record in merger.pop_ready():
+            output(record)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    return deck_frames
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Decode several lighthouse decks in parallel")
+    parser.add_argument("sources", nargs="+", help="input.bin or /dev/tty..., one per deck")
+    parser.add_argument("--stats", type=float, default=STATS_INTERVAL, help="deck frame rate report interval in seconds")
+    args = parser.parse_args()
+    if any(map(is_live_source, args.sources)) and not all(map(is_live_source, args.sources)):
+        parser.error("live decks and capture files can not be decoded together")
+
+    try:
+        run(args.sources, stats_interval=args.stats)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+# Slow data (OOTX) of the lighthouse V2 base stations
+#
+# A base station sends one bit of slow data per rotor rotation, the slow bit
+# of its poly (nPoly & 1). Both sweeps of a rotation have the same slow bit.
+# The bits form OOTX frames, sent MSB first:
+#
+#   * Preamble: 17 zeros followed by a one
+#   * Payload length, uint16 little endian
+#   * Payload, padded with a zero to an even length
+#   * CRC32 of the payload, uint32 little endian
+#
+# A one is inserted as sync bit after every 16 bits following the preamble.
+# The payload is the base station info block with the calibration, its
+# layout is the one of ootx_decoder.h in the Crazyflie firmware.
+#
+# SlowData takes the slow bit of the sweeps of a channel and keeps one bit per
+# rotation, found from the start of the rotation. The frame being received is
+# dropped when a rotation is missed. OotxDecoder assembles the frames and
+# checks the CRC. A full frame takes around 9 s, so CalibrationCache keeps
+# the latest calibration of each channel in a JSON file to have it at
+# startup.
+
+import json
+import os
+import struct
+import zlib
+
+from angle_conversion import PERIODS
+
+PREAMBLE_ZEROS = 17
+WORD_BITS = 16
+MAX_PAYLOAD_LENGTH = 64
+
+# Max difference between the rotation starts of the sweeps of a rotation, and
+# between the time between two rotation starts and the period
+ROTATION_MATCH_TICKS = 1000
+
+# Base station info block, the ogee fields are only sent by V2 base stations
+CALIBRATION_FORMAT = struct.Struct("<HIeeeeBBeebbbeeeeBB")
+CALIBRATION_FIELDS = ("firmware", "id", "phase0", "phase1", "tilt0", "tilt1", "unlock_count", "hw_version",
+                      "curve0", "curve1", "accel_x", "accel_y", "accel_z", "gibphase0", "gibphase1",
+                      "gibmag0", "gibmag1", "mode", "faults")
+OGEE_FORMAT = struct.Struct("<eeee")
+OGEE_FIELDS = ("ogeephase0", "ogeephase1", "ogeemag0", "ogeemag1")
+
+CACHE_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+                          "lighthouse", "calibration.json")
+
+
+def crc32(payload):
+    return zlib.crc32(payload) & 0xffffffff
+
+
+# Returns the bits of an OOTX frame for a payload, sync bits included
+def encode(payload):
+    data = struct.pack("<H", len(payload)) + payload
+    if len(payload) % 2:
+        data += b'\x00'
+    data += struct.pack("<I", crc32(payload))
+
+    bits = [0] * PREAMBLE_ZEROS + [1]
+    for i in range(0, len(data), 2):
+        word = (data[i] << 8) | data[i + 1]
+        bits += [(word >> (WORD_BITS - 1 - bit)) & 1 for bit in range(WORD_BITS)]
+        bits.append(1)
+    return bits
+
+
+class OotxDecoder:
+    def __init__(self):
+        self.zeros = 0
+        self.synchronized = False
+        self.frames = 0
+        self.crc_errors = 0
+        self.sync_errors = 0
+        self.reset()
+
+    # Drops the frame being received, the next frame starts at a preamble
+    def reset(self):
+        self.synchronized = False
+        self.word = 0
+        self.bits_in_word = 0
+        self.length = None
+        self.data = bytearray()
+
+    # Returns the payload when a frame with a good CRC is complete
+    def push(self, bit):
+        # The preamble is the only place with 17 zeros in a row, the sync
+        # bits prevent it in the data
+        if bit:
+            preamble = self.zeros >= PREAMBLE_ZEROS
+            self.zeros = 0
+            if preamble:
+                self.reset()
+                self.synchronized = True
+                return None
+        else:
+            self.zeros += 1
+
+        if not self.synchronized:
+            return None
+
+        if self.bits_in_word == WORD_BITS:
+            self.bits_in_word = 0
+            if not bit:
+                self.sync_errors += 1
+                self.reset()
+            return None
+
+        self.word = (self.word << 1) | bit
+        self.bits_in_word += 1
+        if self.bits_in_word < WORD_BITS:
+            return None
+
+        self.data += bytes((self.word >> 8, self.word & 0xff))
+        self.word = 0
+        if self.length is None:
+            self.length = self.data[0] | (self.data[1] << 8)
+            self.data = bytearray()
+            if self.length > MAX_PAYLOAD_LENGTH:
+                self.reset()
+            return None
+
+        padded = self.length + (self.length & 1)
+        if len(self.data) < padded + 4:
+            return None
+
+        payload = bytes(self.data[:self.length])
+        crc, = struct.unpack("<I", self.data[padded:padded + 4])
+        # Waits for the next preamble
+        self.reset()
+        if crc != crc32(payload):
+            self.crc_errors += 1
+            return None
+        self.frames += 1
+        return payload
+
+
+# Returns the calibration fields of a payload as a dict, None if the payload
+# is too short
+def decode_calibration(payload):
+    if len(payload) < CALIBRATION_FORMAT.size:
+        return None
+
+    calibration = dict(zip(CALIBRATION_FIELDS, CALIBRATION_FORMAT.unpack_from(payload)))
+    firmware = calibration.pop("firmware")
+    calibration["protocol_version"] = firmware & 0x3f
+    calibration["firmware_version"] = firmware >> 6
+    if len(payload) >= CALIBRATION_FORMAT.size + OGEE_FORMAT.size:
+        calibration.update(zip(OGEE_FIELDS, OGEE_FORMAT.unpack_from(payload, CALIBRATION_FORMAT.size)))
+    return calibration
+
+
+# Slow data of one channel
+class SlowData:
+    def __init__(self, channel, on_payload=None):
+        self.channel = channel
+        self.period = PERIODS[channel]
+        # Called with the channel and the payload of each good frame
+        self.on_payload = on_payload
+        self.decoder = OotxDecoder()
+        self.rotor = None
+        self.bits = 0
+        self.lost = 0
+
+    # Pushes the slow bit of a sweep or pulse of the rotation starting at rotor
+    def push(self, rotor, slow_bit):
+        if self.rotor is not None:
+            delta = (rotor - self.rotor) & 0xffffff
+            if delta <= ROTATION_MATCH_TICKS or delta >= 0x1000000 - ROTATION_MATCH_TICKS:
+                # Same rotation
+                return None
+            if abs(delta - self.period) > ROTATION_MATCH_TICKS:
+                self.lost += 1
+                self.decoder.reset()
+                self.decoder.zeros = 0
+        self.rotor = rotor
+
+        self.bits += 1
+        payload = self.decoder.push(slow_bit)
+        if payload is not None and self.on_payload:
+            self.on_payload(self.channel, payload)
+        return payload
+
+
+# Latest calibration payload of each channel, kept in a JSON file as
+# {"<channel>": "<payload in hex>"} with zero indexed channels
+class CalibrationCache:
+    def __init__(self, file_name=CACHE_FILE):
+        self.file_name = file_name
+        self.payloads = {}
+        try:
+            with open(file_name) as f:
+                for channel, payload in json.load(f).items():
+                    self.payloads[int(channel)] = bytes.fromhex(payload)
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    # Returns the calibration of a channel as a dict or None
+    def get(self, channel):
+        payload = self.payloads.get(channel)
+        if payload is None:
+            return None
+        return decode_calibration(payload)
+
+    def update(self, channel, payload):
+        if self.payloads.get(channel) == payload:
+            return
+        self.payloads[channel] = payload
+        try:
+            os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+            tmp_file = "{}.{}.tmp".format(self.file_name, os.getpid())
+            with open(tmp_file, "w") as f:
+                json.dump({str(channel): payload.hex() for channel, payload in sorted(self.payloads.items())}, f,
+                          indent=1)
+            os.replace(tmp_file, self.file_name)
+        except OSError:
+            # Not cached, kept in memory
+            pass
+
+
+def format_calibration(channel, calibration):
+    if calibration is None:
+        return "Chan:{:2d} no calibration".format(channel + 1)
+    return "Chan:{:2d} id:{:08x} fw:{} phase:{:.4f},{:.4f} tilt:{:.4f},{:.4f} curve:{:.4f},{:.4f}".format(
+        channel + 1, calibration["id"], calibration["firmware_version"], calibration["phase0"],
+        calibration["phase1"], calibration["tilt0"], calibration["tilt1"], calibration["curve0"],
+        calibration["curve1"])
+
+
+# Returns a SlowData per channel for the decoders. The cached calibrations
+# are printed on stderr at start and the ones received when they are cached.
+def cached_slow_data(cache=None):
+    import sys
+    if cache is None:
+        cache = CalibrationCache()
+    for channel in sorted(cache.payloads):
+        print("Cached   " + format_calibration(channel, cache.get(channel)), file=sys.stderr)
+
+    def on_payload(channel, payload):
+        cache.update(channel, payload)
+        print("Received " + format_calibration(channel, decode_calibration(payload)), file=sys.stderr)
+
+    return [SlowData(channel, on_payload) for channel in range(len(PERIODS))]
+
+
+if __name__ == "__main__":
+    import sys
+
+    cache = CalibrationCache()
+    if len(sys.argv) < 2:
+        # Print the cached calibrations
+        print("Cache: {}".format(cache.file_name))
+        for channel in sorted(cache.payloads):
+            print(format_calibration(channel, cache.get(channel)))
+        sys.exit(0)
+
+    # Decode the slow data of a capture and cache the calibrations found
+    import contextlib
+    import io
+    import bulk_decode
+    import decodeV2
+
+    payloads = []
+    slow_data = [SlowData(channel, lambda channel, payload: payloads.append((channel, payload)))
+                 for channel in range(len(PERIODS))]
+    pulse_processor = decodeV2.PulseProcessor()
+    frames = bulk_decode.load_capture(sys.argv[1])
+    # The decoder prints dropped blocks
+    with contextlib.redirect_stdout(io.StringIO()):
+        for pulse in frames.iter_pulses():
+            block = pulse_processor.push(*pulse)
+            if block:
+                slow_data[block.channel].push(decodeV2.rotor_start(block), block.slow_bit)
+
+    for data in slow_data:
+        if data.bits:
+            print("Chan:{:2d} {:5d} bits {:3d} lost rotations {:2d} frames {:2d} CRC errors".format(
+                data.channel + 1, data.bits, data.lost, data.decoder.frames, data.decoder.crc_errors))
+
+    for channel, payload in payloads:
+        cache.update(channel, payload)
+        print(format_calibration(channel, decode_calibration(payload)))
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Parallel decoding of a large recorded capture
+#
+# The capture is cut in chunks right after sync frames, where the frames are
+# aligned, and the chunks are decoded with PulseProcessor and BaseStation of
+# decodeV2.py in a process pool. Each chunk writes its angles to a part file
+# and the parts are joined in order into one angle file, the same as
+# decodeV2.py capture.bin output.lha writes.
+#
+# A chunk does not start with an empty decoder: the frames from WARMUP_SYNCS
+# sync frames before the cut are decoded first and their results dropped,
+# so that the open sweep block and the sweeps waiting for their pair are
+# rebuilt. The decoder state at the cut is compared to the state the
+# previous chunk ended with. If they differ, for instance when a base station
+# stopped with a sweep waiting for its pair, the chunk is decoded again
+# starting from the state of the previous chunk, as a serial decoding does.
+#
+# The chunks are cut at byte offsets of a raw capture, a compressed capture
+# has to be extracted first.
+
+import mmap
+import os
+import shutil
+import sys
+import time
+
+import angle_file
+import bulk_decode
+import decodeV2
+from capture_file import require_raw_capture
+from framing import SYNC_FRAME, find_sync
+
+# Sync frames before a cut where the decoding of a chunk starts, they are
+# sent every 0.5 s
+WARMUP_SYNCS = 2
+CHUNKS_PER_JOB = 4
+MIN_CHUNK_BYTES = 1 << 20
+
+
+class Chunk:
+    def __init__(self, index, warmup, start, end):
+        self.index = index
+        # Start of the decoding, of the angles and end in the capture, the
+        # first two are just after a sync frame
+        self.warmup = warmup
+        self.start = start
+        self.end = end
+
+
+# Returns the first frame after the sync frame count sync frames before pos,
+# or the first frame of the capture
+def sync_before(data, pos, count):
+    first = find_sync(data)
+    for _ in range(count):
+        sync = data.rfind(SYNC_FRAME, first, pos - len(SYNC_FRAME))
+        if sync < first:
+            return first
+        pos = find_sync(data, sync)
+    return pos
+
+
+# Cuts the capture in count chunks of about the same size, after sync frames
+def make_chunks(data, count):
+    first = find_sync(data)
+    if first < 0:
+        return []
+
+    cuts = [first]
+    for i in range(1, count):
+        cut = find_sync(data, first + (len(data) - first) * i // count)
+        if cut < 0:
+            break
+        if cut > cuts[-1]:
+            cuts.append(cut)
+    cuts.append(len(data))
+
+    return [Chunk(i, sync_before(data, cuts[i], WARMUP_SYNCS) if i else cuts[0], cuts[i], cuts[i + 1])
+            for i in range(len(cuts) - 1)]
+
+
+def iter_chunk_pulses(data, start, end):
+    if end <= start:
+        return iter(())
+    return bulk_decode.FrameArrays(bulk_decode.align_frames(data[start:end], 0)).iter_pulses()
+
+
+def decoder_state(pulse_processor, base_stations):
+    return pulse_processor.state(), tuple(bs.state() for bs in base_stations)
+
+
+# Decodes a chunk to a part file, returns the number of angles and the
+# decoder states at the start and at the end of the chunk. The decoders
+# start from state if given, instead of the warmup frames.
+def decode_chunk(file_name, chunk, part_file, recover_channels=False, use_angle_tables=False, state=None):
+    with open(file_name, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    pulse_processor = decodeV2.PulseProcessor(recover_channels)
+    base_stations = [decodeV2.BaseStation(i, use_angle_tables) for i in range(16)]
+
+    # The decoder prints dropped blocks
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        if state is None:
+            for pulse in iter_chunk_pulses(data, chunk.warmup, chunk.start):
+                block = pulse_processor.push(*pulse)
+                if block:
+                    base_stations[block.channel].push(block)
+        else:
+            pulse_processor.set_state(state[0])
+            for base_station, base_station_state in zip(base_stations, state[1]):
+                base_station.set_state(base_station_state)
+        start_state = decoder_state(pulse_processor, base_stations)
+
+        with angle_file.AngleWriter(part_file) as writer:
+            for pulse in iter_chunk_pulses(data, chunk.start, chunk.end):
+                block = pulse_processor.push(*pulse)
+                if block:
+                    angles = base_stations[block.channel].push(block)
+                    if angles:
+                        writer.write_angles(angles)
+            count = writer.count
+        end_state = decoder_state(pulse_processor, base_stations)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        data.close()
+
+    return count, start_state, end_state
+
+
+def _decode_task(args):
+    return decode_chunk(*args)
+
+
+# Appends the records of a part file to an open angle file
+def append_part(output, part_file):
+    header_size, _ = angle_file.read_header(part_file)
+    with open(part_file, "rb") as f:
+        f.seek(header_size)
+        shutil.copyfileobj(f, output)
+    os.remove(part_file)
+
+
+# Decodes a capture to an angle file with jobs processes, returns the number
+# of angles, of chunks and of chunks decoded again. The capture is cut in
+# CHUNKS_PER_JOB chunks per job of at least MIN_CHUNK_BYTES by default.
+def decode_parallel(file_name, output_file, jobs=None, chunks=None, recover_channels=False,
+                    use_angle_tables=False):
+    import multiprocessing
+
+    require_raw_capture(file_name)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if chunks is None:
+        chunks = max(1, min(jobs * CHUNKS_PER_JOB, os.path.getsize(file_name) // MIN_CHUNK_BYTES))
+    with open(file_name, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunks = make_chunks(data, chunks)
+
+    def part_name(chunk):
+        return "{}.{}.{}.part".format(output_file, os.getpid(), chunk.index)
+
+    tasks = [(file_name, chunk, part_name(chunk), recover_channels, use_angle_tables) for chunk in chunks]
+
+    count = 0
+    redone = 0
+    # An empty angle file, the parts are appended to it
+    angle_file.AngleWriter(output_file).close()
+    with open(output_file, "ab") as output, multiprocessing.Pool(jobs) as pool:
+        previous_state = None
+        for chunk, (chunk_count, start_state, end_state) in zip(chunks, pool.imap(_decode_task, tasks)):
+            if previous_state is not None and start_state != previous_state:
+                chunk_count, _, end_state = decode_chunk(file_name, chunk, part_name(chunk), recover_channels,
+                                                         use_angle_tables, previous_state)
+                redone += 1
+
+            append_part(output, part_name(chunk))
+            count += chunk_count
+            previous_state = end_state
+
+    return count, len(chunks), redone
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Decode a recorded capture to an angle file in parallel")
+    parser.add_argument("input", help="capture.bin")
+    parser.add_argument("output", help="output.lha")
+    parser.add_argument("--jobs", type=int, help="number of processes, default is the number of cores")
+    parser.add_argument("--chunks", type=int, help="number of chunks, default is {} per job".format(CHUNKS_PER_JOB))
+    parser.add_argument("--angle-tables", action="store_true",
+                        help="convert angles with the precomputed tables of angle_conversion.py")
+    parser.add_argument("--recover-channels", action="store_true",
+                        help="identify the channel of pulses without poly from the beam words, see lfsr.py")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        count, chunks, redone = decode_parallel(args.input, args.output, args.jobs, args.chunks,
+                                                args.recover_channels, args.angle_tables)
+    except ValueError as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(args.input)
+    print("Angles:  {}".format(count))
+    print("Chunks:  {}, {} decoded again".format(chunks, redone))
+    print("Time:    {:.2f} s ({:.1f} MB/s)".format(elapsed, size / elapsed / 1e6))
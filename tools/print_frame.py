@@ -12,18 +12,10 @@ def calculateAE(firstBeam, secondBeam):
     return (azimuth, elevation)
 
 
-PERIODS = [959000, 957000,
-           953000, 949000,
-           947000, 943000,
-           941000, 939000,
-           937000, 929000,
-           919000, 911000,
-           907000, 901000,
-           893000, 887000]
-
 if __name__ == "__main__":
     import sys
-    import struct
+    import capture_file
+    import framing
     if len(sys.argv) < 2:
         print("Usage: {} <input.bin or /dev/tty...>".format(sys.argv[0]))
         exit(1)
@@ -31,28 +23,15 @@ if __name__ == "__main__":
     if sys.argv[1].startswith("/dev/"):
         src = serial.Serial(sys.argv[1], 2*115200)
     else:
-        src = open(sys.argv[1], "rb")
+        src = capture_file.open_capture(sys.argv[1])
 
 
     print("Waiting for sync ...")
-    sync = [b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff', b'\xff']
-    syncBuffer = [b'\x00'] * len(sync)
-    while sync != syncBuffer:
-        b = src.read(1)
-        if len(b) < 1:
-            sys.exit(1)
-        syncBuffer.append(b)
-        syncBuffer = syncBuffer[1:]
-
-    print("Found sync!")
+    frame_sync = framing.FrameSync(on_sync=lambda: print("Found sync!"))
 
-    reading = src.read(12)
     prevSweepTime = 0
-    while(len(reading) == 12):
-        timestamp = struct.unpack("<I", reading[9:] + b'\x00')[0]
-        beam_word = struct.unpack("<I", reading[6:9] + b'\x00')[0]
-        offset = struct.unpack("<I", reading[3:6] + b'\x00')[0]
-        first_word = struct.unpack("<I", reading[:3] + b'\x00')[0]
+    for reading in framing.FrameReader(src, frame_sync):
+        first_word, offset, beam_word, timestamp = framing.unpack_frame(reading)
 
         sensor = first_word & 0x03
         width = (first_word >> 8) & 0xffff
@@ -64,7 +43,6 @@ if __name__ == "__main__":
 
         # Sync frame, ignore it
         if offset == 0xffffff:
-            reading = src.read(12)
             continue
 
         # Detect new sweep
@@ -80,5 +58,3 @@ if __name__ == "__main__":
                 end='')
 
         print()
-
-        reading = src.read(12)
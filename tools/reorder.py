@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Reordering of the pulses by timestamp
+#
+# The deck sends the frame of a pulse when the pulse ends, so the frames of
+# the sensors hit by one sweep can arrive out of timestamp order.
+# PulseProcessor in decodeV2.py expects the pulses in order and ends the
+# sweep block at a pulse earlier than the previous one, decodeV2_cf.py only
+# tolerates it within MAX_TICKS_SENSOR_TO_SENSOR.
+#
+# ReorderBuffer holds the pulses in a heap keyed by timestamp and releases
+# them sorted once a pulse window ticks later is received, so a pulse is
+# delayed by at most window ticks of the deck clock. The 24 bits timestamps
+# are unwrapped against the latest one: up to timeline.MAX_BACKWARD_TICKS
+# back in time is an earlier pulse, anything else a later one. A pulse
+# earlier than one already released is late and dropped. Items without
+# timestamp, the sync frames, stay after the pulses received before them.
+# flush() releases the pulses held at the end of the stream.
+#
+# When the deck goes quiet no later pulse releases the ones held. On a live
+# stream max_delay bounds the wall clock time they wait: poll(), called for
+# each frame and when a read times out, releases them all once no pulse has
+# been received for max_delay seconds.
+
+import heapq
+import time
+
+import framing
+from timeline import CLOCK_FREQUENCY, MAX_BACKWARD_TICKS, TIMESTAMP_MASK, TIMESTAMP_WRAP
+
+DEFAULT_WINDOW_TICKS = CLOCK_FREQUENCY // 4000
+# Seconds the pulses are held after the last pulse received on a live stream
+LIVE_MAX_DELAY = 0.05
+
+
+def ticks_to_us(ticks):
+    return ticks * 1000000 / CLOCK_FREQUENCY
+
+
+def us_to_ticks(us):
+    return int(us * CLOCK_FREQUENCY / 1000000)
+
+
+class ReorderBuffer:
+    def __init__(self, window=DEFAULT_WINDOW_TICKS, max_delay=None):
+        self.window = window
+        self.max_delay = max_delay
+        self._heap = []
+        self._count = 0
+        # Unwrapped time of the latest pulse and of the last pulse released
+        self._latest = None
+        self._released = None
+        # time.monotonic() of the latest pulse, with max_delay
+        self._received = None
+
+        self.items = 0
+        self.reordered = 0
+        self.late_drops = 0
+        # Largest ticks a pulse arrived after a later one, and most items held
+        self.max_depth = 0
+        self.max_pending = 0
+
+    # Adds an item with its 24 bits timestamp, or None to keep it after the
+    # items already pushed. Returns the items that are ready, in timestamp
+    # order.
+    def push(self, ts, item):
+        self.items += 1
+        latest = self._latest
+        if ts is not None and self.max_delay is not None:
+            self._received = time.monotonic()
+
+        if ts is None:
+            if latest is None:
+                return (item,)
+            key = latest
+        elif latest is None:
+            key = latest = ts
+        else:
+            delta = (ts - latest) & TIMESTAMP_MASK
+            if delta > TIMESTAMP_WRAP - MAX_BACKWARD_TICKS:
+                delta -= TIMESTAMP_WRAP
+                self.reordered += 1
+                if -delta > self.max_depth:
+                    self.max_depth = -delta
+            key = latest + delta
+            if key < latest:
+                if self._released is not None and key < self._released:
+                    self.late_drops += 1
+                    return ()
+            else:
+                latest = key
+        self._latest = latest
+
+        heap = self._heap
+        heapq.heappush(heap, (key, self._count, item))
+        self._count += 1
+        if len(heap) > self.max_pending:
+            self.max_pending = len(heap)
+
+        limit = latest - self.window
+        if heap[0][0] > limit:
+            return ()
+
+        ready = []
+        while heap and heap[0][0] <= limit:
+            key, _, item = heapq.heappop(heap)
+            ready.append(item)
+        self._released = key
+        return ready
+
+    # Returns all the items held, in timestamp order, if no pulse was received
+    # for max_delay seconds
+    def poll(self):
+        if not self._heap or self.max_delay is None:
+            return ()
+        if self._received is not None and time.monotonic() - self._received < self.max_delay:
+            return ()
+        return self.flush()
+
+    # Returns all the items held, in timestamp order
+    def flush(self):
+        heap = self._heap
+        ready = []
+        while heap:
+            key, _, item = heapq.heappop(heap)
+            ready.append(item)
+            self._released = key
+        return ready
+
+    def stats(self):
+        return {
+            "items": self.items,
+            "reordered": self.reordered,
+            "late_drops": self.late_drops,
+            "max_depth": self.max_depth,
+            "max_pending": self.max_pending,
+        }
+
+    def report(self):
+        return "Reorder: {} of {} reordered, {} late drops, max depth {:.1f} us, max {} held".format(
+            self.reordered, self.items, self.late_drops, ticks_to_us(self.max_depth), self.max_pending)
+
+
+# Returns the timestamp of a frame, or None for a sync frame
+def frame_ts(frame):
+    if framing.is_sync_frame(frame, 0):
+        return None
+    return framing.frame_timestamp(frame, 0)
+
+
+# Generator of frames in timestamp order. The frames are copied while held,
+# framing.FrameReader reuses its buffer.
+def reorder_frames(frames, reorder_buffer):
+    push = reorder_buffer.push
+    poll = reorder_buffer.poll
+    for frame in frames:
+        yield from push(frame_ts(frame), bytes(frame))
+        yield from poll()
+    yield from reorder_buffer.flush()
+
+
+# Generator of the pulses of parse_pulse() or FrameArrays.iter_pulses() in
+# timestamp order. None, a sync frame, stays after the pulses before it.
+def reorder_pulses(pulses, reorder_buffer):
+    push = reorder_buffer.push
+    for pulse in pulses:
+        yield from push(pulse[1] if pulse else None, pulse)
+    yield from reorder_buffer.flush()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import capture_file
+
+    parser = argparse.ArgumentParser(description="Report the frames of a capture received out of timestamp order")
+    parser.add_argument("input", help="capture.bin or capture.lhc")
+    parser.add_argument("--window-us", type=float, default=ticks_to_us(DEFAULT_WINDOW_TICKS),
+                        help="time a frame is held, default {:.0f} us".format(ticks_to_us(DEFAULT_WINDOW_TICKS)))
+    args = parser.parse_args()
+
+    reorder_buffer = ReorderBuffer(us_to_ticks(args.window_us))
+    frame_sync = framing.FrameSync()
+    frames = 0
+    for _ in reorder_frames(framing.FrameReader(capture_file.open_capture(args.input), frame_sync), reorder_buffer):
+        frames += 1
+    print("Frames:  {}".format(frames))
+    print(reorder_buffer.report())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Replays a recorded UART capture over a pty
+#
+# The frames of the capture are written to the master side of a pty, the
+# decoders open the slave side as if it was the serial port of a deck. The
+# time of each frame is reconstructed from the 24 bits timestamps with
+# timeline.py, frames sent out of order by the deck are sent right away and
+# sync frames are sent with the previous pulse.
+#
+# The frames are replayed at real time, --speed times faster or as fast as
+# the pty is read with --max. The lateness of each frame relative to its
+# schedule is measured and reported as the jitter added by the replay.
+#
+# Frames with broken padding bits are removed as in bulk_decode.py, the
+# replayed stream starts with a sync frame. The capture can be a compressed
+# one, see capture_file.py.
+
+import os
+import sys
+import time
+import tty
+
+import numpy as np
+
+import bulk_decode
+import capture_file
+import timeline
+from framing import SYNC_FRAME, UART_FRAME_LENGTH
+
+# Max number of frames written at once
+WRITE_FRAMES = 4096
+START_DELAY = 2.0
+
+
+# Returns the aligned frames of a capture as a (n, 12) array, starting with a
+# sync frame
+def load_frames(file_name):
+    frames = capture_file.load_frames(file_name)
+    if len(frames) == 0:
+        return np.frombuffer(SYNC_FRAME, dtype=np.uint8).reshape(1, UART_FRAME_LENGTH)
+    return frames
+
+
+# Returns the time of each frame in ticks since the first pulse
+def frame_times(frames):
+    times = timeline.unwrap_frames(bulk_decode.FrameArrays(frames)).monotonic
+    # Frames out of order are sent right away, with the frame before them
+    return times - times[0]
+
+
+class ReplayStats:
+    def __init__(self, frame_count, timed=True):
+        self.timed = timed
+        # Lateness of each frame in seconds
+        self.lateness = np.zeros(frame_count)
+        self.frames = 0
+        self.writes = 0
+        self.elapsed = 0.0
+
+    def report(self):
+        lines = ["Frames:   {} in {} writes, {:.3f} s ({:.0f} frames/s)".format(
+            self.frames, self.writes, self.elapsed, self.frames / self.elapsed if self.elapsed > 0 else 0.0)]
+        if self.timed and self.frames:
+            lateness = self.lateness[:self.frames] * 1000
+            lines.append("Lateness: mean {:.3f} p50 {:.3f} p99 {:.3f} max {:.3f} ms".format(
+                lateness.mean(), np.percentile(lateness, 50), np.percentile(lateness, 99), lateness.max()))
+        return "\n".join(lines)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# Writes the frames to fd at their deadlines, in seconds from the start
+def replay(fd, frames, deadlines, stats):
+    start = time.perf_counter()
+    i = 0
+    try:
+        while i < len(frames):
+            now = time.perf_counter() - start
+            due = int(np.searchsorted(deadlines, now, side="right"))
+            if due <= i:
+                time.sleep(deadlines[i] - now)
+                continue
+
+            due = min(due, i + WRITE_FRAMES)
+            write_all(fd, frames[i:due].tobytes())
+            sent = time.perf_counter() - start
+            stats.lateness[i:due] = sent - deadlines[i:due]
+            stats.writes += 1
+            stats.frames = due
+            i = due
+    finally:
+        stats.elapsed = time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay a recorded capture over a pty")
+    parser.add_argument("input", help="capture.bin")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 1 is real time")
+    parser.add_argument("--max", action="store_true", help="replay as fast as the pty is read")
+    parser.add_argument("--delay", type=float, default=START_DELAY,
+                        help="seconds to wait for the decoder to open the pty, default {}".format(START_DELAY))
+    args = parser.parse_args()
+
+    frames = load_frames(args.input)
+    if args.max:
+        deadlines = np.zeros(len(frames))
+    else:
+        deadlines = timeline.seconds(frame_times(frames)) / args.speed
+
+    master, slave = os.openpty()
+    # No echo or newline translation, the slave must behave as a serial port
+    tty.setraw(slave)
+    # The name of the pty is the only output on stdout, for scripts
+    print(os.ttyname(slave), flush=True)
+    print("Replaying {} frames ({:.1f} s)".format(len(frames), deadlines[-1] if len(deadlines) else 0.0),
+          file=sys.stderr)
+
+    stats = ReplayStats(len(frames), not args.max)
+    try:
+        time.sleep(args.delay)
+        replay(master, frames, deadlines, stats)
+        # Let the decoder read the end of the capture before the pty is closed
+        time.sleep(args.delay)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(master)
+        os.close(slave)
+
+    print(stats.report(), file=sys.stderr)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# Binary sample cache for Saleae CSV captures
+#
+# The CSV export of a capture has one row per signal change, a time in seconds
+# followed by the D and E columns of each sensor (see saleae_decode.py). The
+# CSV is parsed in chunks of CHUNK_ROWS rows and converted once to a sample
+# file, written next to it as <capture>.csv.lhs and rebuilt when the CSV is
+# newer. All numbers are little-endian.
+#
+# Header, 48 bytes:
+#
+#   Offset  Type     Field
+#   0       char[4]  Magic, "LHSC"
+#   4       uint16   Format version, 1
+#   6       uint16   Header size in bytes
+#   8       uint16   Number of signal columns
+#   10      uint16   Bytes of packed signals per row
+#   12      uint32   Number of blocks
+#   16      uint64   Number of rows
+#   24      uint64   File offset of the block index
+#   32      int64    Time of the first row in ns
+#   40      int64    Time of the last row in ns
+#
+# The rows are stored in blocks of up to BLOCK_ROWS rows:
+#
+#   uint32[rows]             Time since the previous row in ns, 0 for the first
+#   uint8[rows][row bytes]   Signal columns packed with numpy.packbits()
+#
+# A new block is started when a row is more than 2^32 - 1 ns after the
+# previous one. The block index is an array of (int64 time of the first row,
+# uint64 first row, uint64 file offset, uint64 rows), one per block. It is the
+# sparse time index used to seek: reading a time window only decodes the
+# blocks that overlap it.
+
+import os
+import struct
+from itertools import islice
+
+import numpy as np
+
+MAGIC = b'LHSC'
+VERSION = 1
+HEADER = struct.Struct("<4sHHHHIQQqq")
+INDEX_DTYPE = np.dtype([("time", "<i8"), ("row", "<u8"), ("offset", "<u8"), ("rows", "<u8")])
+CACHE_EXTENSION = ".lhs"
+
+CHUNK_ROWS = 1 << 20
+BLOCK_ROWS = 1 << 16
+MAX_DELTA = 0xffffffff
+
+NS_PER_SECOND = 1000000000
+
+
+# Yields the rows of a CSV capture as (times in ns, signals), a (rows,
+# columns) uint8 array, CHUNK_ROWS rows at a time
+def read_csv_chunks(file_name, chunk_rows=CHUNK_ROWS):
+    with open(file_name) as f:
+        # Skip header
+        f.readline()
+        while True:
+            lines = list(islice(f, chunk_rows))
+            if not lines:
+                break
+            data = np.loadtxt(lines, delimiter=",", ndmin=2)
+            times = np.rint(data[:, 0] * NS_PER_SECOND).astype(np.int64)
+            yield times, data[:, 1:].astype(np.uint8)
+
+
+class SampleWriter:
+    def __init__(self, file_name, n_columns):
+        self.file = open(file_name, "wb")
+        self.n_columns = n_columns
+        self.row_bytes = (n_columns + 7) // 8
+        self.file.write(b'\x00' * HEADER.size)
+
+        self.index = []
+        self.rows = 0
+        self.first_time = 0
+        self.last_time = None
+
+        # Rows of the block being built
+        self.deltas = []
+        self.bits = []
+        self.block_rows = 0
+
+    def write(self, times, signals):
+        if len(times) == 0:
+            return
+
+        previous = times[0] if self.last_time is None else self.last_time
+        if self.last_time is None:
+            self.first_time = int(times[0])
+        deltas = np.diff(times, prepend=previous)
+        if np.any(deltas < 0):
+            raise ValueError("times are not increasing")
+        bits = np.packbits(signals, axis=1)
+
+        i = 0
+        while i < len(times):
+            if self.block_rows == 0 or self.block_rows == BLOCK_ROWS or deltas[i] > MAX_DELTA:
+                self._flush_block()
+                self.index.append((int(times[i]), self.rows, 0, 0))
+                deltas[i] = 0
+
+            # Until the block is full or the next delta that does not fit
+            end = min(len(times), i + BLOCK_ROWS - self.block_rows)
+            large = np.flatnonzero(deltas[i + 1:end] > MAX_DELTA)
+            if len(large):
+                end = i + 1 + large[0]
+
+            self.deltas.append(deltas[i:end].astype("<u4"))
+            self.bits.append(bits[i:end])
+            self.block_rows += end - i
+            self.rows += end - i
+            i = end
+
+        self.last_time = int(times[-1])
+
+    def _flush_block(self):
+        if self.block_rows == 0:
+            return
+        time, row, _, _ = self.index[-1]
+        self.index[-1] = (time, row, self.file.tell(), self.block_rows)
+        for deltas in self.deltas:
+            self.file.write(deltas.tobytes())
+        for bits in self.bits:
+            self.file.write(bits.tobytes())
+        self.deltas = []
+        self.bits = []
+        self.block_rows = 0
+
+    def close(self):
+        self._flush_block()
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+
+        last_time = self.first_time if self.last_time is None else self.last_time
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, HEADER.size, self.n_columns, self.row_bytes, len(self.index),
+                                    self.rows, index_offset, self.first_time, last_time))
+        self.file.close()
+
+
+# Converts a CSV capture to a sample file, written to a temporary file first so
+# that an interrupted conversion does not leave a broken cache
+def convert(csv_file, sample_file, chunk_rows=CHUNK_ROWS):
+    with open(csv_file) as f:
+        n_columns = len(f.readline().split(",")) - 1
+
+    tmp_file = "{}.{}.tmp".format(sample_file, os.getpid())
+    writer = SampleWriter(tmp_file, n_columns)
+    try:
+        for times, signals in read_csv_chunks(csv_file, chunk_rows):
+            writer.write(times, signals)
+        writer.close()
+        os.replace(tmp_file, sample_file)
+    except BaseException:
+        writer.file.close()
+        os.remove(tmp_file)
+        raise
+
+
+class SampleFile:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.data = np.memmap(file_name, dtype=np.uint8, mode="r")
+
+        if len(self.data) < HEADER.size:
+            raise ValueError("{}: file too short".format(file_name))
+        magic, version, header_size, n_columns, row_bytes, n_blocks, rows, index_offset, first_time, last_time = \
+            HEADER.unpack(self.data[:HEADER.size].tobytes())
+        if magic != MAGIC:
+            raise ValueError("{}: not a sample file".format(file_name))
+        if version != VERSION:
+            raise ValueError("{}: unsupported sample file version {}".format(file_name, version))
+
+        self.n_columns = n_columns
+        self.row_bytes = row_bytes
+        self.rows = rows
+        self.first_time = first_time
+        self.last_time = last_time
+        self.index = np.frombuffer(self.data, dtype=INDEX_DTYPE, count=n_blocks, offset=index_offset)
+
+    def __len__(self):
+        return self.rows
+
+    def start_time(self):
+        return self.first_time / NS_PER_SECOND
+
+    def end_time(self):
+        return self.last_time / NS_PER_SECOND
+
+    def _read_block(self, block):
+        time, _, offset, rows = (int(x) for x in self.index[block])
+        deltas = np.frombuffer(self.data, dtype="<u4", count=rows, offset=offset)
+        times = time + np.cumsum(deltas, dtype=np.int64)
+        bits = np.frombuffer(self.data, dtype=np.uint8, count=rows * self.row_bytes, offset=offset + 4 * rows)
+        signals = np.unpackbits(bits.reshape(rows, self.row_bytes), axis=1, count=self.n_columns)
+        return times, signals
+
+    # Returns the times in ns and the signals of the rows from start to end,
+    # in seconds. The row before start is included, it has the state of the
+    # signals at start.
+    def read_ns(self, start=None, end=None):
+        start_ns = self.first_time if start is None else int(round(start * NS_PER_SECOND))
+        end_ns = self.last_time + 1 if end is None else int(round(end * NS_PER_SECOND))
+
+        first_block = max(0, np.searchsorted(self.index["time"], start_ns, side="right") - 1)
+        last_block = np.searchsorted(self.index["time"], end_ns, side="left")
+        blocks = [self._read_block(block) for block in range(first_block, last_block)]
+        if not blocks:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, self.n_columns), dtype=np.uint8)
+
+        times = np.concatenate([times for times, _ in blocks])
+        signals = np.concatenate([signals for _, signals in blocks])
+        first = max(0, np.searchsorted(times, start_ns, side="right") - 1)
+        last = np.searchsorted(times, end_ns, side="left")
+        return times[first:last], signals[first:last]
+
+    # Same as read_ns() with the times in seconds
+    def read(self, start=None, end=None):
+        times, signals = self.read_ns(start, end)
+        return times / NS_PER_SECOND, signals
+
+
+# Opens a capture, a sample file or a CSV file that is converted the first
+# time
+def open_capture(file_name):
+    if file_name.endswith(CACHE_EXTENSION):
+        return SampleFile(file_name)
+
+    sample_file = file_name + CACHE_EXTENSION
+    try:
+        if os.path.getmtime(sample_file) >= os.path.getmtime(file_name):
+            return SampleFile(sample_file)
+    except (OSError, ValueError):
+        pass
+
+    convert(file_name, sample_file)
+    return SampleFile(sample_file)
+
+
+# Returns the time column and a list of (d, e) columns, one per sensor, of the
+# rows from start to end in seconds
+def load(file_name, start=None, end=None):
+    times, signals = open_capture(file_name).read(start, end)
+    sensors = []
+    for column in range(0, signals.shape[1] - 1, 2):
+        sensors.append((signals[:, column], signals[:, column + 1]))
+    return times, sensors
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Convert a Saleae CSV capture to a sample file and read a time window")
+    parser.add_argument("input", help="capture.csv or capture.csv.lhs")
+    parser.add_argument("--start", type=float, help="start of the window in seconds")
+    parser.add_argument("--end", type=float, help="end of the window in seconds")
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    capture = open_capture(args.input)
+    print("Samples: {} ({:.1f} ms)".format(capture.file_name, (time.perf_counter() - t) * 1000))
+    print("Rows:    {} in {} blocks, {} bytes".format(len(capture), len(capture.index), os.path.getsize(capture.file_name)))
+    print("Time:    {:.9f} to {:.9f} s".format(capture.start_time(), capture.end_time()))
+
+    if args.start is not None or args.end is not None:
+        t = time.perf_counter()
+        times, signals = capture.read(args.start, args.end)
+        print("Window:  {} rows ({:.1f} ms)".format(len(times), (time.perf_counter() - t) * 1000))
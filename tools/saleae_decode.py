@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Software reference decoder for the logic analyzer captures in test_data
+#
+# Decodes Saleae CSV exports of the TS4231 sensor signals the same way the
+# FPGA does and writes the frames in the UART format described in the readme,
+# so the output can be fed to decodeV2.py and the other tools. The CSV has a
+# time column followed by D and E columns for each sensor:
+#
+#   Time[s], Channel 0, Channel 1
+#   0.000000000000000, 0, 1
+#
+# The CSV is converted to a binary sample file the first time, see
+# saleae_capture.py.
+#
+# The pipeline follows LighthouseTopLevel:
+#   * Envelope: a pulse starts when E falls and ends when E rises (PulseTimer)
+#   * BMC decoding of D (DdrBmcDecoder): an edge shorter than SHORT_DELAY after
+#     the previous one is half a 1, a longer edge is a 0 and no edge for
+#     UNSYNC_DELAY loses the synchronization. Only bits decoded while E is low
+#     are used and the first 17 bits of a pulse is the beam word
+#   * Poly identification between consecutive pulses (PulseIdentifier)
+#   * Offset of the beam word in the LFSR sequence (PulseOffsetFinder)
+#
+# The edges, the beam words and the polys are found with numpy for all pulses
+# at once.
+#
+# The FPGA only identifies the poly from two sensors hit within the same sweep,
+# captures of one sensor never get a channel. With --identify the poly is also
+# found from the bits following the beam word in the pulse itself, which is
+# not done by the FPGA.
+
+import numpy as np
+
+import lfsr
+import saleae_capture
+from synthetic import encode_frame
+
+CLOCK_FREQUENCY = 24000000
+
+# decodershortDelay and decoderUnsyncDelay in LighthouseTopLevel
+SHORT_DELAY = 124e-9
+UNSYNC_DELAY = 235e-9
+
+BEAM_WORD_BITS = 17
+NO_POLY = 0x3f
+
+# Pulse distances in LFSR iterations, one iteration is 4 ticks
+POLY_FINDER_MAX_DELTA = 1024
+OFFSET_FINDER_MIN_DELTA = 2048
+
+SYNC_FRAME = b'\xff' * 12
+SYNC_PERIOD = 0.5
+
+# Number of bits after the beam word that must match the poly for --identify
+IDENTIFY_BITS = 10
+
+
+# Returns the start and end times of the pulses
+def envelope(times, e):
+    change = np.flatnonzero(np.diff(e)) + 1
+    falls = times[change[e[change] == 0]]
+    rises = times[change[e[change] == 1]]
+
+    # Only keep complete pulses
+    if len(rises) and len(falls) and rises[0] < falls[0]:
+        rises = rises[1:]
+    count = min(len(falls), len(rises))
+    return falls[:count], rises[:count]
+
+
+# BMC decodes a signal, returns the time and value of each bit
+def bmc_decode(times, d):
+    edges = times[np.flatnonzero(np.diff(d)) + 1]
+    if len(edges) == 0:
+        return edges, np.zeros(0, dtype=np.uint8)
+
+    delta = np.diff(edges, prepend=-np.inf)
+    short = delta < SHORT_DELAY
+    long = (delta >= SHORT_DELAY) & (delta < UNSYNC_DELAY)
+
+    # Both a long edge and a lost synchronization restart the decoding of a
+    # 1, every second short edge since then is a 1
+    shorts = np.cumsum(short)
+    restart = np.maximum.accumulate(np.where(~short, np.arange(len(edges)), 0))
+    one = short & ((shorts - shorts[restart]) % 2 == 0)
+
+    bit = one | long
+    return edges[bit], one[bit].astype(np.uint8)
+
+
+# Packs the bits first_bit to first_bit + n_bits of each pulse in a word, the
+# first bit is the most significant. Returns the words and the number of bits
+# found for each pulse.
+def pulse_words(bit_times, bits, falls, rises, first_bit, n_bits):
+    pulse = np.searchsorted(falls, bit_times, side="right") - 1
+    in_pulse = pulse >= 0
+    in_pulse[in_pulse] = bit_times[in_pulse] < rises[pulse[in_pulse]]
+    pulse = pulse[in_pulse]
+    bits = bits[in_pulse]
+
+    # Rank of each bit in its pulse
+    rank = np.arange(len(pulse)) - np.searchsorted(pulse, pulse)
+    rank -= first_bit
+    used = (rank >= 0) & (rank < n_bits)
+
+    weights = bits[used].astype(np.int64) << (n_bits - 1 - rank[used])
+    words = np.bincount(pulse[used], weights=weights, minlength=len(falls)).astype(np.int64)
+    counts = np.bincount(pulse[used], minlength=len(falls))
+    return words, counts
+
+
+# Decodes the pulses of one sensor, returns a dict of arrays
+def decode_sensor(sensor, times, d, e):
+    falls, rises = envelope(times, e)
+    bit_times, bits = bmc_decode(times, d)
+
+    beam_words, counts = pulse_words(bit_times, bits, falls, rises, 0, BEAM_WORD_BITS)
+    # The beam word is 0 if not enough bits were received
+    beam_words[counts < BEAM_WORD_BITS] = 0
+    next_bits, next_counts = pulse_words(bit_times, bits, falls, rises, BEAM_WORD_BITS, IDENTIFY_BITS)
+
+    start = np.floor(falls * CLOCK_FREQUENCY).astype(np.int64)
+    end = np.floor(rises * CLOCK_FREQUENCY).astype(np.int64)
+    return {
+        "sensor": np.full(len(falls), sensor),
+        "time": rises,
+        "timestamp": start & 0xffffff,
+        "width": (end - start) & 0xffff,
+        "beam_word": beam_words,
+        "next_bits": next_bits,
+        "next_count": next_counts,
+    }
+
+
+# Finds the poly from the bits following the beam word, for all pulses at once
+def identify_in_pulse(beam_words, next_bits):
+    polys = np.array(lfsr.POLYS, dtype=np.int64)
+    states = np.repeat(beam_words[:, np.newaxis], len(polys), axis=1)
+    predicted = np.zeros_like(states)
+    for _ in range(IDENTIFY_BITS):
+        states = lfsr.iterate_batch(states, polys)
+        predicted = (predicted << 1) | (states & 1)
+
+    match = predicted == next_bits[:, np.newaxis]
+    poly = np.argmax(match, axis=1)
+    poly[match.sum(axis=1) != 1] = NO_POLY
+    return poly
+
+
+# Runs the pulses through PulseIdentifier and PulseOffsetFinder, in the order
+# the FPGA gets them, and returns the frames with their time
+def identify(pulses, use_pulse_bits=False):
+    in_pulse_poly = None
+    if use_pulse_bits:
+        in_pulse_poly = identify_in_pulse(pulses["beam_word"], pulses["next_bits"])
+        in_pulse_poly[pulses["next_count"] < IDENTIFY_BITS] = NO_POLY
+        in_pulse_poly[pulses["beam_word"] == 0] = NO_POLY
+
+    # PulseIdentifier, the poly is searched from the beam word of the previous
+    # pulse of any sensor, for all pulses at once
+    order = np.argsort(pulses["time"], kind="stable")
+    timestamps = pulses["timestamp"][order]
+    beam_words = pulses["beam_word"][order]
+    last_timestamps = np.concatenate(([0], timestamps))[:-1]
+    last_states = np.concatenate(([0], beam_words))[:-1]
+    delta = ((timestamps - last_timestamps) & 0xffffff) >> 2
+    # The 10 bits maxTick counter of PolyFinder wraps
+    ticks = (((delta + 2) & 0x3ff) - 2) << 2
+    polys = lfsr.find_polys(last_states, beam_words, ticks)
+    polys[(delta >= POLY_FINDER_MAX_DELTA) | (polys == lfsr.NO_POLY)] = NO_POLY
+
+    frames = []
+
+    # PulseOffsetFinder state
+    last_offset_timestamp = 0
+    last_poly = None
+
+    for i, poly in zip(order.tolist(), polys.tolist()):
+        timestamp = int(pulses["timestamp"][i])
+        beam_word = int(pulses["beam_word"][i])
+
+        if poly == NO_POLY and in_pulse_poly is not None:
+            poly = int(in_pulse_poly[i])
+
+        offset = 0
+        delta = ((timestamp - last_offset_timestamp) & 0xffffff) >> 2
+        if poly != NO_POLY and (delta > OFFSET_FINDER_MIN_DELTA or poly != last_poly):
+            found = lfsr.find_offset(poly, beam_word)
+            if found is not None:
+                offset = found
+                last_offset_timestamp = timestamp
+        last_poly = poly
+
+        frame = encode_frame(int(pulses["sensor"][i]), timestamp, int(pulses["width"][i]), offset,
+                             poly >> 1, poly & 1, poly != NO_POLY, beam_word)
+        frames.append((pulses["time"][i], frame))
+
+    return frames
+
+
+# Decodes a capture, or the part from start to end in seconds, returns the UART
+# frames
+def decode(file_name, use_pulse_bits=False, start=None, end=None):
+    times, sensors = saleae_capture.load(file_name, start, end)
+
+    decoded = [decode_sensor(sensor, times, d, e) for sensor, (d, e) in enumerate(sensors)]
+    pulses = {key: np.concatenate([p[key] for p in decoded]) for key in decoded[0]}
+    frames = identify(pulses, use_pulse_bits)
+
+    # A sync frame first, then at the same rate as the FPGA
+    if len(times):
+        sync_time = times[0]
+        while sync_time <= times[-1]:
+            frames.append((sync_time, SYNC_FRAME))
+            sync_time += SYNC_PERIOD
+    frames.sort(key=lambda frame: frame[0])
+
+    return b''.join(frame for _, frame in frames)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Decode a Saleae capture of the sensor signals to UART frames")
+    parser.add_argument("input", help="capture.csv or capture.csv.lhs")
+    parser.add_argument("output", help="output.bin")
+    parser.add_argument("--identify", action="store_true", help="also identify the poly from the bits of each pulse")
+    parser.add_argument("--start", type=float, help="start of the part to decode in seconds")
+    parser.add_argument("--end", type=float, help="end of the part to decode in seconds")
+    args = parser.parse_args()
+
+    data = decode(args.input, args.identify, args.start, args.end)
+    with open(args.output, "wb") as f:
+        f.write(data)
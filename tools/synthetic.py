@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Generates synthetic UART captures
+#
+# Simulates V2 base stations sweeping a deck with 4 sensors and produces the
+# frames the deck would send, including the sync frames. For each sweep, the
+# first sensor hit has no polynomial found and the second one has the sync
+# offset, as the FPGA does. The beam word of a pulse is the LFSR state at its
+# offset. Used to test and benchmark the decoders without a deck.
+#
+# With --check-fov the script decodes captures of a deck at the center and at
+# the corners of the field of view of a base station and checks that the
+# sweeps are paired and the angles found.
+
+import io
+import math
+import random
+import struct
+import sys
+
+import lfsr
+from angle_conversion import PERIODS
+
+N_SENSORS = 4
+SYNC_FRAME = b'\xff' * 12
+SYNC_PERIOD = 24000000 // 2
+
+
+def encode_frame(sensor, timestamp, width, offset_6, channel, slow_bit, poly_ok, beam_word=0):
+    first_word = sensor | (((channel << 1) | slow_bit) << 2) | ((0 if poly_ok else 1) << 7) | (width << 8)
+    return (struct.pack("<I", first_word)[:3] + struct.pack("<I", offset_6)[:3] +
+            struct.pack("<I", beam_word)[:3] + struct.pack("<I", timestamp & 0xffffff)[:3])
+
+
+# Inverse of calculateAE(), returns the offset of each sweep for a sensor
+def sweep_offsets(channel, azimuth, elevation):
+    period = PERIODS[channel]
+    beta = 2 * math.asin(math.tan(elevation) * math.tan(math.radians(30)))
+    half = (beta + math.radians(120)) / 2
+    first_beam = azimuth + math.pi - half
+    second_beam = azimuth + math.pi + half
+    return (first_beam / (2 * math.pi) * period, second_beam / (2 * math.pi) * period)
+
+
+# Returns a list of (timestamp, frame) for the pulses of one channel. pose is
+# the (azimuth, elevation) of sensor 0 in radians, random if None.
+def channel_pulses(channel, seconds, rnd, slow_bits=None, pose=None):
+    period = PERIODS[channel]
+    azimuth = rnd.uniform(-0.5, 0.5)
+    elevation = rnd.uniform(-0.3, 0.3)
+    if pose:
+        azimuth, elevation = pose
+    start = rnd.randrange(int(period))
+
+    offsets = []
+    for sensor in range(N_SENSORS):
+        offsets.append(sweep_offsets(channel, azimuth + 0.01 * sensor, elevation + 0.005 * sensor))
+
+    pulses = []
+    rotation = 0
+    while True:
+        rotor_start = int(start + rotation * period)
+        if rotor_start > seconds * 24000000:
+            break
+
+        if slow_bits:
+            slow_bit = slow_bits[rotation % len(slow_bits)]
+        else:
+            slow_bit = rnd.randrange(2)
+        states = lfsr.state_table((channel << 1) | slow_bit)
+
+        for sweep in range(2):
+            # The FPGA measures the offset in a 6 MHz clock
+            hits = sorted((int(offsets[sensor][sweep]) // 4 * 4, sensor) for sensor in range(N_SENSORS))
+            for i, (offset, sensor) in enumerate(hits):
+                timestamp = rotor_start + offset
+                offset_6 = offset // 4 if i == 1 else 0
+                beam_word = int(states[(offset // 4) % lfsr.SEQUENCE_LENGTH])
+                frame = encode_frame(sensor, timestamp, rnd.randrange(0x100, 0x150), offset_6, channel, slow_bit, i != 0,
+                                     beam_word)
+                pulses.append((timestamp, frame))
+
+        rotation += 1
+
+    return pulses
+
+
+def generate(seconds=2.0, channels=(0, 1), seed=1, slow_bits=None, pose=None):
+    rnd = random.Random(seed)
+
+    pulses = []
+    for channel in channels:
+        pulses += channel_pulses(channel, seconds, rnd, slow_bits.get(channel) if slow_bits else None, pose)
+
+    sync_time = 1
+    while sync_time < seconds * 24000000:
+        pulses.append((sync_time, SYNC_FRAME))
+        sync_time += SYNC_PERIOD
+
+    pulses.sort(key=lambda pulse: pulse[0])
+    return b''.join(frame for _, frame in pulses)
+
+
+# Poses of sensor 0 checked by --check-fov, (azimuth, elevation) in radians
+FOV_POSES = [(0.0, 0.0), (1.0, 0.5), (1.0, -0.5), (-1.0, 0.5), (-1.0, -0.5), (0.9, -0.4)]
+FOV_MIN_PAIRED = 0.95
+FOV_TOLERANCE = math.radians(0.1)
+
+
+# Decodes a capture at each of FOV_POSES, returns True if the sweeps are
+# paired and the angles of sensor 0 are found
+def check_fov(seconds, channel, seed):
+    import decoders
+
+    ok = True
+    for pose in FOV_POSES:
+        decoder = decoders.V2Decoder()
+        data = generate(seconds, (channel,), seed, pose=pose)
+        pairs = 0
+        worst = 0.0
+        with decoders.quiet():
+            for frame in decoders.read_frames(io.BytesIO(data)):
+                angles = decoder.push(frame)
+                if angles and angles.data[0]:
+                    pairs += 1
+                    azimuth, elevation = angles.data[0]
+                    worst = max(worst, abs(azimuth - pose[0]), abs(elevation - pose[1]))
+        rotations = int(seconds * 24000000 / PERIODS[channel])
+        good = pairs >= rotations * FOV_MIN_PAIRED and worst <= FOV_TOLERANCE
+        ok = ok and good
+        print("azimuth: {:6.2f} elevation: {:6.2f}  {:5d} of {:5d} paired, error {:.3f} deg  {}".format(
+            math.degrees(pose[0]), math.degrees(pose[1]), pairs, rotations, math.degrees(worst),
+            "ok" if good else "FAIL"))
+    return ok
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic lighthouse deck capture")
+    parser.add_argument("output", nargs="?", help="output.bin")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--channels", default="1,2", help="comma separated list of channels, 1 to 16")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--check-fov", action="store_true",
+                        help="check the decoding at the corners of the field of view instead")
+    args = parser.parse_args()
+
+    channels = [int(c) - 1 for c in args.channels.split(",")]
+    if args.check_fov:
+        sys.exit(0 if check_fov(args.seconds, channels[0], args.seed) else 1)
+    if not args.output:
+        parser.error("the output file is required")
+    with open(args.output, "wb") as f:
+        f.write(generate(args.seconds, channels, args.seed))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# Unwrapping of the 24 bits frame timestamps
+#
+# The timestamps of the frames count the 24 MHz clock of the deck on 24 bits
+# and wrap every 0.7 s. They are unwrapped into 64 bits ticks on a timeline
+# that starts at the timestamp of the first pulse, so ticks & 0xffffff is
+# always the timestamp of the frame.
+#
+# The time between two pulses is the difference of their timestamps modulo
+# 2^24. A difference of up to MAX_BACKWARD_TICKS back in time is a frame sent
+# out of order, it keeps its earlier time. Longer gaps are found with the sync
+# frames, which the FPGA sends every 0.5 s from the same clock:
+#   * The time of the sync frames is known once a sync frame is received
+#     between two pulses less than PHASE_TICKS apart, and then advances by
+#     SYNC_PERIOD_TICKS for each sync frame. A pulse following a sync frame is
+#     not earlier than it, so the gap is the shortest one that puts the pulse
+#     after the latest sync frame
+#   * Before that, the gap is the shortest one longer than SYNC_PERIOD_TICKS
+#     times the number of sync frames in between, minus one. A gap of more
+#     than a wrap and 2 sync periods at the start of a capture can be a wrap
+#     short
+#
+# A pulse received out of order keeps its earlier time, so the ticks of a
+# stream can go back by up to MAX_BACKWARD_TICKS. The monotonic column of a
+# Timeline clamps them to the latest time before, it never decreases and can
+# be used as a sorted index, with np.searchsorted() for instance.
+#
+# Unwrapper unwraps a stream of frames and unwrap_frames() all the frames of a
+# capture at once.
+
+import framing
+
+CLOCK_FREQUENCY = 24000000
+TIMESTAMP_WRAP = 1 << 24
+TIMESTAMP_MASK = TIMESTAMP_WRAP - 1
+
+SYNC_PERIOD_TICKS = CLOCK_FREQUENCY // 2
+MAX_BACKWARD_TICKS = CLOCK_FREQUENCY // 100
+# Max distance of the pulses around a sync frame to get the time of the sync
+# frames from them
+PHASE_TICKS = CLOCK_FREQUENCY // 10
+# Max time a pulse can be sent after a sync frame while it started before it
+SYNC_LATENCY_TICKS = CLOCK_FREQUENCY // 100
+
+
+def seconds(ticks):
+    return ticks / CLOCK_FREQUENCY
+
+
+# Time columns of frames, numpy arrays with one entry per frame:
+#   ticks      time of the frame in ticks, going back for pulses received out
+#              of order
+#   monotonic  ticks that never decrease, a frame received out of order gets
+#              the time of the latest frame before it
+#   seconds    monotonic in seconds
+class Timeline:
+    def __init__(self, ticks, monotonic):
+        self.ticks = ticks
+        self.monotonic = monotonic
+        self.seconds = monotonic / CLOCK_FREQUENCY
+
+    def __len__(self):
+        return len(self.ticks)
+
+
+class SyncPhase:
+    def __init__(self):
+        # Estimated time of the latest sync frame, None until known
+        self.sync_time = None
+
+    # Returns the ticks between a pulse at time now and the next pulse, delta
+    # ticks later modulo the wrap, with syncs sync frames in between
+    def gap(self, now, delta, syncs):
+        if self.sync_time is not None:
+            self.sync_time += syncs * SYNC_PERIOD_TICKS
+            shortest = self.sync_time - PHASE_TICKS // 2 - SYNC_LATENCY_TICKS - now
+        else:
+            shortest = (syncs - 1) * SYNC_PERIOD_TICKS - SYNC_LATENCY_TICKS
+        wraps = max(0, -((delta - shortest) // TIMESTAMP_WRAP))
+        elapsed = delta + wraps * TIMESTAMP_WRAP
+
+        if syncs == 1 and elapsed <= PHASE_TICKS:
+            self.sync_time = now + elapsed // 2
+        return elapsed
+
+
+class Unwrapper:
+    def __init__(self):
+        self.phase = SyncPhase()
+        # Time and timestamp of the latest pulse
+        self.ticks = None
+        self.latest_ts = None
+        # Sync frames since the latest pulse
+        self.syncs = 0
+        # Latest time of the monotonic column of push_columns()
+        self.monotonic = None
+
+    def sync(self):
+        if self.ticks is not None:
+            self.syncs += 1
+
+    # Returns the time of a pulse
+    def push(self, ts):
+        if self.ticks is None:
+            self.ticks = ts
+        else:
+            delta = (ts - self.latest_ts) & TIMESTAMP_MASK
+            if self.syncs:
+                delta = self.phase.gap(self.ticks, delta, self.syncs)
+            elif delta > TIMESTAMP_WRAP - MAX_BACKWARD_TICKS:
+                delta -= TIMESTAMP_WRAP
+            self.ticks += delta
+
+        self.latest_ts = ts
+        self.syncs = 0
+        return self.ticks
+
+    # Returns the time of a frame, sync frames get the time of the latest
+    # pulse, None before the first one
+    def push_frame(self, frame):
+        if framing.is_sync_frame(frame, 0):
+            self.sync()
+            return self.ticks
+        return self.push(framing.frame_timestamp(frame, 0))
+
+    # Returns the time of a timestamp less than half a wrap from the latest
+    # pulse, for instance the start of a sweep
+    def time_of(self, ts):
+        delta = (ts - self.latest_ts) & TIMESTAMP_MASK
+        if delta >= TIMESTAMP_WRAP // 2:
+            delta -= TIMESTAMP_WRAP
+        return self.ticks + delta
+
+    # Returns the time of each frame of a bulk_decode.FrameArrays as an int64
+    # array, following the frames pushed before. Frames that are not pulses
+    # get the time of the latest pulse, or of the first pulse at the start of
+    # the timeline, and 0 without pulses.
+    def push_frames(self, frames):
+        import numpy as np
+
+        pulse = frames.pulse_mask()
+        pulses = np.flatnonzero(pulse)
+        sync_count = np.cumsum(frames.is_sync)
+        if len(pulses) == 0:
+            if self.ticks is not None:
+                self.syncs += int(sync_count[-1]) if len(frames) else 0
+            return np.full(len(frames), 0 if self.ticks is None else self.ticks, dtype=np.int64)
+
+        timestamps = frames.timestamp[pulses].astype(np.int64)
+        # Sync frames before each pulse, since the previous one
+        syncs = np.diff(sync_count[pulses], prepend=0)
+        first = self.ticks is None
+        if first:
+            start = int(timestamps[0])
+            previous = timestamps[0]
+            syncs[0] = 0
+        else:
+            start = self.ticks
+            previous = self.latest_ts
+            syncs[0] += self.syncs
+        deltas = np.diff(timestamps, prepend=previous) & TIMESTAMP_MASK
+        deltas[(syncs == 0) & (deltas > TIMESTAMP_WRAP - MAX_BACKWARD_TICKS)] -= TIMESTAMP_WRAP
+
+        # The gaps with sync frames are resolved in order, from the time of the
+        # pulse before them
+        gaps = np.flatnonzero(syncs)
+        gap_deltas = deltas[gaps].tolist()
+        deltas[gaps] = 0
+        times = np.cumsum(deltas) - deltas
+        extra = 0
+        for gap, delta, count in zip(gaps.tolist(), gap_deltas, syncs[gaps].tolist()):
+            elapsed = self.phase.gap(start + int(times[gap]) + extra, delta, count)
+            deltas[gap] = elapsed
+            extra += elapsed
+
+        times = start + np.cumsum(deltas)
+        self.ticks = int(times[-1])
+        self.latest_ts = int(timestamps[-1])
+        self.syncs = int(sync_count[-1] - sync_count[pulses[-1]])
+
+        latest_pulse = np.cumsum(pulse) - 1
+        result = times[np.maximum(latest_pulse, 0)]
+        if not first:
+            result[latest_pulse < 0] = start
+        return result
+
+
+    # Returns the Timeline of the frames of a bulk_decode.FrameArrays, the
+    # ticks of push_frames() and the monotonic and seconds columns, following
+    # the frames pushed before
+    def push_columns(self, frames):
+        import numpy as np
+
+        ticks = self.push_frames(frames)
+        monotonic = np.maximum.accumulate(ticks) if len(ticks) else ticks.copy()
+        if self.monotonic is not None:
+            np.maximum(monotonic, self.monotonic, out=monotonic)
+        if len(monotonic):
+            self.monotonic = int(monotonic[-1])
+        return Timeline(ticks, monotonic)
+
+
+# Returns the Timeline of all the frames of a bulk_decode.FrameArrays. Frames
+# that are not pulses get the time of the latest pulse.
+def unwrap_frames(frames):
+    return Unwrapper().push_columns(frames)
+
+
+if __name__ == "__main__":
+    import sys
+    import bulk_decode
+    import numpy as np
+
+    if len(sys.argv) < 2:
+        print("Usage: {} <input.bin>".format(sys.argv[0]))
+        exit(1)
+
+    frames = bulk_decode.load_capture(sys.argv[1])
+    columns = unwrap_frames(frames)
+    pulse = frames.pulse_mask()
+    pulses = columns.monotonic[pulse]
+    gaps = np.diff(pulses)
+    # Pulses received after a later one, by how much
+    late = (columns.monotonic - columns.ticks)[pulse]
+
+    print("Frames:   {}".format(len(frames)))
+    if len(pulses):
+        print("Time:     {:.6f} to {:.6f} s".format(columns.seconds[pulse][0], columns.seconds[pulse][-1]))
+        print("Wraps:    {}".format(int(pulses[-1] >> 24) - int(pulses[0] >> 24)))
+        print("Gaps:     {} longer than a wrap, longest {:.3f} s".format(
+            np.count_nonzero(gaps >= TIMESTAMP_WRAP), seconds(gaps.max(initial=0))))
+        print("Late:     {} pulses out of order, up to {:.1f} us".format(
+            np.count_nonzero(late), seconds(late.max(initial=0)) * 1e6))